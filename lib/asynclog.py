@@ -0,0 +1,240 @@
+from collections import deque
+from threading import Thread, Condition, Lock
+import atexit
+import gzip
+import logging
+import os
+import shutil
+import sys
+
+
+class _LogFile:
+    """
+    Log file owned by writer thread, size is tracked in memory instead of seek/tell per record
+    """
+
+    def __init__(self, path, max_bytes, backups, compress):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self.backups = int(backups)
+        self.compress = compress
+        self.stream = None
+        self.size = 0
+        self.rotations = 0
+
+    def open(self):
+        self.stream = open(self.path, 'a')
+        self.size = os.path.getsize(self.path)
+
+    def write(self, data):
+        if self.stream is None:
+            self.open()
+        self.stream.write(data)
+        self.size += len(data)
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+
+
+class AsyncLogWriter(Thread):
+    """
+    Background thread that formats and writes records of all async handlers
+    Records of a wake-up are written with one write per file and one flush, files are rotated by byte count
+    and rotated files are shifted (and gzip compressed) by a separate thread.
+    """
+
+    def __init__(self):
+        Thread.__init__(self, name='AsyncLogWriter')
+        self.daemon = True
+        self._condition = Condition(Lock())
+        self._records = deque()
+        self._stopping = False
+        self._idle = True
+        self._rotated = deque()
+        self._rotated_condition = Condition(Lock())
+        self._rotator = Thread(target=self._rotate_loop, name='AsyncLogRotator')
+        self._rotator.daemon = True
+
+    def start(self):
+        Thread.start(self)
+        self._rotator.start()
+
+    def enqueue(self, handler, record):
+        with self._condition:
+            self._records.append((handler, record))
+            if self._idle:
+                self._condition.notify_all()
+
+    def backlog(self):
+        return len(self._records)
+
+    def flush(self, timeout=5):
+        # Wait until everything queued so far is written, used on close and exit
+        with self._condition:
+            self._condition.notify()
+            waited = 0
+            while (self._records or not self._idle) and waited < timeout:
+                self._condition.wait(0.1)
+                waited += 0.1
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self.join(5)
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._records and not self._stopping:
+                    self._idle = True
+                    self._condition.notify_all()
+                    self._condition.wait(1)
+                if not self._records and self._stopping:
+                    self._idle = True
+                    self._condition.notify_all()
+                    return
+                self._idle = False
+                records = self._records
+                self._records = deque()
+            self._write(records)
+
+    def _write(self, records):
+        chunks = {}
+        for handler, record in records:
+            try:
+                chunks.setdefault(handler, []).append(handler.format(record) + '\n')
+            except Exception:
+                handler.handleError(record)
+
+        for handler, lines in chunks.items():
+            if handler.dropped:
+                dropped, handler.dropped = handler.dropped, 0
+                lines.insert(0, '{} log records dropped, buffer was full\n'.format(dropped))
+            try:
+                self._write_file(handler.log_file, ''.join(lines))
+            except Exception, e:
+                # Nowhere to log it, keep going with other files
+                print >> sys.stderr, 'Error writing log file {}: {}'.format(handler.log_file.path, e)
+
+    def _write_file(self, log_file, data):
+        log_file.write(data)
+        log_file.stream.flush()
+        if log_file.max_bytes and log_file.size >= log_file.max_bytes:
+            # Only rename here, shifting backups and compression happen in rotator thread
+            log_file.close()
+            log_file.rotations += 1
+            rotated = '{}.rotated.{}.{}'.format(log_file.path, os.getpid(), log_file.rotations)
+            os.rename(log_file.path, rotated)
+            log_file.open()
+            with self._rotated_condition:
+                self._rotated.append((log_file, rotated))
+                self._rotated_condition.notify()
+
+    def _rotate_loop(self):
+        while True:
+            with self._rotated_condition:
+                while not self._rotated:
+                    self._rotated_condition.wait(1)
+                log_file, rotated = self._rotated.popleft()
+            try:
+                self._shift_backups(log_file, rotated)
+            except Exception, e:
+                print >> sys.stderr, 'Error rotating log file {}: {}'.format(log_file.path, e)
+
+    @staticmethod
+    def _shift_backups(log_file, rotated):
+        suffix = '.gz' if log_file.compress else ''
+        if log_file.compress:
+            with open(rotated, 'rb') as source:
+                compressed = gzip.open(rotated + '.gz', 'wb')
+                try:
+                    shutil.copyfileobj(source, compressed)
+                finally:
+                    compressed.close()
+            os.remove(rotated)
+            rotated += '.gz'
+
+        if log_file.backups < 1:
+            os.remove(rotated)
+            return
+        # path.1 is the newest backup, same as RotatingFileHandler
+        for index in range(log_file.backups - 1, 0, -1):
+            source = '{}.{}{}'.format(log_file.path, index, suffix)
+            if os.path.exists(source):
+                os.rename(source, '{}.{}{}'.format(log_file.path, index + 1, suffix))
+        os.rename(rotated, '{}.1{}'.format(log_file.path, suffix))
+
+
+# (pid, writer), forked child inherits the writer object but not its threads
+_writer = (None, None)
+_writer_lock = Lock()
+
+
+def _get_writer():
+    global _writer, _writer_lock
+    pid, writer = _writer
+    if pid == os.getpid():
+        return writer
+    if pid is not None:
+        # Forked child, lock could have been held by a thread of parent at fork time
+        _writer_lock = Lock()
+    with _writer_lock:
+        pid, writer = _writer
+        if pid != os.getpid():
+            # Records buffered by parent are left to parent
+            writer = AsyncLogWriter()
+            writer.start()
+            _writer = (os.getpid(), writer)
+        return writer
+
+
+def _flush_at_exit():
+    pid, writer = _writer
+    if pid == os.getpid():
+        writer.flush()
+
+
+atexit.register(_flush_at_exit)
+
+
+class AsyncLogHandler(logging.Handler):
+    """
+    Non-blocking file handler, emit() only appends record to in-memory buffer shared by all async handlers
+    When buffer holds max_records, records are dropped and counted, logging never blocks calling thread.
+    Message is formatted by writer thread, so log arguments must not be mutated after the call.
+    File size and rotation are tracked per process, so a file must have one writing process only.
+    In process mode children log to Main-<component> instead of Main (see ComponentProcess.run).
+    """
+
+    def __init__(self, path, max_bytes=0, backups=0, compress=True, max_records=10000):
+        logging.Handler.__init__(self)
+        self.log_file = _LogFile(path, max_bytes, backups, compress)
+        self.max_records = int(max_records)
+        self.dropped = 0
+        _get_writer()
+
+    def createLock(self):
+        # Writer thread is the only one touching the file
+        self.lock = None
+
+    def emit(self, record):
+        # Writer is looked up on every record so handler keeps working in forked child
+        writer = _get_writer()
+        if writer.backlog() >= self.max_records:
+            self.dropped += 1
+            return
+        if record.exc_info and not record.exc_text:
+            # Traceback has to be rendered while frames still exist
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        writer.enqueue(self, record)
+
+    def flush(self):
+        _get_writer().flush()
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
@@ -0,0 +1,26 @@
+import random
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter
+    Every failure doubles the ceiling up to maximum, actual delay is random below the ceiling
+    so many clients failing at once don't retry in lockstep.
+    """
+
+    def __init__(self, initial=1.0, maximum=60.0, multiplier=2.0, jitter=True):
+        self._initial = float(initial)
+        self._maximum = float(maximum)
+        self._multiplier = float(multiplier)
+        self._jitter = jitter
+        self.failures = 0
+
+    def next_delay(self):
+        ceiling = min(self._initial * (self._multiplier ** self.failures), self._maximum)
+        self.failures += 1
+        if self._jitter:
+            return random.uniform(self._initial / 2, max(ceiling, self._initial / 2))
+        return ceiling
+
+    def reset(self):
+        self.failures = 0
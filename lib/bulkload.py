@@ -0,0 +1,35 @@
+import os
+import tempfile
+
+# Tab separated format read by LOAD DATA with default FIELDS/LINES options
+_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\x00': '\\0'}
+
+
+def tsv_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, float):
+        value = repr(value)
+    else:
+        value = str(value)
+    for char in '\\\t\n\r\x00':
+        if char in value:
+            value = value.replace(char, _ESCAPES[char])
+    return value
+
+
+def write_tsv(rows, directory=None):
+    """
+    Write rows to temporary file for LOAD DATA LOCAL INFILE, returns file path
+    Caller removes the file when load is done
+    """
+    descriptor, path = tempfile.mkstemp(prefix='bulk-', suffix='.tsv', dir=directory)
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            output.writelines('\t'.join([tsv_value(value) for value in row]) + '\n' for row in rows)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
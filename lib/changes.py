@@ -0,0 +1,91 @@
+from lib.clock import monotonic
+import Queue
+
+
+class ChangeDetector:
+    """
+    Remembers fingerprint of last written row per primary key
+    Only new and changed rows pass through filter(), keys missing from a complete run are reported
+    as removed. Every resync_interval seconds all rows are passed through to heal any drift.
+    """
+
+    def __init__(self, key_index, resync_interval=3600):
+        self._key_index = key_index
+        self._resync_interval = float(resync_interval)
+        self._fingerprints = {}
+        self._next_resync = 0
+        self._seen = None
+        self.passed = 0
+        self.suppressed = 0
+
+    def invalidate(self):
+        # Run failed part way, state may not match what was written, resync on next run
+        self._next_resync = 0
+
+    def filter(self, rows):
+        if monotonic() >= self._next_resync:
+            # Forget fingerprints but keep keys so removals are still detected on resync run
+            self._fingerprints = dict.fromkeys(self._fingerprints)
+            self._next_resync = monotonic() + self._resync_interval
+
+        fingerprints = self._fingerprints
+        key_index = self._key_index
+        seen = self._seen = set()
+        self.passed = 0
+        self.suppressed = 0
+        for row in rows:
+            key = row[key_index]
+            seen.add(key)
+            fingerprint = hash(row)
+            if fingerprints.get(key) == fingerprint:
+                self.suppressed += 1
+                continue
+            fingerprints[key] = fingerprint
+            self.passed += 1
+            yield row
+
+    def finish(self):
+        # Called after filter() was fully consumed, returns keys that disappeared since previous run
+        removed = [key for key in self._fingerprints if key not in self._seen]
+        for key in removed:
+            del self._fingerprints[key]
+        self._seen = None
+        return removed
+
+
+class DropNotices:
+    """
+    Reports jobs dropped on the way to MySQL back to the flows that produced them
+    Writer side calls dropped(job) wherever a job is thrown away, scraper calls resync(flows) so change
+    detection of matching flows sends all rows again instead of suppressing rows that were never written.
+    Queue is Queue.Queue in thread mode and multiprocessing.Queue when scrapers run in their own process.
+    """
+
+    def __init__(self, queue):
+        self._queue = queue
+        if hasattr(queue, 'cancel_join_thread'):
+            # Notices are best effort, process exit doesn't wait for ones nobody reads
+            queue.cancel_join_thread()
+
+    def dropped(self, job):
+        self._queue.put_nowait((job['name'], job.get('router')))
+
+    def take(self):
+        # (flow name, router id) of jobs dropped since previous call
+        dropped = set()
+        try:
+            while True:
+                dropped.add(self._queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return dropped
+
+    def resync(self, flows):
+        # Returns flows whose change detection was reset
+        dropped = self.take()
+        if not dropped:
+            return []
+        resynced = [flow for flow in flows if (flow.get_flow_name(), flow.get_router_id()) in dropped]
+        for flow in resynced:
+            flow.reset_changes()
+        return resynced
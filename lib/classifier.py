@@ -0,0 +1,98 @@
+import bisect
+import socket
+import struct
+
+TRAFFIC_LOCAL = 'local'
+TRAFFIC_UPLOAD = 'upload'
+TRAFFIC_DOWNLOAD = 'download'
+TRAFFIC_WAN = 'wan'
+
+_ip_struct = struct.Struct('!I')
+
+
+def ip_to_int(address):
+    return _ip_struct.unpack(socket.inet_aton(address))[0]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(_ip_struct.pack(value))
+
+
+def parse_prefix(prefix):
+    # '192.168.0.0/16' -> (3232235520, 3232301055)
+    if '/' in prefix:
+        address, length = prefix.split('/', 1)
+        length = int(length)
+    else:
+        address, length = prefix, 32
+    if not 0 <= length <= 32:
+        raise Exception('Invalid prefix length in [{}]'.format(prefix))
+
+    mask = (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+    start = ip_to_int(address.strip()) & mask
+    return start, start | (~mask & 0xFFFFFFFF)
+
+
+class TrafficClassifier:
+    """
+    Classifies accounting rows as local/upload/download/wan traffic
+    LAN prefixes are parsed once into sorted, merged integer ranges, lookup is one bisect per address
+    """
+
+    def __init__(self, lan_prefixes):
+        ranges = sorted(parse_prefix(prefix) for prefix in lan_prefixes)
+
+        # Merge overlapping and adjacent ranges
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        self._starts = [start for start, end in merged]
+        self._ends = [end for start, end in merged]
+
+    def is_local_int(self, value):
+        idx = bisect.bisect_right(self._starts, value) - 1
+        return idx >= 0 and value <= self._ends[idx]
+
+    def is_local(self, address):
+        try:
+            return self.is_local_int(ip_to_int(address))
+        except (socket.error, TypeError):
+            # Not an IPv4 address
+            return False
+
+    def classify(self, source_ip, destination_ip):
+        return self._classify(self.is_local(source_ip), self.is_local(destination_ip), source_ip, destination_ip)
+
+    @staticmethod
+    def _classify(source_local, destination_local, source_ip, destination_ip):
+        if source_local:
+            if destination_local:
+                return TRAFFIC_LOCAL, source_ip
+            return TRAFFIC_UPLOAD, source_ip
+        if destination_local:
+            return TRAFFIC_DOWNLOAD, destination_ip
+        return TRAFFIC_WAN, ''
+
+    def classify_batch(self, rows):
+        """
+        Classify iterable of rows starting with (source_ip, destination_ip, ...)
+        Yields each row extended with (traffic_type, local_ip)
+        Same hosts repeat a lot in a snapshot so every address is looked up only once per batch
+        """
+        seen = {}
+        is_local = self.is_local
+        classify = self._classify
+        for row in rows:
+            source_ip, destination_ip = row[0], row[1]
+            source_local = seen.get(source_ip)
+            if source_local is None:
+                source_local = seen[source_ip] = is_local(source_ip)
+            destination_local = seen.get(destination_ip)
+            if destination_local is None:
+                destination_local = seen[destination_ip] = is_local(destination_ip)
+
+            yield row + classify(source_local, destination_local, source_ip, destination_ip)
@@ -0,0 +1,47 @@
+import ctypes
+import ctypes.util
+import os
+import time
+
+# Monotonic clock for interval scheduling
+# time.time() jumps with NTP corrections and manual clock changes, use CLOCK_MONOTONIC where available
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+
+_CLOCK_MONOTONIC = 1
+
+
+def _load_clock_gettime():
+    if os.name != 'posix':
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        return clock_gettime
+    except Exception:
+        return None
+
+
+_clock_gettime = _load_clock_gettime()
+
+
+def _monotonic_posix():
+    ts = _Timespec()
+    if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif _clock_gettime:
+    monotonic = _monotonic_posix
+else:
+    # Last resort, not monotonic but keeps scheduler working
+    monotonic = time.time
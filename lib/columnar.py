@@ -0,0 +1,166 @@
+from array import array
+from lib.classifier import ip_to_int, int_to_ip
+
+# Column types, counters and IPs are kept in typed arrays, strings as indexes into batch string dictionary
+TYPE_STR = 'str'
+TYPE_INT = 'int'
+TYPE_FLOAT = 'float'
+TYPE_IP = 'ip'
+
+_TYPECODES = {TYPE_STR: 'i', TYPE_INT: 'l', TYPE_FLOAT: 'd', TYPE_IP: 'I'}
+_CONVERTERS = {TYPE_INT: int, TYPE_FLOAT: float, TYPE_IP: ip_to_int}
+
+# Marker of columnar payload in spool records
+_RECORD_TAG = 'columnar:1'
+
+
+class ColumnarBatch:
+    """
+    Compact payload of one job, one typed array per column
+    Rows are appended as tuples and read back as tuples with IPs as dotted strings, so code that iterates
+    payload works unchanged. Writer uses flat_args() and row_size() to build statements without row tuples.
+    Values that don't convert to column type (None, '' for WAN local IP) are kept as they are
+    in per column exceptions dict.
+    """
+
+    def __init__(self, types):
+        self.types = tuple(types)
+        for column_type in self.types:
+            if column_type not in _TYPECODES:
+                raise Exception('Unknown column type {}'.format(column_type))
+        self._columns = [array(_TYPECODES[column_type]) for column_type in self.types]
+        self._exceptions = [None] * len(self.types)
+        self._strings = []
+        self._string_index = {}
+        self._length = 0
+
+    def _intern(self, value):
+        index = self._string_index.get(value)
+        if index is None:
+            index = self._string_index[value] = len(self._strings)
+            self._strings.append(value)
+        return index
+
+    def append(self, row):
+        if len(row) != len(self.types):
+            raise Exception('Row has {} values, batch has {} columns'.format(len(row), len(self.types)))
+        position = 0
+        for value, column_type in zip(row, self.types):
+            if column_type == TYPE_STR:
+                value = self._intern(value)
+            else:
+                try:
+                    value = _CONVERTERS[column_type](value)
+                except Exception:
+                    if self._exceptions[position] is None:
+                        self._exceptions[position] = {}
+                    self._exceptions[position][self._length] = value
+                    value = 0
+            self._columns[position].append(value)
+            position += 1
+        self._length += 1
+
+    def __len__(self):
+        return self._length
+
+    def _decoded_column(self, position, start, stop):
+        column_type = self.types[position]
+        values = self._columns[position][start:stop]
+        if column_type == TYPE_STR:
+            strings = self._strings
+            return [strings[index] for index in values]
+        if column_type == TYPE_IP:
+            # Same addresses repeat a lot, convert each once
+            cache = {}
+            decoded = []
+            for value in values:
+                address = cache.get(value)
+                if address is None:
+                    address = cache[value] = int_to_ip(value)
+                decoded.append(address)
+            values = decoded
+        else:
+            values = values.tolist()
+        exceptions = self._exceptions[position]
+        if exceptions:
+            for row, value in exceptions.iteritems():
+                if start <= row < stop:
+                    values[row - start] = value
+        return values
+
+    def rows(self, start=0, stop=None):
+        stop = self._length if stop is None else min(stop, self._length)
+        return zip(*[self._decoded_column(position, start, stop) for position in range(len(self.types))])
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self._length)
+            return self.rows(start, stop)[::step]
+        if item < 0:
+            item += self._length
+        return self.rows(item, item + 1)[0]
+
+    def flat_args(self, start, stop):
+        # Statement arguments for rows [start, stop), row after row
+        columns = [self._decoded_column(position, start, stop) for position in range(len(self.types))]
+        args = []
+        for row in zip(*columns):
+            args.extend(row)
+        return args
+
+    def row_size(self):
+        # Approximate encoded size of one row in statement, used to bound statement size
+        if not self._length:
+            return 0
+        size = 0
+        for position, column_type in enumerate(self.types):
+            if column_type == TYPE_STR:
+                size += sum(len(value) for value in self._strings if value) // len(self._strings) + 4
+            elif column_type == TYPE_IP:
+                size += 19
+            else:
+                size += 24
+        return size
+
+    def nbytes(self):
+        # Memory held by arrays and string dictionary
+        return sum(column.itemsize * len(column) for column in self._columns) + \
+            sum(len(value) + 40 for value in self._strings if value)
+
+    def to_record(self):
+        # Plain types only, for marshal
+        return (_RECORD_TAG, self.types, self._length, tuple(self._strings),
+                tuple(column.tostring() for column in self._columns),
+                tuple(exceptions or {} for exceptions in self._exceptions))
+
+    @classmethod
+    def from_record(cls, record):
+        tag, types, length, strings, columns, exceptions = record
+        batch = cls(types)
+        batch._length = length
+        batch._strings = list(strings)
+        batch._string_index = dict((value, index) for index, value in enumerate(strings))
+        for column, data in zip(batch._columns, columns):
+            column.fromstring(data)
+        batch._exceptions = [dict(values) if values else None for values in exceptions]
+        return batch
+
+
+def is_record(payload):
+    return isinstance(payload, tuple) and len(payload) == 6 and payload[0] == _RECORD_TAG
+
+
+def encode_job(job):
+    # Job with columnar payload to job with marshal friendly payload
+    if isinstance(job['payload'], ColumnarBatch):
+        return dict(job, payload=job['payload'].to_record())
+    return job
+
+
+def decode_job(job):
+    if is_record(job['payload']):
+        return dict(job, payload=ColumnarBatch.from_record(job['payload']))
+    return job
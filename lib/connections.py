@@ -0,0 +1,215 @@
+from lib.backoff import Backoff
+from lib.clock import monotonic
+from lib.metrics import ROUTEROS_CONNECTS
+from threading import Condition, Lock
+
+
+class RouterUnavailable(Exception):
+    pass
+
+
+class RouterConnection:
+    def __init__(self, router_id, client, api):
+        self.router_id = router_id
+        self._client = client
+        self._api = api
+        self.last_used = monotonic()
+
+    @property
+    def connected(self):
+        return self._client.connected
+
+    def get_api(self):
+        return self._api
+
+    def disconnect(self):
+        self._client.disconnect()
+
+
+class _RouterState:
+    def __init__(self, router, max_connections, backoff):
+        self.router = router
+        self.idle = []
+        self.open = 0
+        self.max_connections = max(int(max_connections), 1)
+        self.backoff = backoff
+        self.retry_at = 0
+        # Multiplexed mode, one connection shared by all workers
+        self.shared = None
+        self.connecting = False
+
+
+class ConnectionManager:
+    """
+    Keeps persistent API connections per router
+    Connections are checked out by one worker at a time and returned after the call. Idle connections
+    are health checked before reuse, failed connects put the router in jittered exponential backoff.
+    In multiplexed mode (connections with tagged concurrent requests) every worker gets the same
+    connection per router.
+    """
+
+    def __init__(self, logger, routers, connection_factory, max_connections=2, health_check_interval=30,
+                 acquire_timeout=10, backoff_initial=1, backoff_max=60, multiplexed=False):
+        self.LOGGER = logger
+        self._connection_factory = connection_factory
+        self._multiplexed = multiplexed
+        self._health_check_interval = float(health_check_interval)
+        self._acquire_timeout = float(acquire_timeout)
+        self._closing = False
+
+        self._lock = Lock()
+        self._available = Condition(self._lock)
+        self._routers = {}
+        for router in routers:
+            self._routers[router['id']] = _RouterState(router,
+                                                       router.get('max_connections', max_connections),
+                                                       Backoff(backoff_initial, backoff_max))
+
+    def router_ids(self):
+        return self._routers.keys()
+
+    def all_failing(self, max_failures):
+        # True when every router failed to connect more than max_failures times in a row
+        with self._lock:
+            return all(state.backoff.failures > max_failures for state in self._routers.values())
+
+    def _connect(self, state):
+        router_id = state.router['id']
+        client = None
+        try:
+            client = self._connection_factory(state.router)
+            # RouterOsApiPool connects and logs in on first get_api(), not in its constructor
+            connection = RouterConnection(router_id, client, client.get_api())
+        except Exception, e:
+            if client is not None:
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
+            ROUTEROS_CONNECTS.labels(router_id, 'error').inc()
+            with self._lock:
+                state.open -= 1
+                delay = state.backoff.next_delay()
+                state.retry_at = monotonic() + delay
+                self._available.notify_all()
+            self.LOGGER.error("Error connecting to router [{}], retrying in {:.1f} sec\n***{}".format(router_id,
+                                                                                                 delay, e))
+            raise RouterUnavailable('Router [{}] connect failed'.format(router_id))
+
+        ROUTEROS_CONNECTS.labels(router_id, 'ok').inc()
+        state.backoff.reset()
+        self.LOGGER.info("Connected to router [{}]".format(router_id))
+        return connection
+
+    def _is_healthy(self, connection):
+        try:
+            connection.get_api().get_resource('/system/identity').get()
+            return True
+        except Exception, e:
+            self.LOGGER.warning("Health check failed for router [{}]\n***{}".format(connection.router_id, e))
+            return False
+
+    def _acquire_shared(self, state, router_id):
+        with self._available:
+            end = monotonic() + self._acquire_timeout
+            while state.connecting:
+                remaining = end - monotonic()
+                if remaining <= 0:
+                    raise RouterUnavailable('Connecting to router [{}] takes too long'.format(router_id))
+                self._available.wait(remaining)
+
+            if state.shared and state.shared.connected:
+                return state.shared
+            if monotonic() < state.retry_at:
+                raise RouterUnavailable('Router [{}] in backoff'.format(router_id))
+            state.shared = None
+            state.connecting = True
+            state.open += 1
+
+        try:
+            connection = self._connect(state)
+        finally:
+            with self._available:
+                state.connecting = False
+                self._available.notify_all()
+
+        with self._available:
+            state.shared = connection
+        return connection
+
+    def acquire(self, router_id):
+        state = self._routers[router_id]
+        if self._multiplexed:
+            return self._acquire_shared(state, router_id)
+
+        connection = None
+        with self._available:
+            if monotonic() < state.retry_at:
+                raise RouterUnavailable('Router [{}] in backoff'.format(router_id))
+
+            end = monotonic() + self._acquire_timeout
+            while True:
+                if state.idle:
+                    connection = state.idle.pop()
+                    break
+                if state.open < state.max_connections:
+                    # Reserve slot, connect outside of lock
+                    state.open += 1
+                    break
+                remaining = end - monotonic()
+                if remaining <= 0:
+                    raise RouterUnavailable('No free connection for router [{}]'.format(router_id))
+                self._available.wait(remaining)
+
+        if connection is None:
+            return self._connect(state)
+
+        if monotonic() - connection.last_used > self._health_check_interval and not self._is_healthy(connection):
+            self._disconnect(connection)
+            return self._connect(state)
+
+        return connection
+
+    def release(self, connection, healthy=True):
+        state = self._routers[connection.router_id]
+        with self._available:
+            keep = healthy and not self._closing and connection.connected
+            if self._multiplexed:
+                # Shared connection stays with router until the connection itself breaks,
+                # failed request doesn't affect other requests in flight
+                keep = not self._closing and connection.connected
+                if not keep and state.shared is connection:
+                    state.shared = None
+                    state.open -= 1
+                elif not keep:
+                    return
+            elif keep:
+                connection.last_used = monotonic()
+                state.idle.append(connection)
+            else:
+                state.open -= 1
+            self._available.notify()
+
+        if not keep:
+            self._disconnect(connection)
+
+    def _disconnect(self, connection):
+        try:
+            connection.disconnect()
+            self.LOGGER.info("Disconnected router [{}]".format(connection.router_id))
+        except Exception, e:
+            self.LOGGER.error("Error disconnecting router [{}]\n***{}".format(connection.router_id, e))
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+            idle = []
+            for state in self._routers.values():
+                if state.shared:
+                    state.idle.append(state.shared)
+                    state.shared = None
+                idle.extend(state.idle)
+                state.open -= len(state.idle)
+                state.idle = []
+        for connection in idle:
+            self._disconnect(connection)
@@ -0,0 +1,31 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class RecentBatches:
+    """
+    Bounded LRU of written batch ids
+    Shared by writer threads, so access is locked
+    """
+
+    def __init__(self, capacity=100000):
+        self._capacity = int(capacity)
+        self._batches = OrderedDict()
+        self._lock = Lock()
+
+    def seen(self, batch_id):
+        with self._lock:
+            if batch_id not in self._batches:
+                return False
+            # Refresh position
+            del self._batches[batch_id]
+            self._batches[batch_id] = True
+            return True
+
+    def add(self, batch_ids):
+        with self._lock:
+            for batch_id in batch_ids:
+                self._batches.pop(batch_id, None)
+                self._batches[batch_id] = True
+            while len(self._batches) > self._capacity:
+                self._batches.popitem(last=False)
@@ -1,24 +1,87 @@
 # from logger import get_logger
-from time import time
-import re
+import itertools
+import time
+import uuid
+from lib.changes import ChangeDetector
+from lib.classifier import TrafficClassifier
+from lib.rollup import Rollup
+from lib.clock import monotonic
+from lib.columnar import ColumnarBatch
+from lib.routeros.client import stream, build_queries
 
 
 class Flow:
-    def __init__(self, logger, flow):
+    # Router attributes each flow method reads, sent as .proplist so router serialises only these
+    # Can be overridden with flow 'fields' config
+    FIELDS = {
+        'dhcp_server_leases': ('mac-address', 'address', 'host-name', 'comment', 'status'),
+        'lan_traffic_usage': ('src-address', 'dst-address', 'bytes', 'packets'),
+        'interface_usage': ('name', 'rx-bits-per-second', 'tx-bits-per-second',
+                            'rx-packets-per-second', 'tx-packets-per-second',
+                            'rx-drops-per-second', 'tx-drops-per-second',
+                            'rx-errors-per-second', 'tx-errors-per-second'),
+    }
+
+    # Column types of flow method rows, jobs of these flows carry ColumnarBatch payload
+    # Can be overridden with flow 'column_types' config, 'columnar': False sends plain lists of tuples
+    COLUMN_TYPES = {
+        'dhcp_server_leases': ('str', 'ip', 'str', 'str', 'str', 'int'),
+        'lan_traffic_usage': ('float', 'str', 'ip', 'ip', 'ip', 'int', 'int'),
+        'interface_usage': ('str', 'int', 'int', 'int', 'int', 'int', 'int', 'int', 'int'),
+    }
+
+    def __init__(self, logger, flow, router_id=None):
         self._name = None
         self.LOGGER = logger
         self._flow_config = flow
-        self._last_run_timestamp = None
 
         self._name = str(flow['name'])
         self._params = tuple(flow['params'])
         self._run_interval = float(flow['run_interval'])
         self._mysql_type = str(flow['mysql_type'])
         self._mysql_table = str(flow['mysql_table'])
+        self._overrun_policy = flow.get('overrun_policy')
+        self._max_concurrency = int(flow.get('max_concurrency', 1))
+        # Rows are emitted in jobs of at most batch_size rows while router reply is streamed
+        self._batch_size = int(flow.get('batch_size', 5000))
+        # Field projection and server side filtering, ex 'query': {'status': 'bound'}
+        self._fields = tuple(flow.get('fields') or self.FIELDS.get(self._name, ()))
+        self._queries = build_queries(flow.get('query'))
+
+        # Router this flow instance scrapes, appended to every row if flow has router_column configured
+        self._router_id = router_id
+        self._router_column = flow.get('router_column')
+
+        self._column_types = None
+        if flow.get('columnar', True):
+            column_types = flow.get('column_types') or self.COLUMN_TYPES.get(self._name)
+            if column_types:
+                self._column_types = tuple(column_types) + (('str',) if self._router_column else ())
+
+        # Only new, changed and (optionally) removed rows are sent, ex
+        # 'change_detection': {'primary_key': 'mac', 'resync_interval': 3600, 'delete_removed': True}
+        self._change_detector = None
+        self._delete_removed = False
+        change_detection = flow.get('change_detection')
+        if change_detection:
+            key_index = self._params.index(change_detection.get('primary_key', self._params[0]))
+            self._change_detector = ChangeDetector(key_index, change_detection.get('resync_interval', 3600))
+            self._delete_removed = bool(change_detection.get('delete_removed', False))
+            # Detector state belongs to one run at a time
+            self._max_concurrency = 1
+
+        # Rows are aggregated into time buckets written to separate rollup table, see lib/rollup.py
+        self._rollup = Rollup(flow) if flow.get('rollup') else None
+
+        # Every job carries sequence number, batch id and collection time, see _job
+        self._sequence = itertools.count(1)
+        self._last_run_mono = None
 
         # Custom method vars
         self.lan_traffic_usage_first_run = True
+        self.lan_traffic_snapshot_at = None
         self.interface_usage_list = ['ether1-gateway', 'ether2-master-local']
+        self.lan_traffic_classifier = TrafficClassifier(flow.get('lan_prefixes', ['192.168.0.0/16']))
 
         # Check if method for flow exists
         if not self.__method_exists(self._name):
@@ -30,6 +93,11 @@ class Flow:
     def __run_method(self, methodName, methodArgs=None):
         return getattr(self, methodName, None)(methodArgs)
 
+    def __str__(self):
+        if self._router_id is None:
+            return self._name
+        return "{}/{}".format(self._router_id, self._name)
+
     def get_flow_name(self):
         return self._name
 
@@ -42,32 +110,138 @@ class Flow:
     def get_params(self):
         return self._params
 
-    # Called each thread loop pass, check if its time to execute method
+    def get_run_interval(self):
+        return self._run_interval
+
+    def get_overrun_policy(self):
+        return self._overrun_policy
+
+    def get_max_concurrency(self):
+        return self._max_concurrency
+
+    def get_router_id(self):
+        return self._router_id
+
+    def reset_changes(self):
+        # Rows emitted by change detection were not written, full resync on next run
+        if self._change_detector:
+            self._change_detector.invalidate()
+
+    def _start_run(self):
+        # Collection time of this run and measured time since previous run of this flow
+        now = monotonic()
+        interval = None if self._last_run_mono is None else now - self._last_run_mono
+        self._last_run_mono = now
+        return {'id': uuid.uuid4().hex,
+                'collected_at': time.time(),
+                'collected_mono': now,
+                'interval': interval,
+                'parts': itertools.count()}
+
+    def _job(self, run, rows, deleted=None, name=None):
+        # batch_id is unique per job and stays the same when job is retried or replayed from spool
+        job = {'name': name or self._name,
+               'router': self._router_id,
+               'payload': rows,
+               'seq': next(self._sequence),
+               'batch_id': '{}:{}'.format(run['id'], next(run['parts'])),
+               'collected_at': run['collected_at'],
+               'collected_mono': run['collected_mono'],
+               'interval': run['interval']}
+        if deleted:
+            job['deleted'] = deleted
+        return job
+
+    def _new_batch(self):
+        if self._column_types:
+            return ColumnarBatch(self._column_types)
+        return []
+
+    def _rollup_jobs(self, run):
+        rows = self._rollup.flush()
+        if self._router_column:
+            rows = [row + (self._router_id,) for row in rows]
+        for start in range(0, len(rows), self._batch_size):
+            yield self._job(run, rows[start:start + self._batch_size], name=self._rollup.name)
+
+    def flush_rollup(self):
+        # Jobs of open rollup bucket, used on shutdown so partial aggregate is not lost
+        # Rollup rows accumulate, bucket continued after restart adds to the same row
+        if not self._rollup:
+            return []
+        return list(self._rollup_jobs(self._start_run()))
+
+    def _deleted_keys(self, keys):
+        if self._router_column:
+            return [(key, self._router_id) for key in keys]
+        return [(key,) for key in keys]
+
+    # Called by thread scheduler when flow is due
     # Thread passes active api client object and it is passed to every method
-    def loop_pass(self, client):
-        if not self._last_run_timestamp or time() - self._last_run_timestamp > self._run_interval:
-            self.LOGGER.debug("Running method {}".format(self._name))
+    # Generator, yields jobs of at most batch_size rows so whole router table is never held in memory
+    def execute(self, client):
+        self.LOGGER.debug("Running method {}", self._name)
+
+        # Run flow custom method
+        run = self._start_run()
+        timestamp = run['collected_at']
+        rows = self.__run_method(self._name, client)
+        if rows is None:
+            return
+
+        rollup = self._rollup
+        if rollup:
+            # Bucket left open by missed runs is closed before rows of new bucket are added
+            if rollup.due(timestamp):
+                for job in self._rollup_jobs(run):
+                    yield job
+            rows = rollup.feed(rows, timestamp)
+
+        detector = self._change_detector
+        if detector:
+            rows = detector.filter(rows)
+
+        completed = False
+        try:
+            batch = self._new_batch()
+            for row in rows:
+                if self._router_column:
+                    row += (self._router_id,)
+                batch.append(row)
+                if len(batch) >= self._batch_size:
+                    yield self._job(run, batch)
+                    batch = self._new_batch()
 
-            # Run flow custom method
-            method_result = self.__run_method(self._name, client)
+            if batch:
+                yield self._job(run, batch)
 
-            self._last_run_timestamp = time()
-            self.LOGGER.debug("Method finished successfully")
+            if detector:
+                removed = detector.finish()
+                self.LOGGER.debug("{} changed rows, {} unchanged, {} removed", detector.passed, detector.suppressed,
+                                  len(removed))
+                if removed and self._delete_removed:
+                    yield self._job(run, [], self._deleted_keys(removed))
 
-            if method_result:
-                return {'name': self._name,
-                        'payload': method_result}
+            # Flush bucket when next run would fall into the next one
+            if rollup and rollup.due(timestamp, self._run_interval):
+                for job in self._rollup_jobs(run):
+                    yield job
+            completed = True
+        finally:
+            if detector and not completed:
+                detector.invalidate()
+
+        self.LOGGER.debug("Method finished successfully")
 
     # Custom flow methods. Called exactly as flow name
-    # Method must return tuple with all results in order defined in flow config
+    # Method must return iterable of tuples with all results in order defined in flow config, or None
 
     # @RouterOSApiClient
     def dhcp_server_leases(self, client):
         lease_resource = client.get_resource('/ip/dhcp-server/lease/')
-        lease_list = lease_resource.get()
-        self.LOGGER.debug("Retrieved {} leases".format(len(lease_list)))
-        result = []
-        for lease in lease_list:
+        lease_count = 0
+        for lease in stream(lease_resource, self._batch_size, self._queries, self._fields):
+            lease_count += 1
             comment = lease.get('comment') or ''
             try:
                 tmp = comment.split(';;')
@@ -79,69 +253,58 @@ class Flow:
                 name = comment
                 color = '#44dddd'
 
-            result.append(
-                (
-                    lease.get('mac-address'),
-                    lease.get('address'),
-                    lease.get('host-name') or 'unknown',
-                    name,
-                    color,
-                    1 if lease.get('status') == 'bound' else 0
-                )
+            yield (
+                lease.get('mac-address'),
+                lease.get('address'),
+                lease.get('host-name') or 'unknown',
+                name,
+                color,
+                1 if lease.get('status') == 'bound' else 0
             )
 
-        return result
+        self.LOGGER.debug("Retrieved {} leases", lease_count)
 
     # @RouterOSApiClient
     def lan_traffic_usage(self, client):
         self.LOGGER.debug("Retrieving lan trafic data")
         traffic_resource = client.get_resource('/ip/accounting/snapshot/')
         traffic_resource.call('take')
-        traffic_list = traffic_resource.get()
+        # Snapshot holds traffic since previous take, rows get actual elapsed time instead of configured interval
+        snapshot_at = monotonic()
+        previous_snapshot_at = self.lan_traffic_snapshot_at
+        self.lan_traffic_snapshot_at = snapshot_at
+
+        # If its a first run don't return anything, snapshot only starts the counting period
+        if self.lan_traffic_usage_first_run:
+            self.lan_traffic_usage_first_run = False
+            return None
 
-        self.LOGGER.debug("Got {} lan traffic rows".format(len(traffic_list)))
+        return self._lan_traffic_rows(traffic_resource, round(snapshot_at - previous_snapshot_at, 3))
 
-        res = []
+    def _lan_traffic_rows(self, traffic_resource, interval):
         # Determine traffic type
-        # Use lan range regex for checking which host is in LAN
-        # Ex '192\.168\.\d{1,3}\.\d{1,3}' for 192.168.0.0/16
-        lan_regex = re.compile('192\.168\.\d{1,3}\.\d{1,3}')
-        for traffic in traffic_list:
-            source_ip = str(traffic.get('src-address')).strip()
-            destination_ip = str(traffic.get('dst-address')).strip()
-            bandwidth_count = str(traffic.get('bytes')).strip()
-            packet_count = str(traffic.get('packets')).strip()
-
-            if lan_regex.match(source_ip) and lan_regex.match(destination_ip):
-                traffic_type = 'local'
-                local_ip = source_ip
-            elif lan_regex.match(source_ip) and not lan_regex.match(destination_ip):
-                traffic_type = 'upload'
-                local_ip = source_ip
-            elif not lan_regex.match(source_ip) and lan_regex.match(destination_ip):
-                traffic_type = 'download'
-                local_ip = destination_ip
-            else:
-                traffic_type = 'wan'
-                local_ip = ''
+        # LAN ranges come from flow 'lan_prefixes' config, ex ['192.168.0.0/16', '10.0.0.0/8']
+        traffic_list = stream(traffic_resource, self._batch_size, self._queries, self._fields)
+        rows = ((str(traffic.get('src-address')).strip(),
+                 str(traffic.get('dst-address')).strip(),
+                 int(traffic.get('bytes') or 0),
+                 int(traffic.get('packets') or 0)) for traffic in traffic_list)
 
-            res.append(
-                (
-                    self._run_interval,
-                    traffic_type,
-                    source_ip,
-                    destination_ip,
-                    local_ip,
-                    bandwidth_count,
-                    packet_count
-                )
+        row_count = 0
+        for source_ip, destination_ip, bandwidth_count, packet_count, traffic_type, local_ip in \
+                self.lan_traffic_classifier.classify_batch(rows):
+            row_count += 1
+            yield (
+                interval,
+                traffic_type,
+                source_ip,
+                destination_ip,
+                local_ip,
+                bandwidth_count,
+                packet_count
             )
-         
-        # If its a first run don't return anything
-        if self.lan_traffic_usage_first_run:
-            self.lan_traffic_usage_first_run = False
-        else:
-            return res
+
+        self.LOGGER.debug("Got {} lan traffic rows", row_count)
 
     # @RouterOSApiClient
     def interface_usage(self, client):
@@ -149,10 +312,12 @@ class Flow:
         resource = client.get_resource('/interface')
 
         interface_list = ",".join(self.interface_usage_list)
-        interface_traffic_results = resource.call('monitor-traffic',
-                                                  arguments={'interface': interface_list, 'once': ''})
+        arguments = {'interface': interface_list, 'once': ''}
+        if self._fields:
+            arguments['.proplist'] = ",".join(self._fields)
+        interface_traffic_results = resource.call('monitor-traffic', arguments=arguments)
 
-        self.LOGGER.debug("Interface traffic data results >> {}".format(interface_traffic_results))
+        self.LOGGER.debug("Interface traffic data results >> {}", interface_traffic_results)
         res = []
         for interface_traffic in interface_traffic_results:
             res.append(
@@ -0,0 +1,202 @@
+from lib.clock import monotonic
+from threading import Condition, Lock
+from collections import deque
+import itertools
+import Queue
+import sys
+
+# Priority classes, lower index is served first
+PRIORITY_CLASSES = ('high', 'normal', 'bulk')
+DEFAULT_PRIORITY = 'normal'
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_SPILL = 'spill'
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_SPILL)
+
+
+class UnknownFlowError(Exception):
+    pass
+
+
+def estimate_job_size(job, sample=10):
+    # Approximate memory held by job payload, extrapolated from first few rows
+    payload = job['payload']
+    size = sys.getsizeof(payload)
+    if hasattr(payload, 'nbytes'):
+        # Columnar batch knows its size
+        return size + payload.nbytes()
+    rows = len(payload)
+    if not rows:
+        return size
+
+    sampled = payload[:sample]
+    sampled_size = 0
+    for row in sampled:
+        sampled_size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size + sampled_size * rows // len(sampled)
+
+
+class JobQueue:
+    """
+    Bounded queue between scrapers and Database thread
+    Tracks job count and approximate memory per flow. Jobs are served by flow priority class,
+    FIFO within a class. When full, producers either block, drop oldest lower priority jobs
+    or spill whole queue to on-disk spool.
+    Jobs for flows without compiled statement are rejected on put, in producer thread.
+    Dropped jobs are passed to on_drop, so flows can resync change detection.
+    """
+
+    def __init__(self, logger, flow_priorities, max_jobs=0, max_bytes=0, policy=POLICY_BLOCK, spool=None,
+                 on_drop=None):
+        self.LOGGER = logger
+
+        if policy not in POLICIES:
+            raise Exception('Unknown backpressure policy [{}]'.format(policy))
+        if policy == POLICY_SPILL and not spool:
+            raise Exception('Backpressure policy [{}] requires spool'.format(policy))
+
+        self._flow_classes = {}
+        for name, priority in flow_priorities.items():
+            if priority not in PRIORITY_CLASSES:
+                raise Exception('Unknown priority [{}] for flow [{}]'.format(priority, name))
+            self._flow_classes[name] = PRIORITY_CLASSES.index(priority)
+
+        self._max_jobs = int(max_jobs or 0)
+        self._max_bytes = int(max_bytes or 0)
+        self._policy = policy
+        self._spool = spool
+        self._on_drop = on_drop
+
+        self._queues = [deque() for x in PRIORITY_CLASSES]
+        self._counter = itertools.count()
+        self._jobs = 0
+        self._bytes = 0
+        self._flow_bytes = dict((name, 0) for name in self._flow_classes)
+        self.dropped = 0
+        self.spilled = 0
+
+        self._mutex = Lock()
+        self._not_empty = Condition(self._mutex)
+        self._not_full = Condition(self._mutex)
+
+    def qsize(self):
+        with self._mutex:
+            return self._jobs
+
+    def empty(self):
+        return not self.qsize()
+
+    def bytes(self):
+        with self._mutex:
+            return self._bytes
+
+    def flow_bytes(self):
+        with self._mutex:
+            return dict(self._flow_bytes)
+
+    def _is_full(self, size):
+        if self._max_jobs and self._jobs >= self._max_jobs:
+            return True
+        # Single job bigger than whole limit is still let through into empty queue
+        return bool(self._max_bytes and self._jobs and self._bytes + size > self._max_bytes)
+
+    def _append(self, priority_class, size, item):
+        self._queues[priority_class].append((next(self._counter), size, item))
+        self._jobs += 1
+        self._bytes += size
+        self._flow_bytes[item['name']] += size
+
+    def _popleft(self, priority_class):
+        seq, size, item = self._queues[priority_class].popleft()
+        self._jobs -= 1
+        self._bytes -= size
+        self._flow_bytes[item['name']] -= size
+        return item
+
+    def _drop_oldest(self, priority_class, size):
+        # Only jobs of the same or lower priority are dropped, lowest priority first
+        for drop_class in range(len(PRIORITY_CLASSES) - 1, priority_class - 1, -1):
+            while self._queues[drop_class] and self._is_full(size):
+                item = self._popleft(drop_class)
+                self.dropped += 1
+                self.LOGGER.warning("Queue full, dropped oldest job of flow [{}]".format(item['name']))
+                if self._on_drop:
+                    self._on_drop(item)
+            if not self._is_full(size):
+                break
+
+    def _spill(self, item):
+        # Whole queue goes to spool in arrival order followed by new job, so per flow order is kept
+        queued = sorted(entry for queue in self._queues for entry in queue)
+        for seq, size, queued_item in queued:
+            self._spool.append(queued_item)
+        self._spool.append(item)
+
+        for queue in self._queues:
+            queue.clear()
+        self._jobs = 0
+        self._bytes = 0
+        for name in self._flow_bytes:
+            self._flow_bytes[name] = 0
+        self.spilled += len(queued) + 1
+        self.LOGGER.warning("Queue full, spilled {} jobs to spool".format(len(queued) + 1))
+        self._not_full.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        priority_class = self._flow_classes.get(item['name'])
+        if priority_class is None:
+            raise UnknownFlowError('No statement configured for flow [{}]'.format(item['name']))
+        size = estimate_job_size(item)
+
+        with self._not_full:
+            if self._is_full(size):
+                if self._policy == POLICY_DROP_OLDEST:
+                    self._drop_oldest(priority_class, size)
+                elif self._policy == POLICY_SPILL:
+                    self._spill(item)
+                    return
+
+            # Block policy, or nothing left to drop
+            if self._is_full(size):
+                if not block:
+                    raise Queue.Full
+                if timeout is None:
+                    while self._is_full(size):
+                        self._not_full.wait()
+                else:
+                    end = monotonic() + timeout
+                    while self._is_full(size):
+                        remaining = end - monotonic()
+                        if remaining <= 0:
+                            raise Queue.Full
+                        self._not_full.wait(remaining)
+
+            self._append(priority_class, size, item)
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._not_empty:
+            if not block:
+                if not self._jobs:
+                    raise Queue.Empty
+            elif timeout is None:
+                while not self._jobs:
+                    self._not_empty.wait()
+            else:
+                end = monotonic() + timeout
+                while not self._jobs:
+                    remaining = end - monotonic()
+                    if remaining <= 0:
+                        raise Queue.Empty
+                    self._not_empty.wait(remaining)
+
+            for priority_class, queue in enumerate(self._queues):
+                if queue:
+                    item = self._popleft(priority_class)
+                    break
+            self._not_full.notify()
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
@@ -1,16 +1,152 @@
 import logging
+from collections import OrderedDict
+from threading import Lock
 from etc import config
 from lib.logrotate.cloghandler import ConcurrentRotatingFileHandler
+from lib.asynclog import AsyncLogHandler
+from lib.clock import monotonic
 import sys
 
+
+def preview(value, max_items, max_chars):
+    # Sequence longer than max_items is shown by its first items and count, long text is cut at max_chars
+    if isinstance(value, (int, long, float)):
+        # Left as is for format specs like {:.3f}
+        return value
+    if max_items and (isinstance(value, (list, tuple)) or hasattr(value, 'rows')):
+        try:
+            length = len(value)
+        except TypeError:
+            length = 0
+        if length > max_items:
+            value = '{} ... ({} items total)'.format(list(value[:max_items]), length)
+        elif hasattr(value, 'rows'):
+            value = value.rows()
+    text = value if isinstance(value, basestring) else str(value)
+    if max_chars and len(text) > max_chars:
+        text = '{} ... ({} chars total)'.format(text[:max_chars], len(text))
+    return text
+
+
+class LazyMessage:
+    """
+    Log message formatted only when a handler renders the record
+    """
+
+    def __init__(self, template, args, max_items, max_chars, repeated=None):
+        self.template = template
+        self.args = args
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self.repeated = repeated
+
+    def __str__(self):
+        message = self.template
+        if self.args:
+            message = message.format(*[preview(arg, self.max_items, self.max_chars) for arg in self.args])
+        if self.repeated:
+            message = '{} [{} similar messages suppressed in last {:.0f} sec]'.format(message, *self.repeated)
+        return message
+
+
+class LazyLogger:
+    """
+    Logger facade with deferred formatting, LOGGER.debug("Got {} rows\n{}", count, rows)
+    Nothing is formatted when level is disabled, arguments are cut to config.log max_arg_items/max_arg_chars
+    when record is written. Same warning or error from the same call site is written once per
+    config.log repeat_interval seconds, next written one reports how many were suppressed.
+    Messages already formatted by caller (no arguments) work as before.
+    """
+
+    # Messages tracked for repeats, least recently logged ones are forgotten first
+    MAX_REPEAT_SITES = 1000
+
+    def __init__(self, logger, max_items=20, max_chars=2000, repeat_interval=60):
+        self.logger = logger
+        self._max_items = int(max_items)
+        self._max_chars = int(max_chars)
+        self._repeat_interval = float(repeat_interval)
+        # (file, line, template, args) -> [last written at, suppressed since]
+        self._repeats = OrderedDict()
+        self._repeats_lock = Lock()
+
+    def __getattr__(self, name):
+        # handlers, setLevel... of wrapped logger
+        return getattr(self.logger, name)
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def _repeated(self, site):
+        if not self._repeat_interval:
+            return None, True
+        now = monotonic()
+        with self._repeats_lock:
+            state = self._repeats.pop(site, None)
+            if state is None or now - state[0] >= self._repeat_interval:
+                self._repeats[site] = [now, 0]
+                while len(self._repeats) > self.MAX_REPEAT_SITES:
+                    self._repeats.popitem(last=False)
+                if state and state[1]:
+                    return (state[1], now - state[0]), True
+                return None, True
+            state[1] += 1
+            self._repeats[site] = state
+            return None, False
+
+    def _log(self, level, template, args, exc_info=None, rate_limited=False):
+        if not self.logger.isEnabledFor(level):
+            return
+        # Frame of code calling debug(), info()..., record points there instead of this module
+        frame = sys._getframe(2)
+        code = frame.f_code
+        repeated = None
+        if rate_limited:
+            # Arguments are cut as in written record, so a large payload doesn't make a large key
+            repeated, write = self._repeated((code.co_filename, frame.f_lineno, template,
+                                              tuple(preview(arg, self._max_items, self._max_chars) for arg in args)))
+            if not write:
+                return
+        if args or repeated:
+            template = LazyMessage(template, args, self._max_items, self._max_chars, repeated)
+        if exc_info and not isinstance(exc_info, tuple):
+            exc_info = sys.exc_info()
+        self.logger.handle(self.logger.makeRecord(self.logger.name, level, code.co_filename, frame.f_lineno,
+                                                  template, (), exc_info, code.co_name))
+
+    def debug(self, template, *args):
+        self._log(logging.DEBUG, template, args)
+
+    def info(self, template, *args):
+        self._log(logging.INFO, template, args)
+
+    def warning(self, template, *args):
+        self._log(logging.WARNING, template, args, rate_limited=True)
+
+    def error(self, template, *args):
+        self._log(logging.ERROR, template, args, rate_limited=True)
+
+    def exception(self, template, *args):
+        self._log(logging.ERROR, template, args, exc_info=True, rate_limited=True)
+
+
 def get_logger(class_name):
     logger = logging.getLogger(class_name)
-    formatter = logging.Formatter(config.log['formatter_main'])
-    if config.log['location']:
-        handler = ConcurrentRotatingFileHandler(config.log['location']+"/"+class_name, "a", config.log['size'], config.log['backups'])
-    else:
-        handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.getLevelName(config.log['level']))
-    return logger
+    # Restarted component gets the same logger again, handler is added only once
+    if not logger.handlers:
+        formatter = logging.Formatter(config.log['formatter_main'])
+        if config.log['location'] and config.log.get('async'):
+            # Records are buffered and written by background thread, see lib/asynclog.py
+            handler = AsyncLogHandler(config.log['location']+"/"+class_name, config.log['size'], config.log['backups'],
+                                      config.log.get('compress', True), config.log.get('buffer_records', 10000))
+        elif config.log['location']:
+            handler = ConcurrentRotatingFileHandler(config.log['location']+"/"+class_name, "a", config.log['size'], config.log['backups'])
+        else:
+            handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        logger.setLevel(logging.getLevelName(config.log['level']))
+    return LazyLogger(logger,
+                      config.log.get('max_arg_items', 20),
+                      config.log.get('max_arg_chars', 2000),
+                      config.log.get('repeat_interval', 60))
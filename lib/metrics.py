@@ -0,0 +1,285 @@
+from threading import Thread, Lock
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+import bisect
+from lib.supervisor import Health
+
+# Seconds, from fast MySQL statements to slow router replies
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Rows or jobs
+SIZE_BUCKETS = (1, 10, 100, 1000, 5000, 10000, 50000, 100000, 500000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append('{}="{}"'.format(*extra))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Metric:
+    """
+    Metric family, one child per label values: QUEUE_JOBS.labels('lan_traffic_usage').inc()
+    """
+    type = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self):
+        # (suffix, label values, extra label, value)
+        raise NotImplementedError
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, values, extra, value in self._samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.label_names, values, extra),
+                                            _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _samples(self):
+        for values, child in sorted(self._children.items()):
+            yield '', values, None, child.value
+
+
+class Gauge(Metric):
+    """
+    Gauge set by owner, or read from callback (returning {label values: value}) when scraped
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help_text, label_names=(), callback=None):
+        Metric.__init__(self, name, help_text, label_names)
+        self._callback = callback
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_callback(self, callback):
+        self._callback = callback
+
+    def _samples(self):
+        if self._callback:
+            for values, value in sorted(self._callback().items()):
+                yield '', values, None, value
+            return
+        for values, child in sorted(self._children.items()):
+            yield '', values, None, child.value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help_text, label_names)
+        self._buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self._buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        for values, child in sorted(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float('inf'),), counts):
+                cumulative += count
+                yield '_bucket', values, ('le', _format_value(float(bound))), cumulative
+            yield '_sum', values, None, total
+            yield '_count', values, None, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, label_names=()):
+    return REGISTRY.register(Counter(name, help_text, label_names))
+
+
+def gauge(name, help_text, label_names=(), callback=None):
+    return REGISTRY.register(Gauge(name, help_text, label_names, callback))
+
+
+def histogram(name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, label_names, buckets))
+
+
+# Instruments, process wide. In process mode every process has its own values
+
+FLOW_RUN_SECONDS = histogram('flow_run_seconds', 'Flow run duration, router calls and transform',
+                             ('flow', 'router'))
+ROUTEROS_CALL_SECONDS = histogram('routeros_call_seconds', 'RouterOS API call latency, whole reply for streams',
+                                  ('flow', 'router'))
+FLOW_TRANSFORM_SECONDS = histogram('flow_transform_seconds', 'Flow run time spent outside RouterOS calls '
+                                   'and queue handover (parsing, classification, batching)', ('flow', 'router'))
+FLOW_ROWS = histogram('flow_rows_per_run', 'Rows emitted per flow run', ('flow', 'router'), SIZE_BUCKETS)
+FLOW_FAILURES = counter('flow_failures_total', 'Failed flow runs', ('flow', 'router'))
+ROUTEROS_CONNECTS = counter('routeros_connects_total', 'RouterOS connection attempts', ('router', 'result'))
+
+QUEUE_JOBS = gauge('queue_jobs', 'Jobs waiting in database input queue')
+QUEUE_BYTES = gauge('queue_bytes', 'Estimated payload bytes in database input queue')
+SPOOL_BYTES = gauge('spool_bytes', 'Bytes in on-disk spool')
+
+BATCH_JOBS = histogram('db_batch_jobs', 'Jobs per database batch', (), SIZE_BUCKETS)
+BATCH_ROWS = histogram('db_batch_rows', 'Rows per database batch', (), SIZE_BUCKETS)
+MYSQL_EXECUTE_SECONDS = histogram('mysql_execute_seconds', 'Statement execution time per flow and operation',
+                                  ('flow', 'operation'))
+MYSQL_COMMIT_SECONDS = histogram('mysql_commit_seconds', 'Batch commit time')
+MYSQL_ROWS = counter('mysql_rows_total', 'Rows written per flow', ('flow',))
+MYSQL_CONNECTS = counter('mysql_connects_total', 'MySQL connection attempts', ('result',))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    # Client that connects and sends nothing would otherwise hold the only serving thread forever
+    timeout = 5
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not logged
+        pass
+
+
+class _MetricsHTTPServer(HTTPServer):
+    # Restarted server binds again while old connections of previous one are in TIME_WAIT
+    allow_reuse_address = True
+
+
+class MetricsServer(Thread):
+    """
+    Serves metrics of this process in Prometheus text format on http://host:port/metrics
+    Requests are handled one at a time on this thread, rendering is cheap and scrapes are rare.
+    """
+
+    def __init__(self, logger, host='127.0.0.1', port=9108):
+        Thread.__init__(self)
+        self.daemon = True
+        self.LOGGER = logger
+        self._address = (host, int(port))
+        self._server = None
+
+        self.running = False
+        self.wantRunning = True
+        self.health = Health()
+
+    def run(self):
+        self.running = True
+        try:
+            self._server = _MetricsHTTPServer(self._address, _MetricsHandler)
+        except Exception, e:
+            self.LOGGER.error("Could not serve metrics on {}:{}\n***{}".format(self._address[0], self._address[1], e))
+            self.health.failed(e)
+            self.running = False
+            return
+
+        self.LOGGER.info("Serving metrics on {}:{}".format(*self._address))
+        # Wake up at least once a second to check for shutdown
+        self._server.timeout = 1
+        while self.wantRunning:
+            self.health.beat()
+            try:
+                self._server.handle_request()
+            except Exception, e:
+                self.LOGGER.error("Error serving metrics\n***{}", e)
+        self._server.server_close()
+        self.running = False
+        self.health.stopped()
@@ -0,0 +1,9 @@
+import MySQLdb
+
+# Client error codes of a connection that is gone: CR_CONN_HOST_ERROR, CR_SERVER_GONE_ERROR, CR_SERVER_LOST
+# Other OperationalErrors (unknown column, lock wait timeout, deadlock...) come from the statement itself
+CONNECTION_ERRORS = (2003, 2006, 2013)
+
+
+def is_connection_error(error):
+    return isinstance(error, MySQLdb.OperationalError) and bool(error.args) and error.args[0] in CONNECTION_ERRORS
@@ -0,0 +1,64 @@
+import multiprocessing
+import signal
+from lib.logger import get_logger
+from lib.supervisor import Health, Supervisor
+
+
+class ComponentProcess(multiprocessing.Process):
+    """
+    Runs components (scraper or writer) in a child process under their own supervisor
+    Threads are built by create_components(logger) after fork, so connections and locks belong to the child.
+    Child logs to Main-<name> instead of Main, async log files can't be shared between processes.
+    Has the running/wantRunning/join/health interface of component threads so main supervises both the same way,
+    child heartbeat goes to main while its supervisor keeps own threads healthy.
+    """
+
+    def __init__(self, logger, name, create_components, join_timeout=10):
+        multiprocessing.Process.__init__(self, name=name)
+        self.LOGGER = logger
+        self.component = name
+        self.daemon = True
+        self._create_components = create_components
+        self._join_timeout = join_timeout
+        self._stop = multiprocessing.Event()
+        self._drain_timeout = multiprocessing.Value('d', 0)
+        self.health = Health()
+
+    @property
+    def running(self):
+        return self.is_alive()
+
+    @property
+    def wantRunning(self):
+        return not self._stop.is_set()
+
+    @wantRunning.setter
+    def wantRunning(self, value):
+        if not value:
+            self._stop.set()
+
+    def drain(self, timeout):
+        # Child shuts its components down in stages, writer gets timeout to flush
+        self._drain_timeout.value = timeout
+        self._stop.set()
+
+    def run(self):
+        # Shutdown is driven by main through stop event, terminal/service signals go to main only
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        self.LOGGER = get_logger('Main-{}'.format(self.component))
+        supervisor = Supervisor(self.LOGGER)
+        for component in self._create_components(self.LOGGER):
+            supervisor.add(component)
+        supervisor.start()
+
+        # Child exits when main wants out or one of its components can't be restarted any more
+        while not self._stop.is_set():
+            self.health.beat()
+            if not supervisor.poll(1):
+                self.health.failed('component of {} gave up'.format(self.component))
+                break
+
+        supervisor.shutdown(self._join_timeout, self._drain_timeout.value)
+        self.health.stopped()
@@ -0,0 +1,105 @@
+import heapq
+import time
+
+
+def rollup_flow(flow):
+    """
+    Output flow config for flow 'rollup' config, used to compile statement and queue priority
+    ex 'rollup': {'name': 'lan_traffic_rollup', 'mysql_table': 'lan_traffic_rollup', 'bucket': 60,
+                  'group_by': ['local_ip', 'traffic_type'], 'sum': ['bytes', 'packets']}
+    """
+    rollup = flow['rollup']
+    params = [rollup.get('bucket_column', 'bucket')] + list(rollup['group_by']) + list(rollup['sum'])
+    return {'name': rollup.get('name', '{}_rollup'.format(flow['name'])),
+            'params': params,
+            'mysql_type': 'INSERT_ON_FAIL_UPDATE',
+            'mysql_table': rollup['mysql_table'],
+            'router_column': flow.get('router_column'),
+            # Bucket flushed twice (ex after restart) adds up instead of overwriting
+            'accumulate': list(rollup['sum']),
+            'priority': rollup.get('priority', flow.get('priority', 'normal'))}
+
+
+def rollup_flows(flows):
+    return [rollup_flow(flow) for flow in flows if flow.get('rollup')]
+
+
+class Rollup:
+    """
+    Aggregates flow rows into time buckets
+    Rows are grouped by group_by params and sum params are added up, one accumulator list per group.
+    Raw rows are passed through for all rows, none, or only for the top_k groups with most traffic.
+    """
+
+    def __init__(self, flow):
+        rollup = flow['rollup']
+        params = list(flow['params'])
+        self.name = rollup_flow(flow)['name']
+        self._bucket = int(rollup.get('bucket', 60))
+        self._group_indexes = [params.index(param) for param in rollup['group_by']]
+        self._sum_indexes = [params.index(param) for param in rollup['sum']]
+        self._keep_raw = bool(rollup.get('keep_raw', False))
+        self._top_k = int(rollup.get('top_k', 0))
+        # Talkers are ranked by first sum column unless rank_by is set
+        self._rank_index = params.index(rollup.get('rank_by', rollup['sum'][0]))
+
+        self._bucket_start = None
+        self._accumulators = {}
+
+    def bucket_start(self, timestamp):
+        return int(timestamp) // self._bucket * self._bucket
+
+    def _key(self, row):
+        return tuple([row[index] for index in self._group_indexes])
+
+    def feed(self, rows, timestamp):
+        """
+        Generator, adds rows to bucket of timestamp and yields raw rows that should still be written
+        Rollup rows of previous bucket have to be taken with flush() before feeding rows of a new bucket
+        """
+        bucket_start = self.bucket_start(timestamp)
+        if self._bucket_start is None:
+            self._bucket_start = bucket_start
+
+        accumulators = self._accumulators
+        sum_indexes = self._sum_indexes
+        width = len(sum_indexes)
+        top_k = self._top_k and not self._keep_raw
+        talkers = {}
+
+        for row in rows:
+            key = self._key(row)
+            accumulator = accumulators.get(key)
+            if accumulator is None:
+                accumulator = accumulators[key] = [0] * width
+            for position in range(width):
+                accumulator[position] += int(row[sum_indexes[position]])
+
+            if self._keep_raw:
+                yield row
+            elif top_k:
+                talker = talkers.get(key)
+                if talker is None:
+                    talker = talkers[key] = [0, []]
+                talker[0] += int(row[self._rank_index])
+                talker[1].append(row)
+
+        if top_k:
+            for total, talker_rows in heapq.nlargest(self._top_k, talkers.itervalues(), key=lambda talker: talker[0]):
+                for row in talker_rows:
+                    yield row
+
+    def due(self, timestamp, lookahead=0):
+        # Bucket is closed if timestamp (or next run at timestamp + lookahead) falls into a later bucket
+        return self._bucket_start is not None and \
+            self.bucket_start(timestamp + lookahead) > self._bucket_start
+
+    def flush(self):
+        # Rows of open bucket: (bucket, group_by..., sum...), accumulators are reset
+        if self._bucket_start is None:
+            return []
+        bucket = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self._bucket_start))
+        rows = [(bucket,) + key + tuple(accumulator) for key, accumulator in self._accumulators.iteritems()]
+        self._bucket_start = None
+        self._accumulators = {}
+        return rows
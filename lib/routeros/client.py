@@ -0,0 +1,142 @@
+from lib.routeros.protocol import build_command
+from lib.clock import monotonic
+
+
+class EngineResource:
+    """
+    Same interface as routeros_api resource so flow methods work with either client
+    """
+
+    def __init__(self, connection, path):
+        self._connection = connection
+        self._path = '/' + path.strip('/')
+
+    def _command(self, command):
+        return '{}/{}'.format(self._path, command)
+
+    def get(self, **kwargs):
+        queries = ['?{}={}'.format(key, value) for key, value in kwargs.items()]
+        return self._connection.call(self._command('print'), queries=queries)
+
+    def call(self, command, arguments=None, queries=None):
+        return self._connection.call(self._command(command), attributes=arguments, queries=queries)
+
+    def stream(self, command='print', arguments=None, queries=None, proplist=None, max_buffered=1000):
+        return self._connection.stream(self._command(command), arguments, queries, proplist, max_buffered)
+
+    def request(self, command, arguments=None, queries=None, proplist=None):
+        # Non-blocking variant, returns ApiRequest so caller can have many requests in flight
+        return self._connection.request(build_command(self._command(command), arguments, queries, proplist))
+
+
+class EngineApi:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def get_resource(self, path):
+        return EngineResource(self._connection, path)
+
+
+class TimedApi:
+    """
+    Wraps API client of either kind, time spent in router calls is summed in elapsed
+    and every call duration (whole reply for streams) is passed to observe
+    """
+
+    def __init__(self, api, observe=None):
+        self._api = api
+        self._observe = observe
+        self.elapsed = 0.0
+
+    def get_resource(self, path):
+        return TimedResource(self, self._api.get_resource(path))
+
+    def add(self, seconds):
+        self.elapsed += seconds
+        if self._observe:
+            self._observe(seconds)
+
+
+class TimedResource:
+    def __init__(self, api, resource):
+        self._api = api
+        self.resource = resource
+
+    def __getattr__(self, name):
+        return getattr(self.resource, name)
+
+    def _timed(self, method, *args, **kwargs):
+        time_start = monotonic()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._api.add(monotonic() - time_start)
+
+    def get(self, *args, **kwargs):
+        return self._timed(self.resource.get, *args, **kwargs)
+
+    def call(self, *args, **kwargs):
+        return self._timed(self.resource.call, *args, **kwargs)
+
+    def timed_iter(self, open_replies):
+        # Request and waiting for next reply count, time caller spends on the row does not
+        elapsed = 0.0
+        replies = None
+        try:
+            while True:
+                time_start = monotonic()
+                try:
+                    if replies is None:
+                        replies = iter(open_replies())
+                    reply = next(replies)
+                finally:
+                    elapsed += monotonic() - time_start
+                yield reply
+        except StopIteration:
+            pass
+        finally:
+            self._api.add(elapsed)
+
+
+def build_queries(query):
+    """
+    Flow config query to API query words
+    Dict {'status': 'bound'} becomes ['?status=bound'], list of raw words ['?dynamic=yes', '?#|'] is used as is
+    """
+    if not query:
+        return []
+    if isinstance(query, dict):
+        return ['?{}={}'.format(key, value) for key, value in sorted(query.items())]
+    return list(query)
+
+
+class _QueryWords(object):
+    """
+    Raw query words for routeros_api
+    routeros_api prefixes plain query strings with '?' and keeps queries in a set, words of one object
+    are sent as they are and in order, which operator words like '?#|' depend on
+    """
+
+    def __init__(self, words):
+        self._words = [word.encode('utf-8') if isinstance(word, unicode) else word for word in words]
+
+    def get_api_format(self):
+        return list(self._words)
+
+
+def stream(resource, max_buffered=1000, queries=None, proplist=None):
+    """
+    Iterate over resource print replies
+    Only proplist fields are returned and rows are filtered on the router by query words.
+    Engine resources stream replies as they arrive, routeros_api resources can only return whole list
+    """
+    if isinstance(resource, TimedResource):
+        return resource.timed_iter(lambda: stream(resource.resource, max_buffered, queries, proplist))
+
+    if isinstance(resource, EngineResource):
+        return resource.stream(queries=queries, proplist=proplist, max_buffered=max_buffered)
+
+    if not queries and not proplist:
+        return iter(resource.get())
+    arguments = {'.proplist': ','.join(proplist)} if proplist else {}
+    return iter(resource.call('print', arguments, {}, (_QueryWords(queries),) if queries else ()))
@@ -0,0 +1,489 @@
+from lib.routeros.protocol import SentenceParser, encode_sentence, build_command, parse_sentence, login_response
+from lib.clock import monotonic
+from threading import Thread, Event, Lock, Condition
+from collections import deque
+import errno
+import itertools
+import os
+import select
+import socket
+
+_STATE_CONNECTING = 'connecting'
+_STATE_LOGIN = 'login'
+_STATE_READY = 'ready'
+_STATE_CLOSED = 'closed'
+
+_READ_SIZE = 64 * 1024
+_POLL_IN = select.POLLIN | select.POLLPRI
+_POLL_ERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+
+class ApiError(Exception):
+    pass
+
+
+class ApiTimeout(ApiError):
+    pass
+
+
+class ConnectionClosed(ApiError):
+    pass
+
+
+class ApiRequest:
+    """
+    Pending tagged request, completed from engine thread
+    """
+
+    def __init__(self, connection, words):
+        self.connection = connection
+        self.words = words
+        self.tag = None
+        self.replies = []
+        self.error = None
+        self._done = Event()
+
+    def _on_reply(self, attributes):
+        self.replies.append(attributes)
+
+    def _on_trap(self, attributes):
+        self.error = ApiError(attributes.get('message', 'Request failed'))
+
+    def _finish(self, error=None):
+        if error and not self.error:
+            self.error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            self.connection.cancel(self)
+            raise ApiTimeout('Request {} timed out after {} sec'.format(self.words[0], timeout))
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        if self.error:
+            raise self.error
+        return self.replies
+
+
+class StreamingRequest(ApiRequest):
+    """
+    Request whose replies are consumed one by one while they arrive
+    Buffer is bounded, when it fills up engine stops reading the socket so router is held back by TCP
+    """
+
+    def __init__(self, connection, words, max_buffered):
+        ApiRequest.__init__(self, connection, words)
+        self.replies = deque()
+        self._max_buffered = max_buffered
+        self._abandoned = False
+        self._available = Condition(Lock())
+
+    def full(self):
+        return len(self.replies) >= self._max_buffered
+
+    def _on_reply(self, attributes):
+        with self._available:
+            if not self._abandoned:
+                self.replies.append(attributes)
+            self._available.notify()
+
+    def _abandon(self):
+        # Drop buffered replies so paused connection can be read again until cancel completes
+        with self._available:
+            self._abandoned = True
+            self.replies.clear()
+        self.connection.resume()
+
+    def _finish(self, error=None):
+        with self._available:
+            ApiRequest._finish(self, error)
+            self._available.notify()
+
+    def result(self, timeout=None):
+        return list(self.iter(timeout))
+
+    def iter(self, timeout=None):
+        # timeout applies to wait for each reply, not to whole request
+        try:
+            while True:
+                with self._available:
+                    if not self.replies and not self.done():
+                        self._available.wait(timeout)
+                        if not self.replies and not self.done():
+                            raise ApiTimeout('Request {} timed out after {} sec'.format(self.words[0], timeout))
+                    if not self.replies:
+                        break
+                    was_full = self.full()
+                    reply = self.replies.popleft()
+
+                if was_full:
+                    self.connection.resume()
+                yield reply
+
+            if self.error:
+                raise self.error
+        finally:
+            if not self.done():
+                # Consumer gave up early
+                self._abandon()
+                self.connection.cancel(self)
+
+
+class ApiConnection:
+    """
+    Non-blocking RouterOS API connection driven by ApiEngine
+    Any number of requests can be in flight at once, replies are matched by .tag
+    """
+
+    def __init__(self, engine, router_id, host, port, username, password, request_timeout):
+        self.router_id = router_id
+        self.host = host
+        self.port = port
+        self.request_timeout = request_timeout
+        self._engine = engine
+        self._username = username
+        self._password = password
+
+        self._socket = None
+        self._state = _STATE_CONNECTING
+        self._parser = SentenceParser()
+        self._out = bytearray()
+        self._tags = itertools.count(1)
+        self._requests = {}
+        self._ready = Event()
+        self._error = None
+
+    @property
+    def fileno(self):
+        return self._socket.fileno()
+
+    @property
+    def connected(self):
+        return self._state != _STATE_CLOSED
+
+    def get_api(self):
+        from lib.routeros.client import EngineApi
+        return EngineApi(self)
+
+    def disconnect(self):
+        self._engine.close_connection(self)
+
+    def _open(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setblocking(0)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        result = self._socket.connect_ex((self.host, self.port))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(result, os.strerror(result))
+
+    def wait_ready(self, timeout):
+        if not self._ready.wait(timeout):
+            self._engine.close_connection(self, ApiTimeout('Login timed out'))
+            raise ApiTimeout('Connecting to {}:{} timed out'.format(self.host, self.port))
+        if self._state != _STATE_READY:
+            raise self._error or ConnectionClosed('Connection to {}:{} closed'.format(self.host, self.port))
+
+    # Called from any thread
+    def request(self, words):
+        request = ApiRequest(self, words)
+        self._engine.submit(self, request)
+        return request
+
+    def call(self, command, attributes=None, queries=None, proplist=None, timeout=None):
+        request = self.request(build_command(command, attributes, queries, proplist))
+        return request.result(timeout or self.request_timeout)
+
+    def stream(self, command, attributes=None, queries=None, proplist=None, max_buffered=1000, timeout=None):
+        # Yields reply attributes as they arrive, memory is bounded by max_buffered replies
+        request = StreamingRequest(self, build_command(command, attributes, queries, proplist), max_buffered)
+        self._engine.submit(self, request)
+        return request.iter(timeout or self.request_timeout)
+
+    def resume(self):
+        # Streaming consumer made room, let engine read socket again
+        self._engine.mark_dirty(self)
+
+    def paused(self):
+        for request in self._requests.values():
+            if isinstance(request, StreamingRequest) and request.full():
+                return True
+        return False
+
+    def cancel(self, request):
+        if request.tag is not None and self.connected:
+            self.request(['/cancel', '=tag={}'.format(request.tag)])
+
+    # Called from engine thread, with engine lock held
+    def _enqueue(self, request):
+        if self._state == _STATE_CLOSED:
+            request._finish(self._error or ConnectionClosed('Connection closed'))
+            return
+        request.tag = str(next(self._tags))
+        self._requests[request.tag] = request
+        self._out.extend(encode_sentence(request.words + ['.tag={}'.format(request.tag)]))
+
+    def _start_login(self):
+        self._state = _STATE_LOGIN
+        # Plain login (RouterOS 6.43+), falls back to challenge-response if router replies with =ret=
+        request = ApiRequest(self, ['/login', '=name={}'.format(self._username),
+                                    '=password={}'.format(self._password)])
+        request._finish = lambda error=None: self._on_login(request, error)
+        self._enqueue(request)
+
+    def _on_login(self, request, error):
+        if error or request.error:
+            # Socket is closed here, engine forgets the connection once it sees it closed
+            self._close(request.error or error)
+            return
+
+        challenge = request.replies[0].get('ret') if request.replies else None
+        if challenge and not getattr(request, 'challenged', False):
+            response = ApiRequest(self, ['/login', '=name={}'.format(self._username),
+                                         '=response={}'.format(login_response(self._password, challenge))])
+            response.challenged = True
+            response._finish = lambda error=None: self._on_login(response, error)
+            self._enqueue(response)
+            return
+
+        self._state = _STATE_READY
+        self._ready.set()
+
+    def _fail(self, error):
+        self._error = error
+        self._state = _STATE_CLOSED
+        self._ready.set()
+
+    def _on_sentence(self, words):
+        reply, tag, attributes = parse_sentence(words)
+        if reply == '!fatal':
+            raise ConnectionClosed('Router closed connection: {}'.format(' '.join(words[1:])))
+
+        request = self._requests.get(tag)
+        if request is None:
+            # Reply to cancelled or unknown request
+            return
+
+        if reply == '!re':
+            request._on_reply(attributes)
+        elif reply == '!trap':
+            request._on_trap(attributes)
+        elif reply == '!done':
+            if attributes:
+                # Login challenge and some commands return data in !done
+                request._on_reply(attributes)
+            del self._requests[tag]
+            request._finish()
+
+    def _close(self, error):
+        if self._state == _STATE_CLOSED and not self._requests:
+            return
+        self._fail(error)
+        requests, self._requests = self._requests, {}
+        for request in requests.values():
+            request._finish(error)
+        try:
+            self._socket.close()
+        except Exception:
+            pass
+
+
+class ApiEngine(Thread):
+    """
+    Single event loop thread multiplexing all RouterOS API connections
+    Other threads submit requests and wait on them, socket IO only ever happens here.
+    """
+
+    def __init__(self, logger, connect_timeout=10, request_timeout=60):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = 'RouterOSApiEngine'
+        self.LOGGER = logger
+        self._connect_timeout = connect_timeout
+        self._request_timeout = request_timeout
+
+        self._lock = Lock()
+        self._connections = {}
+        self._pending_open = []
+        self._pending_close = []
+        self._dirty = set()
+        self._stopping = False
+
+        self._poller = select.poll()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._poller.register(self._wakeup_read, _POLL_IN)
+        self._registered = {}
+
+    # Public API, any thread
+
+    def connect(self, router):
+        """
+        Open and log into router connection, blocks caller until connection is ready
+        Used as ConnectionManager connection factory
+        """
+        connection = ApiConnection(self, router['id'], router['host'], int(router.get('port', 8728)),
+                                   router['username'], router['password'],
+                                   router.get('request_timeout', self._request_timeout))
+        connection._open()
+        with self._lock:
+            self._pending_open.append(connection)
+        self._wakeup()
+        connection.wait_ready(router.get('connect_timeout', self._connect_timeout))
+        return connection
+
+    def submit(self, connection, request):
+        with self._lock:
+            connection._enqueue(request)
+            self._dirty.add(connection)
+        self._wakeup()
+
+    def mark_dirty(self, connection):
+        with self._lock:
+            self._dirty.add(connection)
+        self._wakeup()
+
+    def close_connection(self, connection, error=None):
+        with self._lock:
+            self._pending_close.append((connection, error or ConnectionClosed('Connection closed')))
+        self._wakeup()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup()
+
+    def _wakeup(self):
+        # Pipe is closed when engine stops, its fd number could already belong to another file
+        with self._lock:
+            if self._wakeup_write is None:
+                return
+            try:
+                os.write(self._wakeup_write, 'x')
+            except OSError:
+                pass
+
+    # Engine thread
+
+    def _update_interest(self, connection):
+        fd = connection.fileno
+        # Stop reading while a streaming consumer has full buffer, errors are still reported
+        events = 0 if connection.paused() else _POLL_IN
+        if connection._out or connection._state == _STATE_CONNECTING:
+            events |= select.POLLOUT
+        if self._registered.get(fd) != events:
+            if fd in self._registered:
+                self._poller.modify(fd, events)
+            else:
+                self._poller.register(fd, events)
+            self._registered[fd] = events
+
+    def _drop(self, connection, error):
+        with self._lock:
+            connection._close(error)
+            self._dirty.discard(connection)
+        fd = None
+        for registered_fd, registered in self._connections.items():
+            if registered is connection:
+                fd = registered_fd
+        if fd is not None:
+            del self._connections[fd]
+            if fd in self._registered:
+                self._poller.unregister(fd)
+                del self._registered[fd]
+
+    def _process_pending(self):
+        with self._lock:
+            opened, self._pending_open = self._pending_open, []
+            closed, self._pending_close = self._pending_close, []
+            dirty, self._dirty = self._dirty, set()
+
+        for connection in opened:
+            self._connections[connection.fileno] = connection
+            self._update_interest(connection)
+        for connection, error in closed:
+            self._drop(connection, error)
+        for connection in dirty:
+            if connection.connected:
+                self._update_interest(connection)
+
+    def _handle_write(self, connection):
+        if connection._state == _STATE_CONNECTING:
+            error = connection._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            with self._lock:
+                connection._start_login()
+
+        with self._lock:
+            if not connection._out:
+                return
+            try:
+                sent = connection._socket.send(connection._out)
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            del connection._out[:sent]
+
+    def _handle_read(self, connection):
+        try:
+            data = connection._socket.recv(_READ_SIZE)
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            raise ConnectionClosed('Connection closed by router')
+
+        sentences = connection._parser.feed(data)
+        if sentences:
+            with self._lock:
+                for words in sentences:
+                    connection._on_sentence(words)
+
+    def run(self):
+        self.LOGGER.info("RouterOS API engine started")
+        while not self._stopping:
+            self._process_pending()
+
+            try:
+                events = self._poller.poll(1000)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                if fd == self._wakeup_read:
+                    os.read(self._wakeup_read, 4096)
+                    continue
+
+                connection = self._connections.get(fd)
+                if connection is None:
+                    continue
+                try:
+                    if event & select.POLLOUT:
+                        self._handle_write(connection)
+                    if event & _POLL_IN:
+                        self._handle_read(connection)
+                    elif event & _POLL_ERR:
+                        raise ConnectionClosed('Socket error')
+                    if connection.connected:
+                        self._update_interest(connection)
+                    else:
+                        # Closed while handling replies, ex failed login
+                        self._drop(connection, connection._error)
+                except Exception, e:
+                    self.LOGGER.error("Connection to router [{}] failed\n***{}".format(connection.router_id, e))
+                    self._drop(connection, e if isinstance(e, ApiError) else ConnectionClosed(str(e)))
+
+        for connection in self._connections.values():
+            self._drop(connection, ConnectionClosed('Engine stopped'))
+        self._poller.unregister(self._wakeup_read)
+        with self._lock:
+            os.close(self._wakeup_read)
+            os.close(self._wakeup_write)
+            self._wakeup_read = self._wakeup_write = None
+        self.LOGGER.info("RouterOS API engine stopped")
@@ -0,0 +1,134 @@
+import hashlib
+import struct
+
+# RouterOS API wire protocol
+# Sentence is a list of words, every word is prefixed with its length, sentence ends with empty word
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_length(length):
+    if length < 0x80:
+        return chr(length)
+    if length < 0x4000:
+        return struct.pack('>H', length | 0x8000)
+    if length < 0x200000:
+        return struct.pack('>I', length | 0xC00000)[1:]
+    if length < 0x10000000:
+        return struct.pack('>I', length | 0xE0000000)
+    return '\xF0' + struct.pack('>I', length)
+
+
+def encode_word(word):
+    if isinstance(word, unicode):
+        word = word.encode('utf-8')
+    return encode_length(len(word)) + word
+
+
+def encode_sentence(words):
+    return ''.join(encode_word(word) for word in words) + '\x00'
+
+
+def build_command(command, attributes=None, queries=None, proplist=None, tag=None):
+    # /path/command =attr=value ?query .proplist=a,b .tag=N
+    words = [command]
+    for key, value in (attributes or {}).items():
+        words.append('={}={}'.format(key, value))
+    if proplist:
+        words.append('=.proplist={}'.format(','.join(proplist)))
+    for query in queries or ():
+        words.append(query)
+    if tag is not None:
+        words.append('.tag={}'.format(tag))
+    return words
+
+
+def login_response(password, challenge):
+    # Pre 6.43 challenge-response login
+    md5 = hashlib.md5()
+    md5.update('\x00')
+    md5.update(password)
+    md5.update(challenge.decode('hex'))
+    return '00' + md5.hexdigest()
+
+
+class SentenceParser:
+    """
+    Incremental parser, bytes are fed as they arrive from socket and complete sentences are returned
+    """
+
+    def __init__(self):
+        self._buffer = ''
+        self._words = []
+
+    @staticmethod
+    def _read_length(buf, position):
+        first = ord(buf[position])
+        if first & 0xC0 == 0x80:
+            size, value = 2, first & ~0xC0
+        elif first & 0xE0 == 0xC0:
+            size, value = 3, first & ~0xE0
+        elif first & 0xF0 == 0xE0:
+            size, value = 4, first & ~0xF0
+        elif first == 0xF0:
+            size, value = 5, 0
+        else:
+            raise ProtocolError('Invalid word length prefix 0x{:02x}'.format(first))
+
+        if position + size > len(buf):
+            return None, 0
+        for char in buf[position + 1:position + size]:
+            value = (value << 8) | ord(char)
+        return value, size
+
+    def feed(self, data):
+        buf = self._buffer + data if self._buffer else data
+        end = len(buf)
+        words = self._words
+        sentences = []
+        position = 0
+        while position < end:
+            # Most words are shorter than 128 bytes and have single byte length
+            length = ord(buf[position])
+            size = 1
+            if length >= 0x80:
+                length, size = self._read_length(buf, position)
+                if length is None:
+                    break
+            if position + size + length > end:
+                break
+            position += size
+            if length == 0:
+                sentences.append(words)
+                words = []
+            else:
+                words.append(buf[position:position + length])
+                position += length
+
+        self._words = words
+        self._buffer = buf[position:]
+        return sentences
+
+
+def parse_sentence(words):
+    """
+    Split reply sentence into (reply type, tag, attributes)
+    Attribute words '=key=value' become dict items, '.id' is returned as 'id' like routeros_api does
+    """
+    if not words:
+        raise ProtocolError('Empty sentence')
+
+    reply = words[0]
+    tag = None
+    attributes = {}
+    for word in words[1:]:
+        if word.startswith('.tag='):
+            tag = word[5:]
+        elif word.startswith('='):
+            key, sep, value = word[1:].partition('=')
+            if key == '.id':
+                key = 'id'
+            attributes[key] = value
+    return reply, tag, attributes
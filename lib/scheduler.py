@@ -0,0 +1,149 @@
+from lib.clock import monotonic
+from threading import Event, Lock
+import heapq
+import itertools
+import math
+
+OVERRUN_SKIP = 'skip'
+OVERRUN_CATCH_UP = 'catch_up'
+OVERRUN_POLICIES = (OVERRUN_SKIP, OVERRUN_CATCH_UP)
+
+
+class ScheduledJob:
+    def __init__(self, job, interval, policy, max_concurrency=1):
+        self.job = job
+        self.interval = float(interval)
+        self.policy = policy
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.in_flight = 0
+        self.parked = False
+        self.deadline = None
+        self.runs = 0
+        self.skipped = 0
+
+
+class Scheduler:
+    """
+    Deadline driven scheduler
+    Jobs are kept in a heap keyed by their next deadline, caller sleeps until the earliest one is due.
+    Next deadline is always computed from the previous deadline, not from the time the job finished,
+    so intervals don't drift when a job runs long.
+    """
+
+    def __init__(self, logger, overrun_policy=OVERRUN_SKIP, max_catch_up=3):
+        if overrun_policy not in OVERRUN_POLICIES:
+            raise Exception('Unknown overrun policy [{}]'.format(overrun_policy))
+
+        self.LOGGER = logger
+        self._overrun_policy = overrun_policy
+        # How many missed intervals catch_up policy is allowed to run back to back
+        self._max_catch_up = int(max_catch_up)
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = Lock()
+        self._wakeup = Event()
+
+    def add(self, job, interval, overrun_policy=None, start=None, max_concurrency=1):
+        policy = overrun_policy or self._overrun_policy
+        if policy not in OVERRUN_POLICIES:
+            raise Exception('Unknown overrun policy [{}]'.format(policy))
+
+        entry = ScheduledJob(job, interval, policy, max_concurrency)
+        # By default first run is due immediately
+        entry.deadline = monotonic() if start is None else start
+        self._push(entry)
+        return entry
+
+    def _push(self, entry):
+        with self._lock:
+            heapq.heappush(self._heap, (entry.deadline, next(self._counter), entry))
+        self._wakeup.set()
+
+    def next_deadline(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def wakeup(self):
+        # Interrupt wait() early, used on shutdown
+        self._wakeup.set()
+
+    def wait(self, max_wait=None):
+        """
+        Block until at least one job is due, max_wait elapsed or wakeup() was called
+        Returns list of due entries, caller must call reschedule() for each of them
+        """
+        deadline = self.next_deadline()
+        now = monotonic()
+        if deadline is None:
+            delay = max_wait
+        else:
+            delay = max(deadline - now, 0)
+            if max_wait is not None:
+                delay = min(delay, max_wait)
+
+        if delay is None or delay > 0:
+            self._wakeup.wait(delay)
+        self._wakeup.clear()
+
+        return self.pop_due()
+
+    def pop_due(self):
+        now = monotonic()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def acquire(self, entry):
+        """
+        Mark due entry as dispatched and schedule its next run
+        Returns False if entry already has max_concurrency runs in flight, in that case
+        the slot is skipped or, for catch_up policy, entry is parked until a running call finishes
+        """
+        with self._lock:
+            if entry.in_flight >= entry.max_concurrency:
+                if entry.policy == OVERRUN_CATCH_UP:
+                    entry.parked = True
+                    self.LOGGER.debug("Job {} still running, parked until it finishes".format(entry.job))
+                    return False
+                busy = True
+            else:
+                entry.in_flight += 1
+                busy = False
+
+        if busy:
+            entry.skipped += 1
+            self.LOGGER.warning("Job {} still running, skipped run".format(entry.job))
+        self.reschedule(entry)
+        return not busy
+
+    def release(self, entry):
+        # Called when dispatched run finished, parked entry is due right away
+        with self._lock:
+            entry.in_flight -= 1
+            parked = entry.parked
+            entry.parked = False
+        if parked:
+            self._push(entry)
+
+    def reschedule(self, entry):
+        now = monotonic()
+        entry.runs += 1
+        next_deadline = entry.deadline + entry.interval
+
+        if next_deadline <= now:
+            # Job overran its interval
+            missed = int(math.floor((now - next_deadline) / entry.interval)) + 1
+            if entry.policy == OVERRUN_CATCH_UP and missed <= self._max_catch_up:
+                # Keep the missed deadline, job runs again right away until it catches up
+                self.LOGGER.debug("Job {} behind by {} interval(s), catching up".format(entry.job, missed))
+            else:
+                # Skip missed runs and align to the next slot on the original grid
+                next_deadline += missed * entry.interval
+                entry.skipped += missed
+                self.LOGGER.warning("Job {} overran, skipped {} run(s)".format(entry.job, missed))
+
+        entry.deadline = next_deadline
+        self._push(entry)
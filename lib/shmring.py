@@ -0,0 +1,149 @@
+from threading import Thread
+import marshal
+import multiprocessing
+import struct
+import Queue
+from lib.clock import monotonic
+from lib.columnar import encode_job, decode_job
+from lib.jobqueue import UnknownFlowError
+from lib.supervisor import Health
+
+_length_struct = struct.Struct('>I')
+
+
+class SharedRing:
+    """
+    Byte ring buffer in shared memory, carries length prefixed records between processes
+    Must be created before worker processes are forked. Writers block (up to timeout) while ring is full,
+    readers while it is empty.
+    """
+
+    def __init__(self, capacity):
+        self._capacity = int(capacity)
+        self._data = multiprocessing.RawArray('c', self._capacity)
+        # Total bytes ever written/read, position in ring is value modulo capacity
+        self._head = multiprocessing.RawValue('L', 0)
+        self._tail = multiprocessing.RawValue('L', 0)
+        self._changed = multiprocessing.Condition(multiprocessing.Lock())
+
+    def _copy_in(self, position, data):
+        start = position % self._capacity
+        first = min(len(data), self._capacity - start)
+        self._data[start:start + first] = data[:first]
+        if first < len(data):
+            self._data[0:len(data) - first] = data[first:]
+
+    def _copy_out(self, position, length):
+        start = position % self._capacity
+        first = min(length, self._capacity - start)
+        data = self._data[start:start + first]
+        if first < length:
+            data += self._data[0:length - first]
+        return data
+
+    def used(self):
+        return self._head.value - self._tail.value
+
+    def write(self, data, timeout=None):
+        record = _length_struct.pack(len(data)) + data
+        if len(record) > self._capacity:
+            raise Exception('Record of {} bytes is bigger than ring of {} bytes'.format(len(record), self._capacity))
+
+        end = None if timeout is None else monotonic() + timeout
+        with self._changed:
+            while self._capacity - self.used() < len(record):
+                remaining = 1 if end is None else end - monotonic()
+                if remaining <= 0:
+                    raise Queue.Full
+                self._changed.wait(min(remaining, 1))
+            self._copy_in(self._head.value, record)
+            self._head.value += len(record)
+            self._changed.notify_all()
+
+    def read(self, timeout=None):
+        end = None if timeout is None else monotonic() + timeout
+        with self._changed:
+            while not self.used():
+                remaining = 1 if end is None else end - monotonic()
+                if remaining <= 0:
+                    raise Queue.Empty
+                self._changed.wait(min(remaining, 1))
+            tail = self._tail.value
+            length = _length_struct.unpack(self._copy_out(tail, _length_struct.size))[0]
+            data = self._copy_out(tail + _length_struct.size, length)
+            self._tail.value = tail + _length_struct.size + length
+            self._changed.notify_all()
+        return data
+
+
+class RingWriter:
+    """
+    Producer side of ring with the put() interface of JobQueue, used as scraper output queue in process mode
+    Jobs are marshal encoded, columnar payloads as raw array bytes
+    """
+
+    def __init__(self, ring):
+        self._ring = ring
+
+    def put(self, item, block=True, timeout=None):
+        self._ring.write(marshal.dumps(encode_job(item), 2), timeout if block else 0)
+
+
+class RingReader(Thread):
+    """
+    Moves jobs from ring into writer process JobQueue, jobs it can't queue are passed to on_drop
+    """
+
+    def __init__(self, logger, ring, queue, put_timeout=None, on_drop=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.LOGGER = logger
+        self._ring = ring
+        self._queue = queue
+        self._put_timeout = put_timeout
+        self._on_drop = on_drop
+
+        self.running = False
+        self.wantRunning = True
+        self.health = Health()
+
+    def _move(self, timeout):
+        try:
+            job = decode_job(marshal.loads(self._ring.read(timeout=timeout)))
+        except Queue.Empty:
+            raise
+        except Exception, e:
+            self.LOGGER.error("Dropping unreadable ring record\n***{}".format(e))
+            return
+
+        try:
+            self._queue.put(job, timeout=self._put_timeout)
+            return
+        except UnknownFlowError, e:
+            self.LOGGER.error("Dropping job from ring\n***{}".format(e))
+        except Queue.Full:
+            self.LOGGER.error("Queue full, dropping job [{}] from ring".format(job['name']))
+        if self._on_drop:
+            self._on_drop(job)
+
+    def run(self):
+        self.running = True
+        while self.wantRunning:
+            self.health.beat()
+            try:
+                self._move(1)
+            except Queue.Empty:
+                continue
+
+        # Scrapers are stopped before reader, jobs still in ring are handed over for database drain
+        moved = 0
+        try:
+            while True:
+                self._move(0)
+                moved += 1
+        except Queue.Empty:
+            pass
+        if moved:
+            self.LOGGER.info("Moved {} jobs left in ring to queue".format(moved))
+        self.running = False
+        self.health.stopped()
@@ -0,0 +1,229 @@
+from threading import Lock
+import marshal
+import os
+import struct
+import zlib
+from lib.columnar import encode_job, decode_job
+
+# Record layout: magic, payload length, crc32 of payload, payload (marshal encoded job)
+_RECORD_MAGIC = 0x53504F4C
+_record_header = struct.Struct('>III')
+_cursor_struct = struct.Struct('>QQ')
+
+_SEGMENT_SUFFIX = '.seg'
+_CURSOR_FILE = 'cursor'
+
+
+class Spool:
+    """
+    Append-only on-disk job spool, used while MySQL is unavailable or input queue is too deep
+    Jobs are appended to numbered segment files and read back in order.
+    Read position is persisted in cursor file only when caller commits it, so jobs survive restarts
+    until they are written to MySQL.
+    """
+
+    def __init__(self, logger, location, segment_size=16 * 1024 * 1024, max_size=1024 * 1024 * 1024, fsync=False):
+        self.LOGGER = logger
+        self._location = location
+        self._segment_size = int(segment_size)
+        self._max_size = int(max_size)
+        self._fsync = fsync
+        self._lock = Lock()
+
+        if not os.path.isdir(self._location):
+            os.makedirs(self._location)
+
+        self._segments = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self._location)
+                                if name.endswith(_SEGMENT_SUFFIX))
+        self._sizes = dict((segment, os.path.getsize(self._segment_path(segment))) for segment in self._segments)
+
+        # Read position (segment, offset) of first uncommitted record
+        self._cursor = self._load_cursor()
+        self._write_file = None
+        self._write_segment = None
+
+        if self._segments:
+            self.LOGGER.info("Spool has {} segment(s), {} bytes pending".format(len(self._segments), self.size()))
+
+    def _segment_path(self, segment):
+        return os.path.join(self._location, "{:012d}{}".format(segment, _SEGMENT_SUFFIX))
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self._location, _CURSOR_FILE), 'rb') as f:
+                segment, offset = _cursor_struct.unpack(f.read(_cursor_struct.size))
+        except (IOError, struct.error):
+            return (self._segments[0] if self._segments else 0), 0
+
+        if segment not in self._sizes:
+            # Segment was consumed or removed, continue from oldest one left
+            return (self._segments[0] if self._segments else segment), 0
+        return segment, offset
+
+    def _save_cursor(self):
+        path = os.path.join(self._location, _CURSOR_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_cursor_struct.pack(*self._cursor))
+            if self._fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+    def size(self):
+        return sum(self._sizes.values()) - (self._cursor[1] if self._cursor[0] in self._sizes else 0)
+
+    def empty(self):
+        with self._lock:
+            return self._is_empty()
+
+    def _is_empty(self):
+        if not self._segments:
+            return True
+        segment, offset = self._cursor
+        return segment == self._segments[-1] and offset >= self._sizes[segment]
+
+    def _open_write_segment(self):
+        if self._write_file:
+            self._write_file.close()
+        was_empty = self._is_empty()
+
+        self._write_segment = (self._segments[-1] + 1) if self._segments else max(self._cursor[0], 1)
+        self._segments.append(self._write_segment)
+        self._sizes[self._write_segment] = 0
+        self._write_file = open(self._segment_path(self._write_segment), 'ab')
+
+        # Nothing left to read in older segments, reading continues from the new one
+        if was_empty:
+            self._cursor = (self._write_segment, 0)
+
+    def append(self, job):
+        data = marshal.dumps(encode_job(job), 2)
+        record = _record_header.pack(_RECORD_MAGIC, len(data), zlib.crc32(data) & 0xFFFFFFFF) + data
+
+        with self._lock:
+            # New process always starts a fresh segment, older ones may end with a torn record
+            if not self._write_file or self._sizes[self._write_segment] >= self._segment_size:
+                self._open_write_segment()
+
+            self._write_file.write(record)
+            self._write_file.flush()
+            if self._fsync:
+                os.fsync(self._write_file.fileno())
+            self._sizes[self._write_segment] += len(record)
+            self._enforce_size_cap()
+
+    def _enforce_size_cap(self):
+        # Oldest segments are dropped when spool grows over its cap, active segment is never dropped
+        while len(self._segments) > 1 and sum(self._sizes.values()) > self._max_size:
+            segment = self._segments.pop(0)
+            self.LOGGER.error("Spool over {} bytes, dropping segment {} ({} bytes)".format(
+                self._max_size, segment, self._sizes[segment]))
+            self._remove_segment(segment)
+            if self._cursor[0] <= segment:
+                self._cursor = (self._segments[0], 0)
+                self._save_cursor()
+
+    def _remove_segment(self, segment):
+        del self._sizes[segment]
+        try:
+            os.remove(self._segment_path(segment))
+        except OSError, e:
+            self.LOGGER.error("Could not remove spool segment {}\n***{}".format(segment, e))
+
+    def read(self, max_records):
+        """
+        Read up to max_records jobs starting at current cursor
+        Returns (jobs, position), position has to be passed to commit() once jobs are written
+        """
+        jobs = []
+        with self._lock:
+            segment, offset = self._cursor
+            while len(jobs) < max_records and segment in self._sizes:
+                end = self._sizes[segment]
+                if offset < end:
+                    with open(self._segment_path(segment), 'rb') as f:
+                        f.seek(offset)
+                        while len(jobs) < max_records and offset < end:
+                            job, length = self._read_record(f, segment, offset, end)
+                            if job is None:
+                                # Corrupted or torn record, continue from next valid record in segment
+                                offset = self._resync(f, segment, offset + 1, end)
+                                continue
+                            jobs.append(job)
+                            offset += length
+
+                if offset >= end and segment != self._segments[-1]:
+                    segment = self._segments[self._segments.index(segment) + 1]
+                    offset = 0
+                else:
+                    break
+
+        return jobs, (segment, offset)
+
+    def _read_record(self, f, segment, offset, end, log=True):
+        f.seek(offset)
+        header = f.read(_record_header.size)
+        if len(header) < _record_header.size:
+            if log:
+                self.LOGGER.error("Truncated spool record in segment {} at {}".format(segment, offset))
+            return None, 0
+
+        magic, length, checksum = _record_header.unpack(header)
+        if magic != _RECORD_MAGIC or offset + _record_header.size + length > end:
+            if log:
+                self.LOGGER.error("Corrupted spool record header in segment {} at {}".format(segment, offset))
+            return None, 0
+
+        data = f.read(length)
+        if zlib.crc32(data) & 0xFFFFFFFF != checksum:
+            if log:
+                self.LOGGER.error("Spool record checksum mismatch in segment {} at {}".format(segment, offset))
+            return None, 0
+
+        return decode_job(marshal.loads(data)), _record_header.size + length
+
+    def _resync(self, f, segment, offset, end):
+        # Scan forward for next record with valid magic and checksum
+        magic = _record_header.pack(_RECORD_MAGIC, 0, 0)[:4]
+        f.seek(offset)
+        data = f.read(end - offset)
+        position = data.find(magic)
+        while position >= 0:
+            job, length = self._read_record(f, segment, offset + position, end, log=False)
+            if job is not None:
+                self.LOGGER.warning("Spool resynced in segment {}, skipped {} bytes".format(segment, position + 1))
+                return offset + position
+            position = data.find(magic, position + 1)
+
+        self.LOGGER.warning("Skipping rest of spool segment {} ({} bytes)".format(segment, end - offset + 1))
+        return end
+
+    def commit(self, position):
+        # Advance cursor past written jobs and remove fully consumed segments
+        with self._lock:
+            if position[0] not in self._sizes and self._segments and position[0] < self._segments[0]:
+                # Segment was dropped by size cap while it was being replayed
+                position = (self._segments[0], 0)
+            self._cursor = position
+            for segment in list(self._segments):
+                if segment >= position[0] or segment == self._write_segment:
+                    break
+                self._segments.remove(segment)
+                self._remove_segment(segment)
+
+            # Whole spool consumed, start over with empty segment files
+            if self._is_empty() and self._write_file:
+                self._write_file.close()
+                self._write_file = None
+                self._segments.remove(self._write_segment)
+                self._remove_segment(self._write_segment)
+                self._cursor = (self._write_segment + 1, 0)
+                self._write_segment = None
+
+            self._save_cursor()
+
+    def close(self):
+        with self._lock:
+            if self._write_file:
+                self._write_file.close()
+                self._write_file = None
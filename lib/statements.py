@@ -0,0 +1,163 @@
+from collections import OrderedDict
+from threading import Lock
+from lib.columnar import ColumnarBatch
+
+MYSQL_TYPES = ('INSERT', 'INSERT_ON_FAIL_UPDATE')
+
+
+class Statement:
+    """
+    Precompiled INSERT (and optional DELETE) statement for one flow
+    Multi-row queries are cached per row count, only the most recently used ones are kept
+    """
+
+    MAX_CACHED_QUERIES = 8
+
+    def __init__(self, flow):
+        self.name = str(flow['name'])
+        self.mysql_type = str(flow['mysql_type'])
+        self.mysql_table = str(flow['mysql_table'])
+        self.params = tuple(str(param) for param in flow['params'])
+        # Multi-router setups tag every row with router id
+        if flow.get('router_column'):
+            self.params += (str(flow['router_column']),)
+
+        if self.mysql_type not in MYSQL_TYPES:
+            raise Exception('Unknown mysql type {}'.format(self.mysql_type))
+        if not self.params:
+            raise Exception('Flow [{}] has no params'.format(self.name))
+
+        self._prefix = "INSERT INTO {} ({}) VALUES ".format(self.mysql_table, ", ".join(self.params))
+        self._row_placeholder = "({})".format(", ".join("%s" for x in self.params))
+        self._suffix = ""
+        if "ON_FAIL_UPDATE" in self.mysql_type:
+            self._suffix = self._update_clause(flow.get('accumulate') or (), "")
+
+        self._queries = OrderedDict()
+        self._queries_lock = Lock()
+
+        # Bulk ingest through LOAD DATA LOCAL INFILE, True/False forces it on/off, None decides by payload size
+        self.bulk = flow.get('bulk_ingest')
+        columns = ", ".join(self.params)
+        load = ("LOAD DATA LOCAL INFILE %s INTO TABLE {} CHARACTER SET utf8 "
+                "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' ({})")
+        if self._suffix:
+            # LOAD DATA can't update existing rows, file is loaded to keyless temporary table and merged
+            stage = "{}_stage".format(self.mysql_table)
+            self.bulk_queries = (
+                # Left over by failed load on same connection
+                "DROP TEMPORARY TABLE IF EXISTS {}".format(stage),
+                "CREATE TEMPORARY TABLE {} SELECT {} FROM {} LIMIT 0".format(stage, columns, self.mysql_table),
+                load.format(stage, columns),
+                # Target columns are qualified, bare names would be ambiguous between target and stage table
+                "INSERT INTO {0} ({1}) SELECT {1} FROM {2}{3}".format(
+                    self.mysql_table, columns, stage,
+                    self._update_clause(flow.get('accumulate') or (), "{}.".format(self.mysql_table))),
+                "DROP TEMPORARY TABLE {}".format(stage),
+            )
+        else:
+            self.bulk_queries = (load.format(self.mysql_table, columns),)
+
+        # Flows with change detection can delete rows whose key disappeared from router
+        self.key_columns = ()
+        change_detection = flow.get('change_detection') or {}
+        if change_detection.get('delete_removed'):
+            self.key_columns = (str(change_detection.get('primary_key', self.params[0])),)
+            if flow.get('router_column'):
+                self.key_columns += (str(flow['router_column']),)
+        # Writer pool routes jobs by table, or by hash of this param so rows of one key keep their order
+        self.route_key = None
+        if flow.get('writer_route') == 'key':
+            self.route_key = self.params.index(str(change_detection.get('primary_key', self.params[0])))
+        self._key_placeholder = "({})".format(", ".join("%s" for x in self.key_columns))
+        self._delete_queries = OrderedDict()
+
+    def _update_clause(self, accumulate, qualifier):
+        # Accumulate columns (rollup counters) are added to existing value instead of replacing it
+        return " ON DUPLICATE KEY UPDATE {}".format(
+            ", ".join(("{1}{0} = {1}{0} + VALUES({0})" if param in accumulate else "{1}{0} = VALUES({0})")
+                      .format(param, qualifier) for param in self.params)
+        )
+
+    def _cached(self, cache, count, build):
+        # Full-size chunks repeat, tail chunks of every size would grow the cache without bound
+        with self._queries_lock:
+            query = cache.pop(count, None)
+            if query is None:
+                query = build(count)
+                while len(cache) >= self.MAX_CACHED_QUERIES:
+                    cache.popitem(last=False)
+            cache[count] = query
+        return query
+
+    def _build_query(self, row_count):
+        return self._prefix + ", ".join([self._row_placeholder] * row_count) + self._suffix
+
+    def _build_delete_query(self, key_count):
+        return "DELETE FROM {} WHERE ({}) IN ({})".format(self.mysql_table, ", ".join(self.key_columns),
+                                                          ", ".join([self._key_placeholder] * key_count))
+
+    def query(self, row_count):
+        return self._cached(self._queries, row_count, self._build_query)
+
+    def delete_query(self, key_count):
+        if not self.key_columns:
+            raise Exception('Flow [{}] has no delete key configured'.format(self.name))
+        return self._cached(self._delete_queries, key_count, self._build_delete_query)
+
+
+def compile_statements(logger, flows):
+    # Build statements for all configured flows once at startup, keyed by flow name
+    statements = {}
+    for flow in flows:
+        try:
+            statement = Statement(flow)
+            statements[statement.name] = statement
+        except Exception, e:
+            logger.error("Could not compile statement for flow [{}]\n{}".format(flow, e))
+    return statements
+
+
+def insert_chunks(payloads, max_rows, max_bytes):
+    """
+    Split payloads into (statement args, row count) chunks bounded by row count and approximate statement size
+    Chunk stays open across payloads, so small jobs of one flow share a statement. Columnar payloads are
+    cut by their average row size and encoded straight from columns
+    """
+    chunk = []
+    chunk_rows = 0
+    chunk_bytes = 0
+    for payload in payloads:
+        if isinstance(payload, ColumnarBatch):
+            row_bytes = max(payload.row_size(), 1)
+            start = 0
+            while start < len(payload):
+                fit = min(max_rows - chunk_rows, (max_bytes - chunk_bytes) // row_bytes)
+                if fit <= 0:
+                    if chunk_rows:
+                        yield chunk, chunk_rows
+                        chunk = []
+                        chunk_rows = 0
+                        chunk_bytes = 0
+                        continue
+                    # Single row over byte budget still goes out alone
+                    fit = 1
+                stop = min(start + fit, len(payload))
+                chunk.extend(payload.flat_args(start, stop))
+                chunk_rows += stop - start
+                chunk_bytes += (stop - start) * row_bytes
+                start = stop
+            continue
+
+        for row in payload:
+            row_bytes = sum(len(str(value)) + 4 for value in row)
+            if chunk_rows and (chunk_rows >= max_rows or chunk_bytes + row_bytes > max_bytes):
+                yield chunk, chunk_rows
+                chunk = []
+                chunk_rows = 0
+                chunk_bytes = 0
+            chunk.extend(row)
+            chunk_rows += 1
+            chunk_bytes += row_bytes
+    if chunk_rows:
+        yield chunk, chunk_rows
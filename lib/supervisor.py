@@ -0,0 +1,244 @@
+import Queue
+from etc import config
+from lib.backoff import Backoff
+from lib.clock import monotonic
+
+# Health events, (kind, component name, generation, detail)
+EVENT_HEARTBEAT = 'heartbeat'
+EVENT_FAILED = 'failed'
+EVENT_STOPPED = 'stopped'
+
+
+class Health:
+    """
+    Reports liveness of one component instance to supervisor
+    Component threads call beat() every loop, failed(e) when loop breaks on error and stopped() on exit.
+    Heartbeats are sent at most once per interval. Without supervisor (events is None) calls do nothing.
+    """
+
+    def __init__(self, name=None, generation=0, events=None, interval=1.0):
+        self._name = name
+        self._generation = generation
+        self._events = events
+        self._interval = interval
+        self._last_beat = 0
+
+    def _send(self, kind, detail=None):
+        if self._events is None:
+            return
+        try:
+            self._events.put_nowait((kind, self._name, self._generation, detail))
+        except Queue.Full:
+            pass
+
+    def beat(self):
+        if self._events is None:
+            return
+        now = monotonic()
+        if now - self._last_beat >= self._interval:
+            self._last_beat = now
+            self._send(EVENT_HEARTBEAT)
+
+    def failed(self, error):
+        self._send(EVENT_FAILED, str(error))
+
+    def stopped(self):
+        self._send(EVENT_STOPPED)
+
+
+def restart_policy(name):
+    # config.supervisor = {'default': {...}, 'Database': {...}}, component settings override defaults
+    supervisor_config = getattr(config, 'supervisor', None) or {}
+    policy = dict(supervisor_config.get('default', {}))
+    policy.update(supervisor_config.get(name, {}))
+    return policy
+
+
+class Component:
+    """
+    Supervised unit, factory(previous) builds a new thread (or ComponentProcess) for every start
+    previous is the last instance if it is no longer alive, so factory can take over its unfinished work.
+
+    Policy keys: restart (True), backoff_initial (1), backoff_max (60) seconds between restarts,
+    max_restarts (5) within window (600) seconds before supervisor gives up,
+    heartbeat_timeout (120) seconds without heartbeat after which running instance counts as stuck.
+    fatal (True), non-fatal component that runs out of restarts is retried every backoff_max seconds
+    instead of shutting everything down.
+    exclusive (False), replacement is started only once previous instance exited, for components whose
+    instances share state (queue, spool) that two of them can't use at once. Previous instance that
+    doesn't exit within stop_timeout (30) seconds after restart is due makes supervisor give up.
+    """
+
+    def __init__(self, name, factory, policy=None, stage=0):
+        policy = policy or {}
+        self.name = name
+        self._factory = factory
+        # Shutdown order, producers have lower stage than the writer they feed
+        self.stage = stage
+        self.restart = policy.get('restart', True)
+        self.max_restarts = int(policy.get('max_restarts', 5))
+        self.window = float(policy.get('window', 600))
+        self.heartbeat_timeout = float(policy.get('heartbeat_timeout', 120))
+        self.fatal = policy.get('fatal', True)
+        self.exclusive = policy.get('exclusive', False)
+        self.stop_timeout = float(policy.get('stop_timeout', 30))
+        self.backoff_max = float(policy.get('backoff_max', 60))
+        self.backoff = Backoff(policy.get('backoff_initial', 1), self.backoff_max)
+
+        self.instance = None
+        self.generation = 0
+        self.last_beat = 0
+        self.restart_at = None
+        self.restarts = []
+
+    def create(self, events):
+        previous = self.instance
+        if previous is not None and previous.is_alive():
+            previous = None
+        self.generation += 1
+        self.instance = self._factory(previous)
+        self.instance.health = Health(self.name, self.generation, events)
+        self.last_beat = monotonic()
+        return self.instance
+
+
+class Supervisor:
+    """
+    Starts components and restarts only the one that failed, the rest keep running
+    Failures come as events from component Health, instance that stopped without being asked to
+    or missed its heartbeat deadline counts as failed too. Stuck instance is asked to stop and left behind
+    (component threads are daemons), new instance is started after policy backoff, exclusive components
+    wait for it to exit first.
+    poll() returns False once a component failed more than max_restarts times within window,
+    main then shuts everything down as before.
+
+    events defaults to Queue.Queue, process mode passes multiprocessing.Queue so child processes can report.
+    """
+
+    def __init__(self, logger, events=None):
+        self.LOGGER = logger
+        self.events = events if events is not None else Queue.Queue()
+        self._components = []
+        self._by_name = {}
+        self._stopping = False
+
+    def add(self, component):
+        self._components.append(component)
+        self._by_name[component.name] = component
+
+    def instances(self):
+        return [component.instance for component in self._components if component.instance is not None]
+
+    def start(self):
+        for component in self._components:
+            component.create(self.events).start()
+
+    def _failed(self, component, reason):
+        if component.restart_at is not None:
+            return True
+        now = monotonic()
+        if component.instance.is_alive():
+            component.instance.wantRunning = False
+
+        component.restarts = [restarted for restarted in component.restarts if now - restarted < component.window]
+        if not component.restart or len(component.restarts) >= component.max_restarts:
+            if not component.fatal:
+                component.restart_at = now + component.backoff_max
+                self.LOGGER.error("{} failed ({}), {} restarts in last {:.0f} sec, retrying in {:.0f} sec".format(
+                    component.name, reason, len(component.restarts), component.window, component.backoff_max))
+                return True
+            self.LOGGER.error("{} failed ({}), {} restarts in last {:.0f} sec, giving up".format(
+                component.name, reason, len(component.restarts), component.window))
+            return False
+
+        delay = component.backoff.next_delay()
+        component.restart_at = now + delay
+        self.LOGGER.warning("{} failed ({}), restarting in {:.1f} sec".format(component.name, reason, delay))
+        return True
+
+    def _handle(self, event):
+        kind, name, generation, detail = event
+        component = self._by_name.get(name)
+        # Late events of replaced instances are ignored
+        if component is None or generation != component.generation:
+            return True
+        if kind == EVENT_HEARTBEAT:
+            component.last_beat = monotonic()
+            return True
+        if kind == EVENT_FAILED:
+            return self._failed(component, detail)
+        if kind == EVENT_STOPPED and not self._stopping:
+            return self._failed(component, 'stopped unexpectedly')
+        return True
+
+    def _check(self, component):
+        now = monotonic()
+        if component.restart_at is not None:
+            if now >= component.restart_at and component.exclusive and component.instance.is_alive():
+                if now - component.restart_at < component.stop_timeout:
+                    return True
+                # Left behind instance still holds shared state, only a fresh process gets rid of it
+                self.LOGGER.error("{} did not stop within {:.0f} sec, can't start replacement".format(
+                    component.name, component.stop_timeout))
+                return False
+            if now >= component.restart_at:
+                component.restart_at = None
+                component.restarts.append(now)
+                component.create(self.events).start()
+                self.LOGGER.info("{} restarted".format(component.name))
+            return True
+
+        # Killed process or thread that died outside its loop can't report
+        if not component.instance.is_alive():
+            return self._failed(component, 'died without reporting')
+        if now - component.last_beat > component.heartbeat_timeout:
+            return self._failed(component, 'no heartbeat for {:.0f} sec'.format(now - component.last_beat))
+
+        # Healthy for a whole window, next failure starts backoff from the beginning
+        if component.backoff.failures and component.restarts and now - component.restarts[-1] > component.window:
+            component.backoff.reset()
+        return True
+
+    def poll(self, timeout=1.0):
+        # Handles events for timeout seconds, then restarts due components and checks heartbeat deadlines
+        healthy = True
+        end = monotonic() + timeout
+        while True:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                event = self.events.get(timeout=remaining)
+            except Queue.Empty:
+                break
+            healthy = self._handle(event) and healthy
+
+        for component in self._components:
+            healthy = self._check(component) and healthy
+        return healthy
+
+    def stop(self):
+        self._stopping = True
+        for component in self._components:
+            component.restart_at = None
+
+    def shutdown(self, join_timeout=10, drain_timeout=30):
+        # Ordered shutdown, stage by stage. Instances with drain() (writer) get drain_timeout to flush
+        # what producers of earlier stages left behind before they stop
+        self.stop()
+        for stage in sorted(set(component.stage for component in self._components)):
+            components = [component for component in self._components
+                          if component.stage == stage and component.instance is not None]
+            for component in components:
+                if hasattr(component.instance, 'drain'):
+                    component.instance.drain(drain_timeout)
+                else:
+                    component.instance.wantRunning = False
+            for component in components:
+                self.LOGGER.info("Joining {}".format(component.name))
+                timeout = join_timeout + (drain_timeout if hasattr(component.instance, 'drain') else 0)
+                component.instance.join(timeout)
+                if component.instance.is_alive():
+                    self.LOGGER.warning("{} did not stop within {:.0f} sec".format(component.name, timeout))
+                else:
+                    self.LOGGER.info("Thread {} joined".format(component.name))
@@ -0,0 +1,132 @@
+from lib.connections import RouterUnavailable
+from lib.clock import monotonic
+from lib.metrics import FLOW_RUN_SECONDS, ROUTEROS_CALL_SECONDS, FLOW_TRANSFORM_SECONDS, FLOW_ROWS, FLOW_FAILURES
+from lib.routeros.client import TimedApi
+from threading import Thread
+import Queue
+
+
+class Worker(Thread):
+    """
+    Pool worker, checks out router connection for every flow run so a flow never shares a client
+    """
+
+    def __init__(self, pool, index):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = "{}-worker-{}".format(pool.name, index)
+        self.LOGGER = pool.LOGGER
+        self._pool = pool
+        # Entry being run and when it started, read by pool on stop and overrun check
+        self.entry = None
+        self.started = None
+
+    def run(self):
+        while not self._pool.stopping:
+            try:
+                entry = self._pool.tasks.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+            self.started = monotonic()
+            self.entry = entry
+            try:
+                self._run_entry(entry)
+            except Exception, e:
+                # Worker must outlive any failure, otherwise pool shrinks silently
+                self.LOGGER.error("{} unexpected error running flow [{}]\n***{}".format(self.name, entry.job, e))
+            finally:
+                self.entry = None
+                self.started = None
+                self._pool.tasks.task_done()
+                self._pool.on_done(entry)
+
+    def _run_entry(self, entry):
+        flow = entry.job
+        connections = self._pool.connections
+        try:
+            connection = connections.acquire(flow.get_router_id())
+        except RouterUnavailable, e:
+            self.LOGGER.debug("{} skipping flow [{}], {}".format(self.name, flow, e))
+            return
+
+        labels = (flow.get_flow_name(), str(flow.get_router_id()))
+        time_start = monotonic()
+        handover = 0.0
+        rows = 0
+        try:
+            # get_api() may log in, its failure releases connection as unhealthy like any failed call
+            api = TimedApi(connection.get_api(), ROUTEROS_CALL_SECONDS.labels(*labels).observe)
+            # Jobs are handed over as flow produces them, connection is held until reply is consumed
+            for job in flow.execute(api):
+                if job['name'] == labels[0]:
+                    rows += len(job['payload'])
+                handover_start = monotonic()
+                self._pool.on_result(entry, job)
+                handover += monotonic() - handover_start
+        except Exception, e:
+            FLOW_FAILURES.labels(*labels).inc()
+            self.LOGGER.error("{} flow [{}] failed\n***{}".format(self.name, flow, e))
+            # Connection state is unknown after failed call, start fresh next time
+            connections.release(connection, healthy=False)
+            return
+
+        connections.release(connection)
+        # Transform is what is left after router calls and blocking on output queue
+        elapsed = monotonic() - time_start
+        FLOW_RUN_SECONDS.labels(*labels).observe(elapsed)
+        FLOW_TRANSFORM_SECONDS.labels(*labels).observe(max(elapsed - api.elapsed - handover, 0))
+        FLOW_ROWS.labels(*labels).observe(rows)
+
+
+class WorkerPool:
+    """
+    Bounded pool of worker threads running scheduled flow entries
+    Callbacks are called from worker threads. Run taking longer than task_timeout seconds (0 disables)
+    is reported by overrun(), owner decides what to do with the stuck worker.
+    """
+
+    def __init__(self, logger, name, size, connections, on_result, on_done, task_timeout=0):
+        self.LOGGER = logger
+        self.name = name
+        self.size = max(int(size), 1)
+        self.connections = connections
+        self.on_result = on_result
+        self.on_done = on_done
+        self.task_timeout = float(task_timeout)
+
+        self.tasks = Queue.Queue()
+        self.stopping = False
+        self._workers = []
+
+    def start(self):
+        for index in range(self.size):
+            worker = Worker(self, index)
+            worker.start()
+            self._workers.append(worker)
+        self.LOGGER.info("Started {} workers".format(self.size))
+
+    def submit(self, entry):
+        self.tasks.put(entry)
+
+    def overrun(self):
+        # (worker name, flow, seconds running) of runs past task_timeout
+        if not self.task_timeout:
+            return []
+        now = monotonic()
+        overrun = []
+        for worker in self._workers:
+            entry, started = worker.entry, worker.started
+            if entry is not None and started is not None and now - started > self.task_timeout:
+                overrun.append((worker.name, entry.job, now - started))
+        return overrun
+
+    def stop(self, timeout=10):
+        # Returns flows still running on workers that did not stop within timeout
+        self.stopping = True
+        for worker in self._workers:
+            worker.join(timeout)
+        running = [worker.entry.job for worker in self._workers if worker.is_alive() and worker.entry is not None]
+        self._workers = []
+        self.connections.close()
+        return running
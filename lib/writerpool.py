@@ -0,0 +1,274 @@
+from threading import Thread, Condition
+from zlib import crc32
+import Queue
+import MySQLdb
+from lib.clock import monotonic
+from lib.backoff import Backoff
+from lib.mysqlerrors import is_connection_error
+
+
+class _Completion:
+    # Waits for all partitions of one write to finish, collects jobs of failed partitions
+    def __init__(self, partitions):
+        self._pending = dict(partitions)
+        self._condition = Condition()
+        self.failed = []
+
+    def done(self, index, jobs, error):
+        with self._condition:
+            # Partition given up on by wait() was already counted as failed
+            if self._pending.pop(index, None) is None:
+                return
+            if error:
+                self.failed.extend(jobs)
+            self._condition.notify_all()
+
+    def wait(self, timeout=0):
+        # Partitions not done within timeout (0 waits for all) are counted as failed
+        end = monotonic() + timeout
+        with self._condition:
+            while self._pending and (not timeout or monotonic() < end):
+                self._condition.wait(1 if not timeout else min(max(end - monotonic(), 0.01), 1))
+            for jobs in self._pending.values():
+                self.failed.extend(jobs)
+            self._pending = {}
+
+
+class MySQLWriter(Thread):
+    """
+    Writer worker with its own MySQL connection
+    Connection is pinged after health_check_interval idle seconds and reconnected with jittered
+    exponential backoff while down. With a spool, partitions submitted meanwhile are kept in it and
+    later ones queue behind them until they are replayed, without one they fail right away.
+    """
+
+    def __init__(self, logger, index, connect, write, health_check_interval=30, reconnect_initial=1,
+                 reconnect_max=60, spool=None, set_aside=None, max_write_retries=5, replay_jobs=100):
+        Thread.__init__(self)
+        self.daemon = True
+        self.name = 'MySQLWriter-{}'.format(index)
+        self.index = index
+        self.LOGGER = logger
+        self._connect = connect
+        self._write = write
+        self._health_check_interval = float(health_check_interval)
+        self._backoff = Backoff(reconnect_initial, reconnect_max)
+        self._tasks = Queue.Queue()
+        self._db_client = None
+        self._last_used = 0
+        self._next_connect_attempt = 0
+        self._spool = spool
+        # Spooled partition that loses the connection this many times in a row is set aside
+        self._set_aside = set_aside
+        self._max_write_retries = int(max_write_retries)
+        self._replay_jobs = int(replay_jobs)
+        self._replay_attempts = 0
+        # Start of the MySQL call in progress, read by pool overrun check
+        self.busy_since = None
+        self.wantRunning = True
+
+    @property
+    def connected(self):
+        return self._db_client is not None
+
+    @property
+    def spooling(self):
+        return self._spool is not None
+
+    def _backlog(self):
+        return self._spool is not None and not self._spool.empty()
+
+    def submit(self, jobs, completion):
+        self._tasks.put((jobs, completion))
+
+    def _disconnect(self):
+        try:
+            self._db_client.close()
+        except Exception, e:
+            self.LOGGER.error("{} error disconnecting MySQL DB\n***{}".format(self.name, e))
+        self._db_client = None
+        self._next_connect_attempt = monotonic() + self._backoff.next_delay()
+
+    def _ensure_connection(self):
+        if self._db_client and monotonic() - self._last_used > self._health_check_interval:
+            try:
+                self._db_client.ping()
+                self._last_used = monotonic()
+            except Exception, e:
+                self.LOGGER.warning("{} health check failed\n***{}".format(self.name, e))
+                self._disconnect()
+
+        if not self._db_client and monotonic() >= self._next_connect_attempt:
+            try:
+                self._db_client = self._connect()
+                self._last_used = monotonic()
+                self._backoff.reset()
+                self.LOGGER.info("{} connected to MySQL DB".format(self.name))
+            except Exception, e:
+                delay = self._backoff.next_delay()
+                self._next_connect_attempt = monotonic() + delay
+                self.LOGGER.error("{} error connecting to MySQL DB, trying again in {:.1f} seconds\n***{}".format(
+                    self.name, delay, e))
+
+    def _spool_jobs(self, jobs):
+        for job in jobs:
+            self._spool.append(job)
+
+    def _replay_spool(self):
+        jobs, position = self._spool.read(self._replay_jobs)
+        try:
+            self._write(self._db_client, jobs)
+            self._last_used = monotonic()
+        except Exception, e:
+            if is_connection_error(e):
+                self._replay_attempts += 1
+                self.LOGGER.error("{} lost MySQL connection replaying {} jobs\n***{}".format(self.name, len(jobs), e))
+                self._disconnect()
+                if self._replay_attempts < self._max_write_retries:
+                    return
+                self._set_aside(jobs, self._replay_attempts)
+            else:
+                self.LOGGER.error("{} unexpected error replaying {} jobs\n***{}".format(self.name, len(jobs), e))
+        else:
+            self.LOGGER.info("{} replayed {} jobs from spool".format(self.name, len(jobs)))
+        self._replay_attempts = 0
+        self._spool.commit(position)
+
+    def run(self):
+        while self.wantRunning:
+            try:
+                # Spooled partitions are replayed whenever no new one is waiting
+                jobs, completion = self._tasks.get(timeout=0 if self._db_client and self._backlog() else 1)
+            except Queue.Empty:
+                self.busy_since = monotonic()
+                self._ensure_connection()
+                if self._db_client and self._backlog():
+                    self._replay_spool()
+                self.busy_since = None
+                continue
+
+            self.busy_since = monotonic()
+            error = None
+            try:
+                if self._backlog():
+                    # Older partitions of the same tables are still spooled
+                    self._spool_jobs(jobs)
+                    continue
+                self._ensure_connection()
+                if not self._db_client:
+                    raise MySQLdb.OperationalError(2006, '{} not connected'.format(self.name))
+                self._write(self._db_client, jobs)
+                self._last_used = monotonic()
+            except Exception, e:
+                if is_connection_error(e):
+                    self.LOGGER.error("{} lost MySQL connection writing {} jobs\n***{}".format(self.name, len(jobs), e))
+                    if self._db_client:
+                        self._disconnect()
+                    if self._spool:
+                        self.LOGGER.warning("{} spooling {} jobs until reconnect".format(self.name, len(jobs)))
+                        self._spool_jobs(jobs)
+                    else:
+                        error = e
+                else:
+                    # Same as single connection writer, jobs that can't be written are dropped
+                    self.LOGGER.error("{} unexpected error writing {} jobs\n***{}".format(self.name, len(jobs), e))
+            finally:
+                self.busy_since = None
+                completion.done(self.index, jobs, error)
+
+        if self._db_client:
+            self._disconnect()
+        if self._spool:
+            self._spool.close()
+
+
+class WriterPool:
+    """
+    Parallel MySQL writers
+    Jobs are routed to writers by target table, so each table is written by one connection in order.
+    Flows routed by key have their rows split by key hash instead, keeping order per key.
+    create_spool(index) gives a writer its own spool, so one writer being down doesn't stop the others.
+    Writer busy in one MySQL call for over write_timeout seconds (0 disables) is reported by overrun(),
+    write() counts its partition as failed instead of waiting for it.
+    """
+
+    def __init__(self, logger, size, statements, connect, write, health_check_interval=30, reconnect_initial=1,
+                 reconnect_max=60, create_spool=None, set_aside=None, max_write_retries=5, replay_jobs=100,
+                 write_timeout=0):
+        self.LOGGER = logger
+        self._statements = statements
+        self._write_timeout = float(write_timeout)
+        self._writers = [MySQLWriter(logger, index, connect, write, health_check_interval, reconnect_initial,
+                                     reconnect_max, create_spool and create_spool(index), set_aside,
+                                     max_write_retries, replay_jobs)
+                         for index in range(size)]
+
+    def start(self):
+        for writer in self._writers:
+            writer.start()
+
+    def stop(self, timeout=10):
+        for writer in self._writers:
+            writer.wantRunning = False
+        for writer in self._writers:
+            writer.join(timeout)
+
+    def overrun(self):
+        # (writer name, seconds busy) of writers stuck in a MySQL call
+        if not self._write_timeout:
+            return []
+        now = monotonic()
+        overrun = []
+        for writer in self._writers:
+            busy_since = writer.busy_since
+            if busy_since is not None and now - busy_since > self._write_timeout:
+                overrun.append((writer.name, now - busy_since))
+        return overrun
+
+    def connected(self):
+        # Writer without spool can only fail its partitions, then the pool as a whole is down
+        return any(writer.connected for writer in self._writers) and \
+            all(writer.connected or writer.spooling for writer in self._writers)
+
+    def _writer_index(self, value):
+        return (crc32(str(value)) & 0xffffffff) % len(self._writers)
+
+    @staticmethod
+    def _part(split, index, job):
+        part = split.get(index)
+        if part is None:
+            part = split[index] = dict(job, payload=[], deleted=[])
+            if job.get('batch_id') is not None:
+                part['batch_id'] = '{}/{}'.format(job['batch_id'], index)
+        return part
+
+    def _partition(self, jobs):
+        partitions = {}
+        for job in jobs:
+            statement = self._statements[job['name']]
+            if statement.route_key is None:
+                partitions.setdefault(self._writer_index(statement.mysql_table), []).append(job)
+                continue
+
+            # Split rows and deleted keys of job by key hash, every part gets its own batch id
+            split = {}
+            for row in job['payload']:
+                index = self._writer_index(row[statement.route_key])
+                self._part(split, index, job)['payload'].append(row)
+            for key in job.get('deleted') or ():
+                index = self._writer_index(key[0])
+                self._part(split, index, job)['deleted'].append(key)
+            for index, part in split.items():
+                partitions.setdefault(index, []).append(part)
+        return partitions
+
+    def write(self, jobs):
+        """
+        Write jobs on all writers in parallel and wait for them, returns jobs of partitions that failed
+        """
+        partitions = self._partition(jobs)
+        completion = _Completion(partitions)
+        for index, partition in partitions.items():
+            self._writers[index].submit(partition, completion)
+        completion.wait(self._write_timeout)
+        return completion.failed
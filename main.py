@@ -2,28 +2,146 @@ from lib.logger import get_logger
 from threads.MikrotikScrapper import MikrotikScrapper
 from threads.Database import Database
 from threads.APCScrapper import APCScrapper
-from time import sleep
-import Queue
+from threads.Maintenance import Maintenance
+from lib.statements import compile_statements
+from lib.rollup import rollup_flows
+from lib.jobqueue import JobQueue, DEFAULT_PRIORITY, POLICY_BLOCK
+from lib.spool import Spool
+from lib.shmring import SharedRing, RingWriter, RingReader
+from lib.processes import ComponentProcess
+from lib.changes import DropNotices
+from lib.supervisor import Supervisor, Component, restart_policy
+from lib.metrics import MetricsServer, QUEUE_JOBS, QUEUE_BYTES, SPOOL_BYTES
+from etc import config
+import multiprocessing
 import signal
+import Queue
 
 run_loop = True
 
 
-def run():
-    global run_loop
-    # Will be filled by mikrotik/apcScrapper and saved by database thread
-    database_input_queue = Queue.Queue()
+def create_writer_components(logger, ring=None, drop_notices=None):
+    # SQL for every flow is built and checked once, jobs of unknown flows are rejected by the queue
+    # Rollup tables are written like any other flow
+    output_flows = config.flows + rollup_flows(config.flows)
+    statements = compile_statements(logger, output_flows)
+
+    # Optional on-disk spool used by database thread while MySQL is unavailable
+    spool = None
+    spool_config = getattr(config, 'spool', None)
+    if spool_config:
+        spool = Spool(logger,
+                      spool_config['location'],
+                      spool_config.get('segment_size', 16 * 1024 * 1024),
+                      spool_config.get('max_size', 1024 * 1024 * 1024),
+                      spool_config.get('fsync', False))
 
-    # Initialize threads
-    threads = [
-        Database(database_input_queue),
-        MikrotikScrapper(database_input_queue)
-        #APCScrapper(database_input_queue)
+    # Will be filled by mikrotik/apcScrapper and saved by database thread
+    # Bounded by job count and memory, latency sensitive flows are served first
+    # Dropped jobs are reported to scrapers so their flows resync change detection
+    on_drop = drop_notices.dropped if drop_notices else None
+    queue_config = getattr(config, 'queue', None) or {}
+    flow_priorities = dict((flow['name'], flow.get('priority', DEFAULT_PRIORITY))
+                           for flow in output_flows if flow['name'] in statements)
+    database_input_queue = JobQueue(logger,
+                                    flow_priorities,
+                                    queue_config.get('max_jobs', 1000),
+                                    queue_config.get('max_bytes', 256 * 1024 * 1024),
+                                    queue_config.get('policy', POLICY_BLOCK),
+                                    spool,
+                                    on_drop)
+
+    # Read when metrics are scraped
+    QUEUE_JOBS.set_callback(lambda: {(): database_input_queue.qsize()})
+    QUEUE_BYTES.set_callback(lambda: {(): database_input_queue.bytes()})
+    if spool:
+        SPOOL_BYTES.set_callback(lambda: {(): spool.size()})
+
+    # Restarted database thread takes over jobs its failed predecessor did not write
+    # Database is stopped last (stage 1) so it can drain what the others left in queue
+    # Input queue and spool can't be shared with a stuck predecessor, it has to exit first
+    components = [Component('Database',
+                            lambda previous: Database(database_input_queue, statements, spool,
+                                                      previous.unwritten_jobs() if previous else None, on_drop),
+                            dict({'exclusive': True}, **restart_policy('Database')), stage=1)]
+    # Optional downsampling and retention of stored tables
+    if getattr(config, 'maintenance', None):
+        components.append(Component('Maintenance',
+                                    lambda previous: Maintenance(database_input_queue),
+                                    restart_policy('Maintenance')))
+    # In process mode jobs arrive from scraper process through shared memory ring
+    if ring:
+        components.append(Component('RingReader',
+                                    lambda previous: RingReader(logger, ring, database_input_queue,
+                                                                queue_config.get('put_timeout'), on_drop),
+                                    restart_policy('RingReader')))
+    return components, database_input_queue
+
+
+def create_scraper_components(output_queue, drop_notices=None):
+    return [
+        Component('MikrotikScrapper', lambda previous: MikrotikScrapper(output_queue, drop_notices),
+                  restart_policy('MikrotikScrapper'))
+        #Component('APCScrapper', lambda previous: APCScrapper(output_queue), restart_policy('APCScrapper'))
     ]
 
+
+def create_metrics_components(logger, port_offset=0):
+    # Optional Prometheus endpoint, config.metrics = {'enabled': True, 'host': '127.0.0.1', 'port': 9108}
+    # In process mode metrics are per process, writer process serves on port and scraper process on port + 1
+    metrics_config = getattr(config, 'metrics', None) or {}
+    if not metrics_config.get('enabled'):
+        return []
+    return [Component('MetricsServer',
+                      lambda previous: MetricsServer(logger,
+                                                     metrics_config.get('host', '127.0.0.1'),
+                                                     metrics_config.get('port', 9108) + port_offset),
+                      # Metrics are not worth stopping ingest for, server is retried instead of giving up
+                      dict({'fatal': False}, **restart_policy('MetricsServer')))]
+
+
+def create_supervisor():
+    # Threads of one process by default, in process mode scrapers and writer get a process each
+    # so classification and DB encoding don't share one GIL
+    process_config = getattr(config, 'process_mode', None) or {}
+    if not process_config.get('enabled'):
+        supervisor = Supervisor(logger)
+        drop_notices = DropNotices(Queue.Queue())
+        components, database_input_queue = create_writer_components(logger, drop_notices=drop_notices)
+        for component in components + create_scraper_components(database_input_queue, drop_notices) + \
+                create_metrics_components(logger):
+            supervisor.add(component)
+        return supervisor
+
+    # Child processes report heartbeats to main through process safe queue
+    # and log to their own Main-<component> file, see ComponentProcess.run
+    ring = SharedRing(process_config.get('ring_size', 64 * 1024 * 1024))
+    # Drops in writer process are reported to scraper process through process safe queue
+    drop_notices = DropNotices(multiprocessing.Queue())
+    supervisor = Supervisor(logger, multiprocessing.Queue())
+    supervisor.add(Component('Database',
+                             lambda previous: ComponentProcess(logger, 'Database',
+                                                               lambda child_logger:
+                                                               create_writer_components(child_logger, ring,
+                                                                                        drop_notices)[0] +
+                                                               create_metrics_components(child_logger)),
+                             restart_policy('Database'), stage=1))
+    supervisor.add(Component('MikrotikScrapper',
+                             lambda previous: ComponentProcess(logger, 'MikrotikScrapper',
+                                                               lambda child_logger:
+                                                               create_scraper_components(RingWriter(ring),
+                                                                                         drop_notices) +
+                                                               create_metrics_components(child_logger, 1)),
+                             restart_policy('MikrotikScrapper')))
+    return supervisor
+
+
+def run():
+    global run_loop
+    supervisor = create_supervisor()
+
     # Start threads
-    for thread in threads:
-        thread.start()
+    supervisor.start()
 
     logger.info("Threads started")
 
@@ -37,40 +155,31 @@ def run():
             # Check if shutdown event is triggered, cleanup threads and exit loop
             if not run_loop:
                 logger.info("Received shutdown event, cleaning up")
-                cleanup_threads(threads)
+                cleanup_threads(supervisor)
                 break
 
-            # Check if threads are alive and well
-            for thread in threads:
-                try:
-                    if not thread.running:
-                        logger.warning("{} thread not running, triggering shutdown event".format(thread.__class__.__name__))
-                        raise Exception
-                except Exception:
-                    run_loop = False
-                    continue
-
-            # Everything ok with threads, just print message
-            logger.debug("Running...")
-            sleep(5)
+            # Failed components are restarted by supervisor while others keep running,
+            # shutdown only when one of them keeps failing
+            if not supervisor.poll(1):
+                logger.warning("Component could not be restarted, triggering shutdown event")
+                run_loop = False
+                continue
 
         except KeyboardInterrupt:
             logger.warning("Got keyboard shutdown event")
-            cleanup_threads(threads)
+            cleanup_threads(supervisor)
             break
         except Exception, e:
             logger.warning("Got unknown shutdown event [{}]".format(e))
-            cleanup_threads(threads)
+            cleanup_threads(supervisor)
             break
 
 
-def cleanup_threads(threads):
+def cleanup_threads(supervisor):
+    # Producers stop first, then database writes what is queued within drain timeout and spools the rest
     logger.info("Cleaning up")
-    for thread in threads:
-        thread.wantRunning = False
-        logger.info("Joining {}".format(thread.__class__.__name__))
-        thread.join(10)
-        logger.info("Thread {} joined".format(thread.__class__.__name__))
+    shutdown_config = getattr(config, 'shutdown', None) or {}
+    supervisor.shutdown(shutdown_config.get('join_timeout', 10), shutdown_config.get('drain_timeout', 30))
 
 
 def shutdown_loop(signo, stack_frame):
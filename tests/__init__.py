@@ -0,0 +1,17 @@
+import logging
+import sys
+import types
+
+# Modules under test import etc/config.py of the deployment, tests run without one
+try:
+    import etc.config
+except ImportError:
+    etc = types.ModuleType('etc')
+    etc.config = types.ModuleType('etc.config')
+    sys.modules['etc'] = etc
+    sys.modules['etc.config'] = etc.config
+
+# Logger passed to components under test, records are not shown
+LOGGER = logging.getLogger('tests')
+LOGGER.addHandler(logging.NullHandler())
+LOGGER.propagate = False
@@ -0,0 +1,121 @@
+from lib.routeros.protocol import SentenceParser, encode_sentence, parse_sentence
+from threading import Thread, Lock, Event
+import socket
+
+
+class FakeRouter(Thread):
+    """
+    Local RouterOS API server for tests
+    Speaks the wire protocol: plain /login, tagged commands answered from responses
+    ({'/ip/address/print': [{'address': ...}, ...]}), /cancel. Unknown commands get !trap.
+    Every received sentence is kept in received.
+    """
+
+    def __init__(self, username='api', password='secret', responses=None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.username = username
+        self.password = password
+        self.responses = responses or {}
+        self.received = []
+        self.closed = 0
+
+        self._lock = Lock()
+        self._closed_event = Event()
+        self._clients = []
+        self._stopping = False
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(5)
+        self._server.settimeout(0.1)
+        self.port = self._server.getsockname()[1]
+
+    def router(self, **kwargs):
+        # Router config for ApiEngine.connect
+        router = {'id': 'fake', 'host': '127.0.0.1', 'port': self.port,
+                  'username': self.username, 'password': self.password}
+        router.update(kwargs)
+        return router
+
+    def wait_closed(self, count=1, timeout=5):
+        # Waits until count client connections were closed by the client
+        while True:
+            with self._lock:
+                if self.closed >= count:
+                    return True
+                self._closed_event.clear()
+            if not self._closed_event.wait(timeout):
+                return False
+
+    def stop(self):
+        self._stopping = True
+        self.join(5)
+        for client in self._clients:
+            try:
+                client.close()
+            except socket.error:
+                pass
+        self._server.close()
+
+    def run(self):
+        while not self._stopping:
+            try:
+                client, address = self._server.accept()
+            except socket.timeout:
+                continue
+            self._clients.append(client)
+            thread = Thread(target=self._serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, client):
+        parser = SentenceParser()
+        logged_in = False
+        try:
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                for words in parser.feed(data):
+                    with self._lock:
+                        self.received.append(words)
+                    logged_in = self._reply(client, words, logged_in)
+        except socket.error:
+            pass
+        with self._lock:
+            self.closed += 1
+            self._closed_event.set()
+
+    def _reply(self, client, words, logged_in):
+        command, tag, attributes = parse_sentence(words)
+        tag_words = ['.tag={}'.format(tag)] if tag is not None else []
+
+        if command == '/login':
+            if attributes.get('name') == self.username and attributes.get('password') == self.password:
+                client.sendall(encode_sentence(['!done'] + tag_words))
+                return True
+            client.sendall(encode_sentence(['!trap', '=message=invalid user name or password (6)'] + tag_words))
+            client.sendall(encode_sentence(['!done'] + tag_words))
+            return logged_in
+
+        if not logged_in:
+            client.sendall(encode_sentence(['!fatal', 'not logged in']))
+            client.close()
+            return logged_in
+
+        if command == '/cancel':
+            client.sendall(encode_sentence(['!done'] + tag_words))
+            return logged_in
+
+        if command not in self.responses:
+            client.sendall(encode_sentence(['!trap', '=message=no such command'] + tag_words))
+            client.sendall(encode_sentence(['!done'] + tag_words))
+            return logged_in
+
+        data = ''
+        for row in self.responses[command]:
+            data += encode_sentence(['!re'] + ['={}={}'.format(key, value) for key, value in sorted(row.items())] +
+                                    tag_words)
+        client.sendall(data + encode_sentence(['!done'] + tag_words))
+        return logged_in
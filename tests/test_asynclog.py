@@ -0,0 +1,74 @@
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from lib.asynclog import AsyncLogHandler
+
+
+class TestAsyncLogHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.handlers = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            handler.close()
+        shutil.rmtree(self.location)
+
+    def logger(self, name, **kw):
+        handler = AsyncLogHandler(os.path.join(self.location, name), **kw)
+        self.handlers.append(handler)
+        logger = logging.getLogger('tests.asynclog.{}'.format(name))
+        logger.propagate = False
+        logger.handlers = [handler]
+        logger.setLevel(logging.INFO)
+        return logger, handler
+
+    def wait_for(self, path):
+        end = time.time() + 2
+        while not os.path.exists(path) and time.time() < end:
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(path))
+
+    def test_records_written_in_order(self):
+        logger, handler = self.logger('Order')
+        for index in range(100):
+            logger.info('record %d', index)
+        handler.flush()
+        with open(os.path.join(self.location, 'Order')) as log:
+            self.assertEqual(log.read().splitlines(), ['record {}'.format(index) for index in range(100)])
+
+    def test_rotated_file_is_compressed(self):
+        logger, handler = self.logger('Rotate', max_bytes=100, backups=2)
+        # Size is checked after each write, flush makes every record a write of its own
+        for index in range(5):
+            logger.info('%s', str(index) * 60)
+            handler.flush()
+        self.wait_for(os.path.join(self.location, 'Rotate.2.gz'))
+        # Two records fill a file, newest backup is .1
+        backup = lambda name: gzip.open(os.path.join(self.location, name)).read().splitlines()
+        self.assertEqual(backup('Rotate.1.gz'), ['2' * 60, '3' * 60])
+        self.assertEqual(backup('Rotate.2.gz'), ['0' * 60, '1' * 60])
+        self.assertFalse(os.path.exists(os.path.join(self.location, 'Rotate.3.gz')))
+
+    def test_forked_child_writes_with_own_writer(self):
+        logger, handler = self.logger('Fork')
+        logger.info('parent')
+        handler.flush()
+        pid = os.fork()
+        if not pid:
+            # Parent's writer thread doesn't exist in child
+            logger.info('child')
+            handler.flush()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        with open(os.path.join(self.location, 'Fork')) as log:
+            self.assertEqual(log.read().splitlines(), ['parent', 'child'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from lib.backoff import Backoff
+
+try:
+    import MySQLdb
+    from lib.mysqlerrors import is_connection_error
+except ImportError:
+    MySQLdb = None
+
+
+class TestBackoff(unittest.TestCase):
+
+    def test_ceiling_doubles_up_to_maximum(self):
+        backoff = Backoff(1, 10, jitter=False)
+        self.assertEqual([backoff.next_delay() for attempt in range(6)], [1, 2, 4, 8, 10, 10])
+
+    def test_reset(self):
+        backoff = Backoff(1, 10, jitter=False)
+        backoff.next_delay()
+        backoff.next_delay()
+        backoff.reset()
+        self.assertEqual(backoff.failures, 0)
+        self.assertEqual(backoff.next_delay(), 1)
+
+    def test_jitter_stays_within_bounds(self):
+        backoff = Backoff(2, 16)
+        for attempt in range(10):
+            ceiling = min(2 * 2 ** attempt, 16)
+            delay = backoff.next_delay()
+            self.assertTrue(1 <= delay <= ceiling, (attempt, delay))
+
+
+@unittest.skipIf(MySQLdb is None, 'MySQLdb is not installed')
+class TestConnectionErrors(unittest.TestCase):
+
+    def test_lost_connection(self):
+        self.assertTrue(is_connection_error(MySQLdb.OperationalError(2006, 'MySQL server has gone away')))
+        self.assertTrue(is_connection_error(MySQLdb.OperationalError(2013, 'Lost connection to MySQL server')))
+
+    def test_statement_errors_are_not_retried(self):
+        self.assertFalse(is_connection_error(MySQLdb.OperationalError(1054, "Unknown column 'x'")))
+        self.assertFalse(is_connection_error(MySQLdb.OperationalError(1213, 'Deadlock found')))
+        self.assertFalse(is_connection_error(MySQLdb.Error(2006, 'Not an OperationalError')))
+        self.assertFalse(is_connection_error(MySQLdb.OperationalError()))
+
+
+if __name__ == '__main__':
+    unittest.main()
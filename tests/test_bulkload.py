@@ -0,0 +1,24 @@
+import os
+import unittest
+from lib.bulkload import tsv_value, write_tsv
+
+
+class TestBulkLoad(unittest.TestCase):
+
+    def test_values_are_escaped(self):
+        self.assertEqual(tsv_value(None), '\\N')
+        self.assertEqual(tsv_value('a\tb\nc\\'), 'a\\tb\\nc\\\\')
+        self.assertEqual(tsv_value(u'\xe9'), '\xc3\xa9')
+        self.assertEqual(tsv_value(0.1), '0.1')
+
+    def test_rows_written_one_per_line(self):
+        path = write_tsv([(1, 'x'), (2, None)])
+        try:
+            with open(path, 'rb') as data:
+                self.assertEqual(data.read(), '1\tx\n2\t\\N\n')
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
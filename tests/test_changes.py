@@ -0,0 +1,108 @@
+import Queue
+import multiprocessing
+import time
+import unittest
+from lib.changes import ChangeDetector, DropNotices
+from lib.flow import Flow
+from lib.jobqueue import JobQueue, POLICY_DROP_OLDEST
+from lib.shmring import SharedRing, RingWriter, RingReader
+from tests import LOGGER
+
+LEASES = {'name': 'dhcp_server_leases',
+          'params': ['mac', 'address', 'host', 'name', 'color', 'status'],
+          'run_interval': 10,
+          'mysql_type': 'insert',
+          'mysql_table': 'leases',
+          'columnar': False,
+          'change_detection': {'primary_key': 'mac'}}
+
+
+class _LeaseFlow(Flow):
+    # Router reply replaced by rows set by test
+
+    rows = ()
+
+    def dhcp_server_leases(self, client):
+        return iter(self.rows)
+
+
+def lease(mac, status=1):
+    return (mac, '10.0.0.1', 'host', 'name', '#44dddd', status)
+
+
+def run_rows(flow):
+    return [row for job in flow.execute(None) for row in job['payload']]
+
+
+class TestChangeDetector(unittest.TestCase):
+
+    def test_passes_new_and_changed_rows_only(self):
+        detector = ChangeDetector(0)
+        self.assertEqual(list(detector.filter([('a', 1), ('b', 1)])), [('a', 1), ('b', 1)])
+        detector.finish()
+        self.assertEqual(list(detector.filter([('a', 1), ('b', 2)])), [('b', 2)])
+        self.assertEqual((detector.passed, detector.suppressed), (1, 1))
+
+    def test_reports_removed_keys(self):
+        detector = ChangeDetector(0)
+        list(detector.filter([('a', 1), ('b', 1)]))
+        detector.finish()
+        list(detector.filter([('a', 1)]))
+        self.assertEqual(detector.finish(), ['b'])
+
+    def test_invalidate_passes_all_rows_and_keeps_removals(self):
+        detector = ChangeDetector(0)
+        list(detector.filter([('a', 1), ('b', 1)]))
+        detector.finish()
+        detector.invalidate()
+        self.assertEqual(list(detector.filter([('a', 1)])), [('a', 1)])
+        self.assertEqual(detector.finish(), ['b'])
+
+
+class TestDropNotices(unittest.TestCase):
+
+    def setUp(self):
+        self.flow = _LeaseFlow(LOGGER, LEASES, 'r1')
+        self.flow.rows = [lease('aa'), lease('bb')]
+        self.other = _LeaseFlow(LOGGER, LEASES, 'r2')
+
+    def test_queue_drop_resyncs_flow(self):
+        notices = DropNotices(Queue.Queue())
+        queue = JobQueue(LOGGER, {'dhcp_server_leases': 'bulk', 'alerts': 'high'}, max_jobs=1,
+                         policy=POLICY_DROP_OLDEST, on_drop=notices.dropped)
+        for job in self.flow.execute(None):
+            queue.put(job)
+        # Unchanged rows are suppressed while nothing was dropped
+        self.assertEqual(run_rows(self.flow), [])
+
+        queue.put({'name': 'alerts', 'payload': [(1,)]})
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(notices.resync([self.flow, self.other]), [self.flow])
+        self.assertEqual(run_rows(self.flow), self.flow.rows)
+        # One resync per drop
+        self.assertEqual(notices.resync([self.flow, self.other]), [])
+        self.assertEqual(run_rows(self.flow), [])
+
+    def test_ring_drop_resyncs_flow(self):
+        notices = DropNotices(multiprocessing.Queue())
+        queue = JobQueue(LOGGER, {'dhcp_server_leases': 'normal'}, max_jobs=1)
+        queue.put({'name': 'dhcp_server_leases', 'payload': []})
+        ring = SharedRing(64 * 1024)
+        writer = RingWriter(ring)
+        for job in self.flow.execute(None):
+            writer.put(job)
+        reader = RingReader(LOGGER, ring, queue, 0.01, notices.dropped)
+        reader._move(0)
+
+        # Notice goes through feeder thread of multiprocessing queue
+        end = time.time() + 3
+        resynced = []
+        while not resynced and time.time() < end:
+            resynced = notices.resync([self.flow, self.other])
+            time.sleep(0.01)
+        self.assertEqual(resynced, [self.flow])
+        self.assertEqual(run_rows(self.flow), self.flow.rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from lib.classifier import TrafficClassifier, parse_prefix, ip_to_int, int_to_ip, \
+    TRAFFIC_LOCAL, TRAFFIC_UPLOAD, TRAFFIC_DOWNLOAD, TRAFFIC_WAN
+
+
+class TestParsePrefix(unittest.TestCase):
+
+    def test_range_of_prefix(self):
+        self.assertEqual(parse_prefix('192.168.0.0/16'), (ip_to_int('192.168.0.0'), ip_to_int('192.168.255.255')))
+
+    def test_host_bits_are_masked(self):
+        self.assertEqual(parse_prefix('10.1.2.3/8'), (ip_to_int('10.0.0.0'), ip_to_int('10.255.255.255')))
+
+    def test_address_without_length(self):
+        self.assertEqual(parse_prefix('10.0.0.1'), (ip_to_int('10.0.0.1'), ip_to_int('10.0.0.1')))
+
+    def test_invalid_length(self):
+        self.assertRaises(Exception, parse_prefix, '10.0.0.0/33')
+
+    def test_int_round_trip(self):
+        self.assertEqual(int_to_ip(ip_to_int('172.16.5.4')), '172.16.5.4')
+
+
+class TestTrafficClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.classifier = TrafficClassifier(['192.168.0.0/24', '192.168.1.0/24', '10.0.0.0/8', '10.1.0.0/16'])
+
+    def test_overlapping_and_adjacent_ranges_are_merged(self):
+        self.assertEqual(len(self.classifier._starts), 2)
+
+    def test_is_local(self):
+        self.assertTrue(self.classifier.is_local('192.168.1.255'))
+        self.assertTrue(self.classifier.is_local('10.200.0.1'))
+        self.assertFalse(self.classifier.is_local('192.168.2.0'))
+        self.assertFalse(self.classifier.is_local('9.255.255.255'))
+
+    def test_non_ipv4_address_is_not_local(self):
+        self.assertFalse(self.classifier.is_local('fe80::1'))
+        self.assertFalse(self.classifier.is_local(None))
+
+    def test_classify(self):
+        classify = self.classifier.classify
+        self.assertEqual(classify('192.168.0.2', '10.0.0.3'), (TRAFFIC_LOCAL, '192.168.0.2'))
+        self.assertEqual(classify('192.168.0.2', '8.8.8.8'), (TRAFFIC_UPLOAD, '192.168.0.2'))
+        self.assertEqual(classify('8.8.8.8', '192.168.0.2'), (TRAFFIC_DOWNLOAD, '192.168.0.2'))
+        self.assertEqual(classify('8.8.8.8', '1.1.1.1'), (TRAFFIC_WAN, ''))
+
+    def test_classify_batch_extends_rows(self):
+        rows = [('192.168.0.2', '8.8.8.8', 100), ('8.8.8.8', '192.168.0.2', 200), ('192.168.0.2', '8.8.8.8', 300)]
+        self.assertEqual(list(self.classifier.classify_batch(rows)),
+                         [('192.168.0.2', '8.8.8.8', 100, TRAFFIC_UPLOAD, '192.168.0.2'),
+                          ('8.8.8.8', '192.168.0.2', 200, TRAFFIC_DOWNLOAD, '192.168.0.2'),
+                          ('192.168.0.2', '8.8.8.8', 300, TRAFFIC_UPLOAD, '192.168.0.2')])
+
+
+if __name__ == '__main__':
+    unittest.main()
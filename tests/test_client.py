@@ -0,0 +1,66 @@
+import unittest
+from lib.routeros.client import build_queries, stream, TimedApi
+
+
+class _Resource:
+    def __init__(self, replies):
+        self.replies = replies
+        self.calls = []
+
+    def get(self):
+        self.calls.append(('get',))
+        return list(self.replies)
+
+    def call(self, command, arguments=None, queries=None, additional_queries=()):
+        # Same as routeros_api, query objects are turned into words by get_api_format()
+        self.calls.append((command, arguments, queries,
+                           [word for query in additional_queries for word in query.get_api_format()]))
+        return list(self.replies)
+
+
+class _Api:
+    def __init__(self, resource):
+        self.resource = resource
+
+    def get_resource(self, path):
+        return self.resource
+
+
+class TestQueries(unittest.TestCase):
+
+    def test_dict_query(self):
+        self.assertEqual(build_queries({'status': 'bound', 'dynamic': 'yes'}), ['?dynamic=yes', '?status=bound'])
+
+    def test_raw_words_keep_order(self):
+        self.assertEqual(build_queries(['?type=ether', '?type=vlan', '?#|']), ['?type=ether', '?type=vlan', '?#|'])
+
+    def test_no_query(self):
+        self.assertEqual(build_queries(None), [])
+
+
+class TestStream(unittest.TestCase):
+
+    def test_plain_print_without_proplist_or_query(self):
+        resource = _Resource([{'name': 'ether1'}])
+        self.assertEqual(list(stream(resource)), [{'name': 'ether1'}])
+        self.assertEqual(resource.calls, [('get',)])
+
+    def test_proplist_and_raw_query_words(self):
+        resource = _Resource([{'name': 'ether1'}])
+        list(stream(resource, queries=['?type=ether', u'?type=vlan', '?#|'], proplist=('name', 'type')))
+        self.assertEqual(resource.calls, [('print', {'.proplist': 'name,type'}, {},
+                                           ['?type=ether', '?type=vlan', '?#|'])])
+        self.assertTrue(isinstance(resource.calls[0][3][1], str))
+
+    def test_timed_stream_counts_call_time(self):
+        observed = []
+        api = TimedApi(_Api(_Resource([{'name': 'ether1'}, {'name': 'ether2'}])), observed.append)
+        rows = list(stream(api.get_resource('/interface'), proplist=('name',)))
+        self.assertEqual(rows, [{'name': 'ether1'}, {'name': 'ether2'}])
+        # Whole reply is one observation
+        self.assertEqual(len(observed), 1)
+        self.assertEqual(api.elapsed, observed[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
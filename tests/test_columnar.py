@@ -0,0 +1,57 @@
+import marshal
+import unittest
+from lib.columnar import ColumnarBatch, encode_job, decode_job
+
+TYPES = ('float', 'str', 'ip', 'ip', 'int')
+ROWS = [(60.0, 'upload', '192.168.1.2', '8.8.8.8', 1500),
+        (60.0, 'wan', '1.1.1.1', '2.2.2.2', 40),
+        (60.0, 'upload', '192.168.1.2', '', 3000000000)]
+
+
+def batch(rows=ROWS):
+    payload = ColumnarBatch(TYPES)
+    for row in rows:
+        payload.append(row)
+    return payload
+
+
+class TestColumnarBatch(unittest.TestCase):
+
+    def test_rows_read_back_as_tuples(self):
+        payload = batch()
+        self.assertEqual(len(payload), 3)
+        self.assertEqual(list(payload), ROWS)
+        self.assertEqual(payload[1], ROWS[1])
+        self.assertEqual(payload[-1], ROWS[2])
+        self.assertEqual(payload[1:], ROWS[1:])
+
+    def test_unconvertible_values_are_kept(self):
+        payload = batch([(None, None, None, 'not an ip', 'x')])
+        self.assertEqual(payload[0], (None, None, None, 'not an ip', 'x'))
+
+    def test_flat_args(self):
+        self.assertEqual(batch().flat_args(1, 3), list(ROWS[1]) + list(ROWS[2]))
+
+    def test_strings_are_interned(self):
+        payload = batch(ROWS * 100)
+        self.assertEqual(len(payload._strings), 2)
+        self.assertTrue(payload.nbytes() < len(ROWS) * 100 * 5 * 8)
+
+    def test_wrong_row_length(self):
+        self.assertRaises(Exception, batch().append, (1.0, 'upload'))
+
+    def test_unknown_type(self):
+        self.assertRaises(Exception, ColumnarBatch, ('str', 'date'))
+
+    def test_job_survives_marshal(self):
+        job = {'name': 'lan_traffic_usage', 'payload': batch(), 'batch_id': 'run:0'}
+        decoded = decode_job(marshal.loads(marshal.dumps(encode_job(job), 2)))
+        self.assertEqual(decoded['batch_id'], 'run:0')
+        self.assertEqual(list(decoded['payload']), ROWS)
+        # Row payload is passed through as is
+        rows_job = {'name': 'leases', 'payload': [('a', 1)]}
+        self.assertEqual(decode_job(encode_job(rows_job)), rows_job)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from lib.connections import ConnectionManager, RouterUnavailable
+from tests import LOGGER
+
+ROUTERS = [{'id': 'r1', 'host': '10.0.0.1'}, {'id': 'r2', 'host': '10.0.0.2'}]
+
+
+class _Client:
+    def __init__(self, login_error=None):
+        self.connected = True
+        self.disconnected = False
+        self._login_error = login_error
+
+    def get_api(self):
+        if self._login_error:
+            raise self._login_error
+        return self
+
+    def disconnect(self):
+        self.connected = False
+        self.disconnected = True
+
+
+class TestConnectionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = []
+        self.login_error = None
+
+    def factory(self, router):
+        client = _Client(self.login_error)
+        self.clients.append(client)
+        return client
+
+    def manager(self, **kwargs):
+        return ConnectionManager(LOGGER, ROUTERS, self.factory, acquire_timeout=0.05, **kwargs)
+
+    def test_idle_connection_is_reused(self):
+        manager = self.manager()
+        connection = manager.acquire('r1')
+        manager.release(connection)
+        self.assertTrue(manager.acquire('r1') is connection)
+        self.assertEqual(len(self.clients), 1)
+
+    def test_connections_are_bounded_per_router(self):
+        manager = self.manager(max_connections=2)
+        manager.acquire('r1')
+        manager.acquire('r1')
+        self.assertRaises(RouterUnavailable, manager.acquire, 'r1')
+        # Other router has its own limit
+        manager.acquire('r2')
+
+    def test_unhealthy_release_disconnects(self):
+        manager = self.manager()
+        connection = manager.acquire('r1')
+        manager.release(connection, healthy=False)
+        self.assertTrue(self.clients[0].disconnected)
+        self.assertFalse(manager.acquire('r1') is connection)
+
+    def test_failed_login_disconnects_and_backs_off(self):
+        self.login_error = Exception('invalid user name or password')
+        manager = self.manager(backoff_initial=60, backoff_max=60)
+        self.assertRaises(RouterUnavailable, manager.acquire, 'r1')
+        self.assertTrue(self.clients[0].disconnected)
+        # Router in backoff is not connected again
+        self.assertRaises(RouterUnavailable, manager.acquire, 'r1')
+        self.assertEqual(len(self.clients), 1)
+
+    def test_all_failing(self):
+        self.login_error = Exception('connection refused')
+        manager = self.manager(backoff_initial=0, backoff_max=0)
+        for attempt in range(2):
+            for router in ROUTERS:
+                self.assertRaises(RouterUnavailable, manager.acquire, router['id'])
+        self.assertTrue(manager.all_failing(1))
+        self.assertFalse(manager.all_failing(2))
+
+    def test_multiplexed_connection_is_shared(self):
+        manager = self.manager(multiplexed=True)
+        first = manager.acquire('r1')
+        second = manager.acquire('r1')
+        self.assertTrue(first is second)
+        # Failed request keeps shared connection, broken connection is replaced
+        manager.release(first, healthy=False)
+        self.assertTrue(manager.acquire('r1') is first)
+        first.disconnect()
+        manager.release(first)
+        self.assertFalse(manager.acquire('r1') is first)
+
+    def test_close_disconnects_idle(self):
+        manager = self.manager()
+        manager.release(manager.acquire('r1'))
+        manager.close()
+        self.assertTrue(self.clients[0].disconnected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+from lib.dedupe import RecentBatches
+
+
+class TestRecentBatches(unittest.TestCase):
+
+    def test_seen_after_add(self):
+        batches = RecentBatches(10)
+        self.assertFalse(batches.seen('run:1'))
+        batches.add(['run:1', 'run:2'])
+        self.assertTrue(batches.seen('run:1'))
+        self.assertTrue(batches.seen('run:2'))
+
+    def test_least_recently_used_is_evicted(self):
+        batches = RecentBatches(2)
+        batches.add(['a', 'b'])
+        # Lookup refreshes 'a', so 'b' is the oldest one
+        self.assertTrue(batches.seen('a'))
+        batches.add(['c'])
+        self.assertTrue(batches.seen('a'))
+        self.assertFalse(batches.seen('b'))
+        self.assertTrue(batches.seen('c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
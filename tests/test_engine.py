@@ -0,0 +1,87 @@
+import os
+import threading
+import unittest
+from lib.routeros.client import stream
+from lib.routeros.engine import ApiEngine, ApiError, ConnectionClosed
+from tests import LOGGER
+from tests.fake_routeros import FakeRouter
+
+ADDRESSES = [{'.id': '*{}'.format(index), 'address': '10.0.0.{}/24'.format(index), 'interface': 'ether1'}
+             for index in range(1, 51)]
+
+
+class TestApiEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.router = FakeRouter(responses={'/ip/address/print': ADDRESSES})
+        self.router.start()
+        self.engine = ApiEngine(LOGGER, connect_timeout=5, request_timeout=5)
+        self.engine.start()
+
+    def tearDown(self):
+        self.engine.stop()
+        self.engine.join(5)
+        self.router.stop()
+
+    def test_call(self):
+        connection = self.engine.connect(self.router.router())
+        rows = connection.get_api().get_resource('/ip/address').get()
+        self.assertEqual(len(rows), 50)
+        self.assertEqual(rows[0]['id'], '*1')
+        self.assertEqual(rows[0]['address'], '10.0.0.1/24')
+
+    def test_stream_sends_proplist_and_queries_in_order(self):
+        connection = self.engine.connect(self.router.router())
+        resource = connection.get_api().get_resource('/ip/address')
+        rows = list(stream(resource, max_buffered=5, queries=['?interface=ether1', '?disabled=no', '?#&'],
+                           proplist=['address']))
+        self.assertEqual(len(rows), 50)
+        sentence = [words for words in self.router.received if words[0] == '/ip/address/print'][0]
+        self.assertEqual(sentence[1:5], ['=.proplist=address', '?interface=ether1', '?disabled=no', '?#&'])
+
+    def test_concurrent_requests_share_connection(self):
+        connection = self.engine.connect(self.router.router())
+        results = []
+
+        def call():
+            results.append(len(connection.call('/ip/address/print')))
+
+        threads = [threading.Thread(target=call) for index in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [50] * 10)
+
+    def test_trap_fails_request_only(self):
+        connection = self.engine.connect(self.router.router())
+        self.assertRaises(ApiError, connection.call, '/no/such/print')
+        self.assertEqual(len(connection.call('/ip/address/print')), 50)
+
+    def test_failed_login_closes_socket(self):
+        self.assertRaises(ApiError, self.engine.connect, self.router.router(password='wrong'))
+        # Router sees the client hang up and engine holds no socket of the failed connection
+        self.assertTrue(self.router.wait_closed(1))
+        self.assertEqual(self.engine._connections, {})
+
+    def test_closed_connection_fails_pending_request(self):
+        connection = self.engine.connect(self.router.router())
+        connection.disconnect()
+        self.assertTrue(self.router.wait_closed(1))
+        self.assertRaises(ConnectionClosed, connection.call, '/ip/address/print')
+        self.assertFalse(connection.connected)
+
+
+    def test_stop_closes_wakeup_pipe(self):
+        read, write = self.engine._wakeup_read, self.engine._wakeup_write
+        self.engine.stop()
+        self.engine.join(5)
+        self.assertIsNone(self.engine._wakeup_write)
+        for fd in (read, write):
+            self.assertRaises(OSError, os.fstat, fd)
+        # Late wakeup from another thread is ignored
+        self.engine.mark_dirty(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+from lib.columnar import ColumnarBatch
+from lib.flow import Flow
+from tests import LOGGER
+
+LEASES = {'name': 'dhcp_server_leases',
+          'params': ['mac', 'address', 'host', 'name', 'color', 'status'],
+          'run_interval': 10,
+          'mysql_type': 'insert',
+          'mysql_table': 'leases',
+          'batch_size': 2}
+
+
+class _Resource:
+    def __init__(self, replies):
+        self.replies = replies
+        self.calls = []
+
+    def get(self):
+        return list(self.replies)
+
+    def call(self, command, arguments=None, queries=None, additional_queries=()):
+        self.calls.append((command, arguments))
+        return list(self.replies)
+
+
+class _Client:
+    def __init__(self, replies):
+        self.resource = _Resource(replies)
+
+    def get_resource(self, path):
+        return self.resource
+
+
+def leases(count):
+    return [{'mac-address': '00:00:00:00:00:0{}'.format(index), 'address': '10.0.0.{}'.format(index),
+             'host-name': 'host{}'.format(index), 'comment': 'pc{};;ff0000'.format(index), 'status': 'bound'}
+            for index in range(count)]
+
+
+class TestFlow(unittest.TestCase):
+
+    def execute(self, flow_config, replies, router_id='r1'):
+        client = _Client(replies)
+        return list(Flow(LOGGER, flow_config, router_id).execute(client)), client.resource
+
+    def test_rows_are_emitted_in_batches(self):
+        jobs, resource = self.execute(dict(LEASES, columnar=False), leases(5))
+        self.assertEqual([len(job['payload']) for job in jobs], [2, 2, 1])
+        self.assertEqual(jobs[0]['payload'][1], ('00:00:00:00:00:01', '10.0.0.1', 'host1', 'pc1', '#ff0000', 1))
+        # Only fields read by flow method are requested
+        self.assertEqual(resource.calls, [('print', {'.proplist': 'mac-address,address,host-name,comment,status'})])
+
+    def test_columnar_payload(self):
+        jobs, resource = self.execute(LEASES, leases(3))
+        self.assertTrue(isinstance(jobs[0]['payload'], ColumnarBatch))
+        self.assertEqual([row for job in jobs for row in job['payload']],
+                         [('00:00:00:00:00:0{}'.format(index), '10.0.0.{}'.format(index), 'host{}'.format(index),
+                           'pc{}'.format(index), '#ff0000', 1) for index in range(3)])
+
+    def test_job_metadata(self):
+        jobs, resource = self.execute(LEASES, leases(3))
+        self.assertEqual([job['seq'] for job in jobs], [1, 2])
+        self.assertEqual(len(set(job['batch_id'] for job in jobs)), 2)
+        self.assertEqual(len(set(job['batch_id'].split(':')[0] for job in jobs)), 1)
+        self.assertEqual(set(job['router'] for job in jobs), set(['r1']))
+        self.assertEqual(jobs[0]['interval'], None)
+
+    def test_router_column(self):
+        jobs, resource = self.execute(dict(LEASES, router_column='router'), leases(1))
+        self.assertEqual(list(jobs[0]['payload'])[0][-1], 'r1')
+
+    def test_empty_reply(self):
+        jobs, resource = self.execute(LEASES, [])
+        self.assertEqual(jobs, [])
+
+    def test_unknown_method(self):
+        self.assertRaises(Exception, Flow, LOGGER, dict(LEASES, name='unknown'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import Queue
+import shutil
+import tempfile
+import unittest
+from lib.jobqueue import JobQueue, UnknownFlowError, POLICY_DROP_OLDEST, POLICY_SPILL
+from lib.spool import Spool
+from tests import LOGGER
+
+PRIORITIES = {'alerts': 'high', 'traffic': 'normal', 'archive': 'bulk'}
+
+
+def make_job(name, index=0):
+    return {'name': name, 'payload': [(index,)]}
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def test_served_by_priority_then_fifo(self):
+        queue = JobQueue(LOGGER, PRIORITIES)
+        queue.put(make_job('archive', 1))
+        queue.put(make_job('traffic', 2))
+        queue.put(make_job('alerts', 3))
+        queue.put(make_job('traffic', 4))
+        served = [queue.get_nowait()['payload'][0][0] for index in range(4)]
+        self.assertEqual(served, [3, 2, 4, 1])
+        self.assertRaises(Queue.Empty, queue.get_nowait)
+
+    def test_unknown_flow_is_rejected(self):
+        queue = JobQueue(LOGGER, PRIORITIES)
+        self.assertRaises(UnknownFlowError, queue.put, make_job('unknown'))
+
+    def test_block_policy_times_out(self):
+        queue = JobQueue(LOGGER, PRIORITIES, max_jobs=1)
+        queue.put(make_job('traffic'))
+        self.assertRaises(Queue.Full, queue.put, make_job('traffic'), timeout=0.05)
+        self.assertRaises(Queue.Full, queue.put, make_job('traffic'), block=False)
+
+    def test_byte_accounting(self):
+        queue = JobQueue(LOGGER, PRIORITIES)
+        queue.put(make_job('traffic'))
+        self.assertTrue(queue.bytes() > 0)
+        self.assertEqual(queue.flow_bytes()['traffic'], queue.bytes())
+        queue.get_nowait()
+        self.assertEqual(queue.bytes(), 0)
+
+    def test_drop_oldest_drops_lower_priority_first(self):
+        queue = JobQueue(LOGGER, PRIORITIES, max_jobs=2, policy=POLICY_DROP_OLDEST)
+        queue.put(make_job('traffic', 1))
+        queue.put(make_job('archive', 2))
+        queue.put(make_job('traffic', 3))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual([queue.get_nowait()['payload'][0][0] for index in range(2)], [1, 3])
+
+    def test_drop_oldest_keeps_higher_priority(self):
+        queue = JobQueue(LOGGER, PRIORITIES, max_jobs=1, policy=POLICY_DROP_OLDEST)
+        queue.put(make_job('alerts', 1))
+        self.assertRaises(Queue.Full, queue.put, make_job('archive', 2), block=False)
+        self.assertEqual(queue.dropped, 0)
+
+    def test_spill_moves_queue_to_spool_in_order(self):
+        location = tempfile.mkdtemp()
+        try:
+            spool = Spool(LOGGER, location)
+            queue = JobQueue(LOGGER, PRIORITIES, max_jobs=2, policy=POLICY_SPILL, spool=spool)
+            for index in range(3):
+                queue.put(make_job('traffic', index))
+            self.assertEqual(queue.qsize(), 0)
+            self.assertEqual(queue.spilled, 3)
+            jobs, position = spool.read(10)
+            self.assertEqual([job['payload'][0][0] for job in jobs], [0, 1, 2])
+            spool.close()
+        finally:
+            shutil.rmtree(location)
+
+    def test_spill_requires_spool(self):
+        self.assertRaises(Exception, JobQueue, LOGGER, PRIORITIES, 1, 0, POLICY_SPILL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import logging
+import unittest
+import lib.logger
+from lib.logger import LazyLogger
+
+
+class _Records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestLazyLogger(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('tests.logger')
+        logger.propagate = False
+        self.records = _Records()
+        logger.handlers = [self.records]
+        logger.setLevel(logging.INFO)
+        self.logger = LazyLogger(logger, max_items=3, repeat_interval=60)
+
+    def warn(self, template, *args):
+        # One call site for every message of a test
+        self.logger.warning(template, *args)
+
+    def test_same_message_is_suppressed(self):
+        for index in range(5):
+            self.warn('Router {} unreachable', 'r1')
+        self.assertEqual(self.records.messages, ['Router r1 unreachable'])
+
+    def test_different_message_from_same_site_is_logged(self):
+        self.warn('Router {} unreachable', 'r1')
+        self.warn('Router {} unreachable', 'r2')
+        self.warn('Router r3 unreachable')
+        self.warn('Router r3 unreachable')
+        self.assertEqual(self.records.messages, ['Router r1 unreachable', 'Router r2 unreachable',
+                                                 'Router r3 unreachable'])
+
+    def test_suppressed_count_is_reported(self):
+        now = [100.0]
+        monotonic, lib.logger.monotonic = lib.logger.monotonic, lambda: now[0]
+        try:
+            for index in range(3):
+                self.warn('Router {} unreachable', 'r1')
+            now[0] += 61
+            self.warn('Router {} unreachable', 'r1')
+        finally:
+            lib.logger.monotonic = monotonic
+        self.assertEqual(self.records.messages,
+                         ['Router r1 unreachable',
+                          'Router r1 unreachable [2 similar messages suppressed in last 61 sec]'])
+
+    def test_arguments_are_formatted_lazily(self):
+        self.logger.debug('Rows {}', [object()])
+        self.logger.info('Rows {}', range(10))
+        self.assertEqual(self.records.messages, ['Rows [0, 1, 2] ... (10 items total)'])
+
+
+if __name__ == '__main__':
+    unittest.main()
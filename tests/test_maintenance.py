@@ -0,0 +1,130 @@
+import time
+import unittest
+from etc import config
+
+try:
+    import MySQLdb
+    import threads.Maintenance
+    from threads.Maintenance import Maintenance
+except ImportError:
+    MySQLdb = None
+
+NOW = 1000000
+
+TABLE = {'table': 'traffic', 'time_column': 'created', 'retention': 86400,
+         'group_by': ['local_ip'], 'sum': ['bytes'],
+         'resolutions': [{'table': 'traffic_minute', 'bucket': 60}]}
+
+
+class _Clock:
+    @staticmethod
+    def time():
+        return NOW
+
+
+class _Client:
+    """
+    Records statements, replies are looked up by statement prefix
+    """
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self):
+        return _Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+class _Cursor:
+    def __init__(self, client):
+        self._client = client
+        self._rows = ()
+
+    def execute(self, query, args=None):
+        self._client.executed.append((query, args))
+        for prefix, reply in self._client.replies.items():
+            if query.startswith(prefix):
+                affected_rows, self._rows = reply.pop(0) if isinstance(reply, list) else reply
+                return affected_rows
+        return 0
+
+    def fetchall(self):
+        return self._rows
+
+    def close(self):
+        pass
+
+
+@unittest.skipIf(MySQLdb is None, 'MySQLdb is not installed')
+class TestMaintenance(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = dict((name, getattr(config, name)) for name in ('log', 'maintenance') if hasattr(config, name))
+        config.log = {'formatter_main': '%(message)s', 'location': None, 'level': 'CRITICAL'}
+        config.maintenance = {'tables': [TABLE], 'io_budget': 1.0, 'chunk_rows': 100, 'max_buckets': 10,
+                              'delay': 120}
+        threads.Maintenance.time = _Clock
+        self.maintenance = Maintenance()
+
+    def tearDown(self):
+        threads.Maintenance.time = time
+        for name in ('log', 'maintenance'):
+            if name in self.saved:
+                setattr(config, name, self.saved[name])
+            else:
+                delattr(config, name)
+
+    def statements(self, prefix):
+        return [(query, args) for query, args in self.maintenance._db_client.executed if query.startswith(prefix)]
+
+    def test_rollup_query(self):
+        self.assertEqual(self.maintenance._rollup_query('traffic', 'created', TABLE['resolutions'][0],
+                                                        ['local_ip', 'type'], ['bytes', 'packets']),
+                         "INSERT INTO traffic_minute (bucket, local_ip, type, bytes, packets) "
+                         "SELECT FROM_UNIXTIME(UNIX_TIMESTAMP(created) DIV 60 * 60), local_ip, type, "
+                         "SUM(bytes), SUM(packets) "
+                         "FROM traffic WHERE created >= FROM_UNIXTIME(%s) AND created < FROM_UNIXTIME(%s) "
+                         "GROUP BY 1, local_ip, type "
+                         "ON DUPLICATE KEY UPDATE bytes = bytes + VALUES(bytes), packets = packets + VALUES(packets)")
+
+    def test_downsample_from_first_bucket_in_windows(self):
+        # Complete buckets end at (NOW - delay) // 60 * 60 = 999840
+        first = 999840 - 60 * 15
+        self.maintenance._db_client = _Client({'SELECT watermark': (0, ()),
+                                               'SELECT UNIX_TIMESTAMP(MIN': (1, ((first + 30,),))})
+        self.assertTrue(self.maintenance._downsample('traffic', 'created', TABLE['resolutions'][0],
+                                                     ['local_ip'], ['bytes']))
+        self.assertEqual([args for query, args in self.statements('INSERT INTO traffic_minute')],
+                         [(first, first + 600), (first + 600, 999840)])
+        self.assertEqual([args for query, args in self.statements('INSERT INTO maintenance_watermarks')],
+                         [('traffic:traffic_minute', first + 600), ('traffic:traffic_minute', 999840)])
+        # Watermark is advanced in the transaction of its rollup
+        self.assertEqual(self.maintenance._db_client.commits, 2)
+
+    def test_downsample_continues_from_watermark(self):
+        self.maintenance._db_client = _Client({'SELECT watermark': (1, ((999840,),))})
+        self.assertTrue(self.maintenance._downsample('traffic', 'created', TABLE['resolutions'][0],
+                                                     ['local_ip'], ['bytes']))
+        self.assertEqual(self.statements('INSERT'), [])
+
+    def test_delete_expired_in_chunks(self):
+        self.maintenance._db_client = _Client({'DELETE': [(100, ()), (100, ()), (7, ())]})
+        self.assertTrue(self.maintenance._enforce_retention(TABLE))
+        deletes = self.statements('DELETE')
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(deletes[0], ("DELETE FROM traffic WHERE created < FROM_UNIXTIME(%s) LIMIT 100",
+                                      (NOW - 86400,)))
+
+    def test_drop_expired_partitions(self):
+        self.maintenance._db_client = _Client({'SELECT PARTITION_NAME': (3, (('p1', '900000'), ('p2', '913600'),
+                                                                             ('p3', '999999')))})
+        self.assertTrue(self.maintenance._drop_partitions('traffic', 'UNIX_TIMESTAMP', NOW - 86400))
+        self.assertEqual(self.statements('ALTER'), [("ALTER TABLE traffic DROP PARTITION p1, p2", None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
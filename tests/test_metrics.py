@@ -0,0 +1,80 @@
+import time
+import unittest
+import urllib2
+from lib.metrics import Counter, Gauge, Histogram, Registry, MetricsServer
+from tests import LOGGER
+
+# Local server, proxy settings of environment don't apply
+OPENER = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+
+class TestRender(unittest.TestCase):
+
+    def test_counter_with_labels(self):
+        metric = Counter('rows_total', 'Rows written', ('flow',))
+        metric.labels('traffic').inc(3)
+        metric.labels('leases').inc()
+        metric.labels('traffic').inc()
+        self.assertEqual(metric.render(), '# HELP rows_total Rows written\n'
+                                          '# TYPE rows_total counter\n'
+                                          'rows_total{flow="leases"} 1\n'
+                                          'rows_total{flow="traffic"} 4')
+
+    def test_label_values_are_escaped(self):
+        metric = Counter('failures_total', 'Failures', ('router',))
+        metric.labels('a"b\\c\nd').inc()
+        self.assertEqual(metric.render().split('\n')[-1], 'failures_total{router="a\\"b\\\\c\\nd"} 1')
+
+    def test_gauge_callback_is_read_on_render(self):
+        depth = [5]
+        metric = Gauge('queue_jobs', 'Jobs in queue', callback=lambda: {(): depth[0]})
+        depth[0] = 7
+        self.assertEqual(metric.render().split('\n')[-1], 'queue_jobs 7')
+
+    def test_histogram_buckets_are_cumulative(self):
+        metric = Histogram('run_seconds', 'Run time', ('flow',), buckets=(1, 0.1))
+        for value in (0.05, 0.1, 0.5, 3):
+            metric.labels('traffic').observe(value)
+        self.assertEqual(metric.render().split('\n')[2:], ['run_seconds_bucket{flow="traffic",le="0.1"} 2',
+                                                            'run_seconds_bucket{flow="traffic",le="1.0"} 3',
+                                                            'run_seconds_bucket{flow="traffic",le="+Inf"} 4',
+                                                            'run_seconds_sum{flow="traffic"} 3.65',
+                                                            'run_seconds_count{flow="traffic"} 4'])
+
+    def test_registry_renders_all_metrics(self):
+        registry = Registry()
+        registry.register(Counter('a_total', 'A')).inc()
+        registry.register(Gauge('b', 'B')).set(2)
+        self.assertEqual(registry.render(), '# HELP a_total A\n# TYPE a_total counter\na_total 1\n'
+                                            '# HELP b B\n# TYPE b gauge\nb 2\n')
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MetricsServer(LOGGER, '127.0.0.1', 0)
+        self.server.start()
+        end = time.time() + 3
+        while self.server._server is None and time.time() < end:
+            time.sleep(0.01)
+        self.url = 'http://127.0.0.1:{}'.format(self.server._server.server_address[1])
+
+    def tearDown(self):
+        self.server.wantRunning = False
+        self.server.join(3)
+
+    def test_serves_metrics(self):
+        response = OPENER.open(self.url + '/metrics', timeout=5)
+        self.assertEqual(response.info()['Content-Type'], 'text/plain; version=0.0.4')
+        self.assertTrue('# TYPE flow_run_seconds histogram' in response.read())
+
+    def test_unknown_path(self):
+        try:
+            OPENER.open(self.url + '/other', timeout=5)
+            self.fail('Expected HTTP error')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
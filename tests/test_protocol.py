@@ -0,0 +1,72 @@
+import hashlib
+import unittest
+from lib.routeros.protocol import SentenceParser, ProtocolError, encode_length, encode_sentence, build_command, \
+    parse_sentence, login_response
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_length_prefix_sizes(self):
+        self.assertEqual(len(encode_length(0x7F)), 1)
+        self.assertEqual(len(encode_length(0x80)), 2)
+        self.assertEqual(len(encode_length(0x3FFF)), 2)
+        self.assertEqual(len(encode_length(0x4000)), 3)
+        self.assertEqual(len(encode_length(0x1FFFFF)), 3)
+        self.assertEqual(len(encode_length(0x200000)), 4)
+        self.assertEqual(len(encode_length(0x10000000)), 5)
+
+    def test_round_trip_word_lengths(self):
+        words = ['a' * length for length in (1, 0x7F, 0x80, 0x3FFF, 0x4000, 0x200000)]
+        sentences = SentenceParser().feed(encode_sentence(words))
+        self.assertEqual(sentences, [words])
+
+    def test_unicode_word_is_utf8(self):
+        sentences = SentenceParser().feed(encode_sentence([u'=comment=\u017elu\u0165']))
+        self.assertEqual(sentences, [[u'=comment=\u017elu\u0165'.encode('utf-8')]])
+
+    def test_build_command(self):
+        words = build_command('/ip/address/print', {'detail': ''}, ['?disabled=no', '?#|'], ['address', 'interface'],
+                              tag=3)
+        self.assertEqual(words, ['/ip/address/print', '=detail=', '=.proplist=address,interface',
+                                 '?disabled=no', '?#|', '.tag=3'])
+
+    def test_login_response(self):
+        md5 = hashlib.md5()
+        md5.update('\x00' + 'secret' + '\x01\x02\xff')
+        self.assertEqual(login_response('secret', '0102ff'), '00' + md5.hexdigest())
+
+
+class TestSentenceParser(unittest.TestCase):
+
+    def test_sentences_split_across_reads(self):
+        data = encode_sentence(['!re', '=name=ether1', '.tag=1']) + encode_sentence(['!done', '.tag=1'])
+        parser = SentenceParser()
+        sentences = []
+        for char in data:
+            sentences.extend(parser.feed(char))
+        self.assertEqual(sentences, [['!re', '=name=ether1', '.tag=1'], ['!done', '.tag=1']])
+
+    def test_long_length_prefix_split_across_reads(self):
+        data = encode_sentence(['x' * 0x4000])
+        parser = SentenceParser()
+        self.assertEqual(parser.feed(data[:2]), [])
+        self.assertEqual(parser.feed(data[2:]), [['x' * 0x4000]])
+
+    def test_invalid_length_prefix(self):
+        self.assertRaises(ProtocolError, SentenceParser().feed, '\xF8abc')
+
+
+class TestParseSentence(unittest.TestCase):
+
+    def test_attributes_and_tag(self):
+        reply, tag, attributes = parse_sentence(['!re', '=.id=*1', '=comment=a=b', '.tag=7'])
+        self.assertEqual(reply, '!re')
+        self.assertEqual(tag, '7')
+        self.assertEqual(attributes, {'id': '*1', 'comment': 'a=b'})
+
+    def test_empty_sentence(self):
+        self.assertRaises(ProtocolError, parse_sentence, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import time
+import unittest
+from lib.rollup import Rollup, rollup_flow
+
+FLOW = {'name': 'lan_traffic_usage',
+        'params': ['interval', 'type', 'src', 'dst', 'local', 'bytes', 'packets'],
+        'rollup': {'name': 'lan_traffic_rollup', 'mysql_table': 'lan_traffic_rollup', 'bucket': 60,
+                   'group_by': ['local', 'type'], 'sum': ['bytes', 'packets']}}
+
+ROWS = [(0, 'upload', '10.0.0.1', '8.8.8.8', '10.0.0.1', '100', '1'),
+        (0, 'upload', '10.0.0.1', '1.1.1.1', '10.0.0.1', '50', '2'),
+        (0, 'download', '8.8.8.8', '10.0.0.2', '10.0.0.2', '10', '1')]
+
+
+def with_rollup(**kwargs):
+    flow = dict(FLOW)
+    flow['rollup'] = dict(FLOW['rollup'], **kwargs)
+    return flow
+
+
+class TestRollup(unittest.TestCase):
+
+    def test_rollup_flow(self):
+        flow = rollup_flow(FLOW)
+        self.assertEqual(flow['name'], 'lan_traffic_rollup')
+        self.assertEqual(flow['params'], ['bucket', 'local', 'type', 'bytes', 'packets'])
+        self.assertEqual(flow['accumulate'], ['bytes', 'packets'])
+
+    def test_sums_per_group(self):
+        rollup = Rollup(FLOW)
+        self.assertEqual(list(rollup.feed(ROWS, 120)), [])
+        bucket = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(120))
+        self.assertEqual(sorted(rollup.flush()), sorted([(bucket, '10.0.0.1', 'upload', 150, 3),
+                                                         (bucket, '10.0.0.2', 'download', 10, 1)]))
+        # Flush resets the bucket
+        self.assertEqual(rollup.flush(), [])
+
+    def test_due_when_bucket_closes(self):
+        rollup = Rollup(FLOW)
+        self.assertFalse(rollup.due(120))
+        list(rollup.feed(ROWS, 125))
+        self.assertFalse(rollup.due(179))
+        self.assertTrue(rollup.due(180))
+        self.assertTrue(rollup.due(170, lookahead=10))
+
+    def test_keep_raw_passes_all_rows(self):
+        rollup = Rollup(with_rollup(keep_raw=True))
+        self.assertEqual(list(rollup.feed(ROWS, 0)), ROWS)
+
+    def test_top_k_passes_rows_of_biggest_groups(self):
+        rollup = Rollup(with_rollup(top_k=1))
+        self.assertEqual(list(rollup.feed(ROWS, 0)), ROWS[:2])
+
+
+if __name__ == '__main__':
+    unittest.main()
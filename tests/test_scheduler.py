@@ -0,0 +1,100 @@
+import unittest
+import lib.scheduler
+from lib.scheduler import Scheduler, OVERRUN_SKIP, OVERRUN_CATCH_UP
+from tests import LOGGER
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = _Clock()
+        self.monotonic = lib.scheduler.monotonic
+        lib.scheduler.monotonic = self.clock
+
+    def tearDown(self):
+        lib.scheduler.monotonic = self.monotonic
+
+    def run_due(self, scheduler):
+        # Dispatch and finish due entries right away, returns their jobs
+        jobs = []
+        for entry in scheduler.pop_due():
+            if scheduler.acquire(entry):
+                scheduler.release(entry)
+                jobs.append(entry.job)
+        return jobs
+
+    def test_first_run_is_due_immediately(self):
+        scheduler = Scheduler(LOGGER)
+        scheduler.add('a', 10)
+        scheduler.add('b', 10, start=105)
+        self.assertEqual(self.run_due(scheduler), ['a'])
+        self.assertEqual(scheduler.next_deadline(), 105)
+
+    def test_deadline_does_not_drift(self):
+        scheduler = Scheduler(LOGGER)
+        entry = scheduler.add('a', 10)
+        self.run_due(scheduler)
+        # Run dispatched late still keeps the original grid
+        self.clock.now = 113
+        self.assertEqual(self.run_due(scheduler), ['a'])
+        self.assertEqual(entry.deadline, 120)
+
+    def test_skip_aligns_to_next_slot(self):
+        scheduler = Scheduler(LOGGER, OVERRUN_SKIP)
+        entry = scheduler.add('a', 10)
+        self.clock.now = 135
+        self.assertEqual(self.run_due(scheduler), ['a'])
+        self.assertEqual(entry.deadline, 140)
+        self.assertEqual(entry.skipped, 3)
+
+    def test_catch_up_runs_missed_intervals(self):
+        scheduler = Scheduler(LOGGER, OVERRUN_CATCH_UP, max_catch_up=3)
+        entry = scheduler.add('a', 10)
+        self.clock.now = 125
+        runs = 0
+        while self.run_due(scheduler):
+            runs += 1
+        self.assertEqual(runs, 3)
+        self.assertEqual(entry.deadline, 130)
+
+    def test_catch_up_beyond_limit_skips(self):
+        scheduler = Scheduler(LOGGER, OVERRUN_CATCH_UP, max_catch_up=2)
+        entry = scheduler.add('a', 10)
+        self.clock.now = 155
+        self.run_due(scheduler)
+        self.assertEqual(entry.deadline, 160)
+
+    def test_busy_entry_skips_slot(self):
+        scheduler = Scheduler(LOGGER, OVERRUN_SKIP)
+        entry = scheduler.add('a', 10)
+        self.assertTrue(scheduler.acquire(scheduler.pop_due()[0]))
+        self.clock.now = 110
+        self.assertFalse(scheduler.acquire(scheduler.pop_due()[0]))
+        self.assertEqual(entry.skipped, 1)
+        self.assertEqual(entry.deadline, 120)
+
+    def test_busy_catch_up_entry_is_parked_until_release(self):
+        scheduler = Scheduler(LOGGER, OVERRUN_CATCH_UP)
+        entry = scheduler.add('a', 10)
+        self.assertTrue(scheduler.acquire(scheduler.pop_due()[0]))
+        self.clock.now = 110
+        self.assertFalse(scheduler.acquire(scheduler.pop_due()[0]))
+        self.assertEqual(scheduler.next_deadline(), None)
+        scheduler.release(entry)
+        self.assertEqual(self.run_due(scheduler), ['a'])
+
+    def test_unknown_policy(self):
+        self.assertRaises(Exception, Scheduler, LOGGER, 'later')
+        self.assertRaises(Exception, Scheduler(LOGGER).add, 'a', 10, 'later')
+
+
+if __name__ == '__main__':
+    unittest.main()
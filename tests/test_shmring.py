@@ -0,0 +1,59 @@
+import Queue
+import multiprocessing
+import unittest
+from lib.shmring import SharedRing, RingWriter, RingReader
+from tests import LOGGER
+
+
+def produce(ring, count):
+    for index in range(count):
+        ring.write('record {}'.format(index), timeout=5)
+
+
+class TestSharedRing(unittest.TestCase):
+
+    def test_records_wrap_around(self):
+        ring = SharedRing(64)
+        for index in range(20):
+            ring.write('x' * index)
+            self.assertEqual(ring.read(timeout=0), 'x' * index)
+        self.assertEqual(ring.used(), 0)
+
+    def test_full_and_empty(self):
+        ring = SharedRing(16)
+        ring.write('12345678')
+        self.assertRaises(Queue.Full, ring.write, '12345678', timeout=0.05)
+        self.assertEqual(ring.read(timeout=0), '12345678')
+        self.assertRaises(Queue.Empty, ring.read, timeout=0.05)
+
+    def test_record_bigger_than_ring(self):
+        self.assertRaises(Exception, SharedRing(16).write, 'x' * 16)
+
+    def test_between_processes(self):
+        ring = SharedRing(128)
+        process = multiprocessing.Process(target=produce, args=(ring, 100))
+        process.start()
+        records = [ring.read(timeout=5) for index in range(100)]
+        process.join(5)
+        self.assertEqual(records, ['record {}'.format(index) for index in range(100)])
+
+
+class TestRingReader(unittest.TestCase):
+
+    def test_moves_jobs_to_queue(self):
+        ring = SharedRing(4096)
+        job = {'name': 'traffic', 'payload': [(1, 'a'), (2, 'b')], 'batch_id': 'run:1'}
+        RingWriter(ring).put(job)
+        queue = Queue.Queue()
+        reader = RingReader(LOGGER, ring, queue)
+        reader.wantRunning = False
+        # Stopped reader still hands over what is left in ring
+        reader.run()
+        moved = queue.get_nowait()
+        self.assertEqual(moved['name'], 'traffic')
+        self.assertEqual(list(moved['payload']), [(1, 'a'), (2, 'b')])
+        self.assertEqual(moved['batch_id'], 'run:1')
+
+
+if __name__ == '__main__':
+    unittest.main()
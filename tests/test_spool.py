@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+from lib.spool import Spool
+from tests import LOGGER
+
+
+def make_job(index):
+    return {'name': 'flow', 'payload': [(index, 'row')], 'batch_id': 'run:{}'.format(index)}
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_read_in_order_and_commit(self):
+        spool = Spool(LOGGER, self.location, segment_size=100)
+        for index in range(10):
+            spool.append(make_job(index))
+        self.assertFalse(spool.empty())
+
+        jobs, position = spool.read(4)
+        self.assertEqual([job['payload'][0][0] for job in jobs], [0, 1, 2, 3])
+        spool.commit(position)
+        jobs, position = spool.read(100)
+        self.assertEqual([job['payload'][0][0] for job in jobs], range(4, 10))
+        spool.commit(position)
+        self.assertTrue(spool.empty())
+        self.assertEqual([name for name in os.listdir(self.location) if name.endswith('.seg')], [])
+
+    def test_uncommitted_jobs_survive_reopen(self):
+        spool = Spool(LOGGER, self.location)
+        for index in range(3):
+            spool.append(make_job(index))
+        jobs, position = spool.read(1)
+        spool.commit(position)
+        spool.read(10)
+        spool.close()
+
+        reopened = Spool(LOGGER, self.location)
+        jobs, position = reopened.read(10)
+        self.assertEqual([job['payload'][0][0] for job in jobs], [1, 2])
+
+    def test_corrupted_record_is_skipped(self):
+        spool = Spool(LOGGER, self.location)
+        for index in range(3):
+            spool.append(make_job(index))
+        spool.close()
+        segment = [name for name in os.listdir(self.location) if name.endswith('.seg')][0]
+        with open(os.path.join(self.location, segment), 'r+b') as f:
+            # Damage checksum of first record
+            f.seek(8)
+            f.write('\x00\x00\x00\x00')
+
+        jobs, position = Spool(LOGGER, self.location).read(10)
+        self.assertEqual([job['payload'][0][0] for job in jobs], [1, 2])
+
+    def test_size_cap_drops_oldest_segment(self):
+        spool = Spool(LOGGER, self.location, segment_size=50, max_size=150)
+        for index in range(20):
+            spool.append(make_job(index))
+        self.assertLessEqual(spool.size(), 150)
+        jobs, position = spool.read(100)
+        self.assertEqual(jobs[-1]['payload'][0][0], 19)
+        self.assertNotEqual(jobs[0]['payload'][0][0], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+from lib.columnar import ColumnarBatch, TYPE_INT, TYPE_STR
+from lib.statements import Statement, compile_statements, insert_chunks
+from tests import LOGGER
+
+
+def flow(**kw):
+    return dict({'name': 'traffic', 'mysql_type': 'INSERT_ON_FAIL_UPDATE', 'mysql_table': 't',
+                 'params': ['a', 'b']}, **kw)
+
+
+class TestStatement(unittest.TestCase):
+
+    def test_multi_row_insert(self):
+        statement = Statement(flow(mysql_type='INSERT', router_column='router'))
+        self.assertEqual(statement.query(2), 'INSERT INTO t (a, b, router) VALUES (%s, %s, %s), (%s, %s, %s)')
+
+    def test_query_is_reused(self):
+        statement = Statement(flow())
+        self.assertIs(statement.query(5), statement.query(5))
+
+    def test_query_cache_is_bounded(self):
+        statement = Statement(flow())
+        full = statement.query(1000)
+        for row_count in range(1, 100):
+            statement.query(row_count)
+            # Full-size chunk is used between tails and stays cached
+            self.assertIs(statement.query(1000), full)
+        self.assertEqual(len(statement._queries), Statement.MAX_CACHED_QUERIES)
+
+    def test_delete_query_needs_key(self):
+        self.assertRaises(Exception, Statement(flow()).delete_query, 1)
+        statement = Statement(flow(change_detection={'delete_removed': True, 'primary_key': 'b'}))
+        self.assertEqual(statement.delete_query(2), 'DELETE FROM t WHERE (b) IN ((%s), (%s))')
+
+    def test_invalid_flows_are_not_compiled(self):
+        statements = compile_statements(LOGGER, [flow(), flow(name='bad', mysql_type='REPLACE'),
+                                                 flow(name='empty', params=[])])
+        self.assertEqual(statements.keys(), ['traffic'])
+
+
+class TestBulkQueries(unittest.TestCase):
+
+    def test_plain_insert_loads_into_table(self):
+        statement = Statement(flow(mysql_type='INSERT'))
+        self.assertEqual(len(statement.bulk_queries), 1)
+        self.assertTrue(statement.bulk_queries[0].startswith('LOAD DATA LOCAL INFILE %s INTO TABLE t '))
+        self.assertTrue(statement.bulk_queries[0].endswith(' (a, b)'))
+
+    def test_update_merges_through_stage_table(self):
+        statement = Statement(flow(accumulate=['b']))
+        drop, create, load, merge, cleanup = statement.bulk_queries
+        self.assertEqual(drop, 'DROP TEMPORARY TABLE IF EXISTS t_stage')
+        self.assertEqual(create, 'CREATE TEMPORARY TABLE t_stage SELECT a, b FROM t LIMIT 0')
+        self.assertIn('INTO TABLE t_stage ', load)
+        # Target columns are qualified, bare b is ambiguous between t and t_stage
+        self.assertEqual(merge, 'INSERT INTO t (a, b) SELECT a, b FROM t_stage '
+                                'ON DUPLICATE KEY UPDATE t.a = VALUES(a), t.b = t.b + VALUES(b)')
+        self.assertEqual(cleanup, 'DROP TEMPORARY TABLE t_stage')
+
+    def test_row_insert_keeps_unqualified_update(self):
+        statement = Statement(flow(accumulate=['b']))
+        self.assertEqual(statement.query(1), 'INSERT INTO t (a, b) VALUES (%s, %s) '
+                                             'ON DUPLICATE KEY UPDATE a = VALUES(a), b = b + VALUES(b)')
+
+
+class TestInsertChunks(unittest.TestCase):
+
+    def columnar(self, rows):
+        batch = ColumnarBatch((TYPE_INT, TYPE_STR))
+        for row in rows:
+            batch.append(row)
+        return batch
+
+    def test_small_payloads_share_chunk(self):
+        payloads = [[(1, 'a')], [(2, 'b')], self.columnar([(3, 'c')])]
+        self.assertEqual(list(insert_chunks(payloads, 1000, 1024 * 1024)), [([1, 'a', 2, 'b', 3, 'c'], 3)])
+
+    def test_chunks_cut_by_rows_across_payloads(self):
+        payloads = [[(1, 'a'), (2, 'b')], self.columnar([(3, 'c'), (4, 'd'), (5, 'e')]), [(6, 'f')]]
+        chunks = list(insert_chunks(payloads, 4, 1024 * 1024))
+        self.assertEqual(chunks, [([1, 'a', 2, 'b', 3, 'c', 4, 'd'], 4), ([5, 'e', 6, 'f'], 2)])
+
+    def test_chunks_cut_by_bytes(self):
+        batch = self.columnar([(index, 'x') for index in range(10)])
+        row_bytes = batch.row_size()
+        chunks = list(insert_chunks([batch], 1000, row_bytes * 3))
+        self.assertEqual([row_count for args, row_count in chunks], [3, 3, 3, 1])
+        # Row larger than budget is sent alone
+        chunks = list(insert_chunks([[('x' * 100,)], [('y' * 100,)]], 1000, 10))
+        self.assertEqual(chunks, [(['x' * 100], 1), (['y' * 100], 1)])
+
+    def test_no_rows_no_chunks(self):
+        self.assertEqual(list(insert_chunks([[], self.columnar([])], 10, 100)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import time
+import unittest
+from threading import Thread, Event
+from lib.supervisor import Supervisor, Component, Health
+from tests import LOGGER
+
+FAST = {'backoff_initial': 0.01, 'backoff_max': 0.02}
+
+
+class Worker(Thread):
+    """
+    Component thread for tests, fails on its first loop when fail is set,
+    stuck one neither beats nor stops until released
+    """
+
+    def __init__(self, previous=None, fail=False, stuck=False):
+        Thread.__init__(self)
+        self.daemon = True
+        self.previous = previous
+        self.fail = fail
+        self.stuck = stuck
+        self.released = Event()
+        self.drained = None
+        self.running = False
+        self.wantRunning = True
+        self.health = Health()
+
+    def run(self):
+        self.running = True
+        if self.stuck:
+            self.released.wait(10)
+        while self.wantRunning:
+            self.health.beat()
+            if self.fail:
+                self.health.failed('boom')
+                break
+            time.sleep(0.01)
+        self.running = False
+        self.health.stopped()
+
+
+class DrainingWorker(Worker):
+    def drain(self, timeout):
+        self.drained = timeout
+        self.wantRunning = False
+
+
+def poll_until(supervisor, condition, timeout=2):
+    # Returns False as soon as supervisor gives up
+    end = time.time() + timeout
+    while time.time() < end:
+        if not supervisor.poll(0.01):
+            return False
+        if condition():
+            return True
+    raise AssertionError('Condition not met within {} sec'.format(timeout))
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.supervisor = Supervisor(LOGGER)
+
+    def tearDown(self):
+        for instance in self.supervisor.instances():
+            instance.released.set()
+        self.supervisor.shutdown(join_timeout=1, drain_timeout=0)
+
+    def add(self, name, factory, policy=None, stage=0):
+        component = Component(name, factory, dict(FAST, **(policy or {})), stage)
+        self.supervisor.add(component)
+        return component
+
+    def test_only_failed_component_is_restarted(self):
+        created = []
+
+        def failing(previous):
+            created.append(Worker(previous, fail=not created))
+            return created[-1]
+
+        failed = self.add('Failing', failing)
+        healthy = self.add('Healthy', lambda previous: Worker(previous))
+        self.supervisor.start()
+        first_healthy = healthy.instance
+
+        self.assertTrue(poll_until(self.supervisor, lambda: len(created) == 2))
+        self.assertIs(healthy.instance, first_healthy)
+        # Replacement can take over unfinished work of the dead instance
+        created[0].join(1)
+        self.assertIs(failed.instance.previous, created[0])
+
+    def test_gives_up_after_max_restarts(self):
+        self.add('Failing', lambda previous: Worker(previous, fail=True), {'max_restarts': 2})
+        self.supervisor.start()
+        self.assertFalse(poll_until(self.supervisor, lambda: False))
+
+    def test_non_fatal_component_keeps_being_retried(self):
+        created = []
+
+        def failing(previous):
+            created.append(Worker(previous, fail=True))
+            return created[-1]
+
+        self.add('Metrics', failing, {'max_restarts': 1, 'fatal': False})
+        self.supervisor.start()
+        self.assertTrue(poll_until(self.supervisor, lambda: len(created) >= 4))
+
+    def test_missed_heartbeat_counts_as_failure(self):
+        created = []
+
+        def factory(previous):
+            created.append(Worker(previous, stuck=not created))
+            return created[-1]
+
+        self.add('Stuck', factory, {'heartbeat_timeout': 0.1})
+        self.supervisor.start()
+        self.assertTrue(poll_until(self.supervisor, lambda: len(created) == 2))
+        self.assertFalse(created[0].wantRunning)
+        # Stuck instance was still alive, replacement starts without it
+        self.assertIsNone(created[1].previous)
+
+    def test_exclusive_waits_for_previous_instance(self):
+        created = []
+
+        def factory(previous):
+            created.append(Worker(previous, stuck=not created))
+            return created[-1]
+
+        self.add('Database', factory, {'heartbeat_timeout': 0.1, 'exclusive': True, 'stop_timeout': 5})
+        self.supervisor.start()
+        time.sleep(0.3)
+        self.assertTrue(self.supervisor.poll(0.1))
+        self.assertEqual(len(created), 1)
+
+        created[0].released.set()
+        self.assertTrue(poll_until(self.supervisor, lambda: len(created) == 2))
+        self.assertIs(created[1].previous, created[0])
+
+    def test_exclusive_gives_up_on_instance_that_does_not_stop(self):
+        self.add('Database', lambda previous: Worker(previous, stuck=True),
+                 {'heartbeat_timeout': 0.1, 'exclusive': True, 'stop_timeout': 0.1})
+        self.supervisor.start()
+        self.assertFalse(poll_until(self.supervisor, lambda: False))
+
+    def test_shutdown_drains_later_stage(self):
+        writer = self.add('Database', lambda previous: DrainingWorker(previous), stage=1)
+        producer = self.add('Scraper', lambda previous: Worker(previous))
+        self.supervisor.start()
+        self.supervisor.shutdown(join_timeout=1, drain_timeout=3)
+        self.assertFalse(producer.instance.is_alive())
+        self.assertFalse(writer.instance.is_alive())
+        self.assertEqual(writer.instance.drained, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
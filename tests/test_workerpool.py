@@ -0,0 +1,132 @@
+import threading
+import time
+import unittest
+from lib.scheduler import ScheduledJob
+from lib.workerpool import WorkerPool
+from tests import LOGGER
+
+
+class _Connection:
+    router_id = 'r1'
+
+    def get_api(self):
+        return None
+
+
+class _Connections:
+    def __init__(self):
+        self.released = []
+
+    def acquire(self, router_id):
+        return _Connection()
+
+    def release(self, connection, healthy=True):
+        self.released.append(healthy)
+
+    def close(self):
+        pass
+
+
+class _Flow:
+    # Flow whose run blocks until released, like a read on router that stopped answering
+    def __init__(self):
+        self.released = threading.Event()
+
+    def get_router_id(self):
+        return 'r1'
+
+    def get_flow_name(self):
+        return 'flow'
+
+    def execute(self, api):
+        self.released.wait(5)
+        yield {'name': 'flow', 'payload': [(1,)]}
+
+
+class _FailingFlow(_Flow):
+    def execute(self, api):
+        yield {'name': 'flow', 'payload': [(1,)]}
+        raise Exception('trap: no such command')
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_slow_flow_does_not_hold_up_others(self):
+        done = []
+        pool = WorkerPool(LOGGER, 'test', 2, _Connections(), lambda entry, job: None,
+                          lambda entry: done.append(entry.job))
+        pool.start()
+        slow, fast = _Flow(), _Flow()
+        fast.released.set()
+        try:
+            pool.submit(ScheduledJob(slow, 1, 'skip'))
+            pool.submit(ScheduledJob(fast, 1, 'skip'))
+            end = time.time() + 2
+            while not done and time.time() < end:
+                time.sleep(0.01)
+            self.assertEqual(done, [fast])
+        finally:
+            slow.released.set()
+            pool.stop(1)
+
+    def test_failed_flow_releases_connection_as_unhealthy(self):
+        connections = _Connections()
+        done = threading.Event()
+        results = []
+        pool = WorkerPool(LOGGER, 'test', 1, connections, lambda entry, job: results.append(job),
+                          lambda entry: done.set())
+        pool.start()
+        try:
+            pool.submit(ScheduledJob(_FailingFlow(), 1, 'skip'))
+            self.assertTrue(done.wait(2))
+            self.assertEqual(connections.released, [False])
+            self.assertEqual(len(results), 1)
+
+            # Worker keeps serving after failure
+            done.clear()
+            flow = _Flow()
+            flow.released.set()
+            pool.submit(ScheduledJob(flow, 1, 'skip'))
+            self.assertTrue(done.wait(2))
+            self.assertEqual(connections.released, [False, True])
+        finally:
+            pool.stop(1)
+
+    def test_overrun_reports_stuck_run(self):
+        results = []
+        done = threading.Event()
+        pool = WorkerPool(LOGGER, 'test', 1, _Connections(), lambda entry, job: results.append(job),
+                          lambda entry: done.set(), task_timeout=0.05)
+        pool.start()
+        flow = _Flow()
+        try:
+            pool.submit(ScheduledJob(flow, 1, 'skip'))
+            time.sleep(0.2)
+            overrun = pool.overrun()
+            self.assertEqual(len(overrun), 1)
+            self.assertEqual(overrun[0][:2], ('test-worker-0', flow))
+            self.assertTrue(overrun[0][2] >= 0.05)
+
+            flow.released.set()
+            self.assertTrue(done.wait(2))
+            self.assertEqual(pool.overrun(), [])
+            self.assertEqual(len(results), 1)
+        finally:
+            flow.released.set()
+            pool.stop(1)
+
+    def test_no_timeout_never_overruns(self):
+        pool = WorkerPool(LOGGER, 'test', 1, _Connections(), lambda entry, job: None, lambda entry: None)
+        pool.start()
+        flow = _Flow()
+        try:
+            pool.submit(ScheduledJob(flow, 1, 'skip'))
+            time.sleep(0.1)
+            self.assertEqual(pool.overrun(), [])
+        finally:
+            flow.released.set()
+            pool.stop(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
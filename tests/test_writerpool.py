@@ -0,0 +1,140 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from lib.spool import Spool
+from lib.statements import compile_statements
+from tests import LOGGER
+
+try:
+    import MySQLdb
+    from lib.writerpool import WriterPool
+except ImportError:
+    MySQLdb = None
+
+
+class _Client:
+    def ping(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def poll_until(condition, timeout=3):
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    raise AssertionError('Condition not met within {} sec'.format(timeout))
+
+
+@unittest.skipIf(MySQLdb is None, 'MySQLdb is not installed')
+class TestWriterPool(unittest.TestCase):
+
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.down = set()
+        self.written = []
+        self.lock = threading.Lock()
+        self.pool = None
+        self.released = threading.Event()
+
+    def tearDown(self):
+        self.released.set()
+        if self.pool:
+            self.pool.stop(2)
+        shutil.rmtree(self.location)
+
+    def connect(self):
+        if threading.current_thread().name in self.down:
+            raise MySQLdb.OperationalError(2003, "Can't connect")
+        return _Client()
+
+    def write(self, db_client, jobs):
+        if any(job['batch_id'] == 'stuck' for job in jobs):
+            self.released.wait(5)
+        with self.lock:
+            self.written.extend((threading.current_thread().name, job['batch_id']) for job in jobs)
+
+    def start(self, flows, spooled=True, write_timeout=0):
+        statements = compile_statements(LOGGER, flows)
+        create_spool = None
+        if spooled:
+            create_spool = lambda index: Spool(LOGGER, '{}/writer-{}'.format(self.location, index))
+        self.pool = WriterPool(LOGGER, 2, statements, self.connect, self.write, reconnect_initial=0.01,
+                               reconnect_max=0.02, create_spool=create_spool, write_timeout=write_timeout)
+        self.pool.start()
+        return statements
+
+    def tables(self):
+        # Two flows whose tables are written by different writers
+        flows = []
+        for index in range(10):
+            flow = {'name': 'flow{}'.format(index), 'mysql_type': 'INSERT', 'mysql_table': 't{}'.format(index),
+                    'params': ['a']}
+            writer = WriterPool(LOGGER, 2, {}, None, None)._writer_index(flow['mysql_table'])
+            if writer not in [known['writer'] for known in flows]:
+                flows.append(dict(flow, writer=writer))
+        return sorted(flows, key=lambda flow: flow['writer'])
+
+    def job(self, flow, batch_id):
+        return {'name': flow['name'], 'payload': [(1,)], 'batch_id': batch_id}
+
+    def test_down_writer_spools_while_others_write(self):
+        up, down = self.tables()
+        self.down.add('MySQLWriter-1')
+        self.start([up, down])
+        poll_until(lambda: self.pool._writers[0].connected)
+        self.assertTrue(self.pool.connected())
+
+        self.assertEqual(self.pool.write([self.job(up, 'u1'), self.job(down, 'd1')]), [])
+        self.assertEqual(self.pool.write([self.job(down, 'd2'), self.job(up, 'u2')]), [])
+        self.assertEqual(self.written, [('MySQLWriter-0', 'u1'), ('MySQLWriter-0', 'u2')])
+
+        # Spooled partitions go first, then the ones submitted after reconnect
+        self.down.clear()
+        poll_until(lambda: ('MySQLWriter-1', 'd2') in self.written)
+        self.pool.write([self.job(down, 'd3')])
+        self.assertEqual([batch_id for writer, batch_id in self.written if writer == 'MySQLWriter-1'],
+                         ['d1', 'd2', 'd3'])
+
+    def test_down_writer_without_spool_fails_partition(self):
+        up, down = self.tables()
+        self.down.add('MySQLWriter-1')
+        self.start([up, down], spooled=False)
+        poll_until(lambda: self.pool._writers[0].connected)
+        self.assertFalse(self.pool.connected())
+
+        failed = self.pool.write([self.job(up, 'u1'), self.job(down, 'd1')])
+        self.assertEqual([job['batch_id'] for job in failed], ['d1'])
+        self.assertEqual(self.written, [('MySQLWriter-0', 'u1')])
+
+    def test_stuck_writer_is_reported_and_not_waited_for(self):
+        up, stuck = self.tables()
+        self.start([up, stuck], write_timeout=0.2)
+        poll_until(lambda: all(writer.connected for writer in self.pool._writers))
+
+        failed = self.pool.write([self.job(up, 'u1'), self.job(stuck, 'stuck')])
+        self.assertEqual([job['batch_id'] for job in failed], ['stuck'])
+        self.assertEqual(self.written, [('MySQLWriter-0', 'u1')])
+        poll_until(lambda: [writer for writer, busy in self.pool.overrun()] == ['MySQLWriter-1'])
+
+        self.released.set()
+        poll_until(lambda: not self.pool.overrun())
+
+    def test_key_routed_job_is_split_by_key(self):
+        flow = {'name': 'leases', 'mysql_type': 'INSERT', 'mysql_table': 'leases', 'params': ['mac', 'ip'],
+                'writer_route': 'key'}
+        self.start([flow])
+        rows = [('mac{}'.format(index), 'ip') for index in range(20)]
+        self.assertEqual(self.pool.write([{'name': 'leases', 'payload': rows, 'batch_id': 'b'}]), [])
+        self.assertEqual(sorted(batch_id for writer, batch_id in self.written), ['b/0', 'b/1'])
+        for writer, batch_id in self.written:
+            self.assertEqual(writer, 'MySQLWriter-{}'.format(batch_id[-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,6 +3,7 @@ from threading import Thread
 from time import sleep
 from etc import config
 from lib.logger import get_logger
+from lib.supervisor import Health
 import sys
 
 
@@ -22,6 +23,8 @@ class APCScrapper(Thread):
         self._error_count = 0
         self.running = False
         self.wantRunning = True  # Can be changed from main
+        # Replaced by supervisor before start
+        self.health = Health()
 
         # Init API connection
         self._client = None
@@ -71,6 +74,7 @@ class APCScrapper(Thread):
         self.LOGGER.info("Starting loop")
 
         while True:
+            self.health.beat()
             try:
                 # If connecting failed sleep few seconds before retrying
                 if self._error_count > 0:
@@ -107,7 +111,7 @@ class APCScrapper(Thread):
                 if not ups_status:
                     self.LOGGER.error("Unable to retrieve UPS status")
                 else:
-                    self.LOGGER.debug("UPS status received:\n{}".format(ups_status))
+                    self.LOGGER.debug("UPS status received:\n{}", ups_status)
                     if 'On Line, No Alarms Present' not in ups_status:
                         self.LOGGER.warning("Invalid status detected!!!")
                     else:
@@ -116,9 +120,11 @@ class APCScrapper(Thread):
                 sleep(config.apc['status_retrieve_interval'])
 
             except Exception, e:
-                self.LOGGER.error("Unexpected exception in loop\n***{}".format(e))
+                self.LOGGER.error("Unexpected exception in loop\n***{}", e)
+                self.health.failed(e)
                 self.running = False
                 break
         # While loop broken
         self.LOGGER.warning("Thread exiting")
+        self.health.stopped()
         return
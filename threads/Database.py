@@ -1,15 +1,28 @@
-from threading import Thread
+from threading import Thread, Lock
 from time import sleep
+from collections import OrderedDict
 import MySQLdb
+import Queue
 import json
 from etc import config
 from lib.logger import get_logger
-import time
-from lib.flow import Flow
+from lib.supervisor import Health
+from lib.clock import monotonic
+from lib.bulkload import write_tsv
+from lib.statements import insert_chunks
+from lib.writerpool import WriterPool
+from lib.backoff import Backoff
+from lib.dedupe import RecentBatches
+from lib.mysqlerrors import is_connection_error
+from lib.spool import Spool
+from lib.metrics import BATCH_JOBS, BATCH_ROWS, MYSQL_EXECUTE_SECONDS, MYSQL_COMMIT_SECONDS, MYSQL_ROWS, \
+    MYSQL_CONNECTS
+import itertools
+import os
 
 class Database(Thread):
 
-    def __init__(self, in_received_queue):
+    def __init__(self, in_received_queue, statements, spool=None, carried_jobs=None, on_drop=None):
         # Setup thread stuff
         Thread.__init__(self)
         self.threadID = 1
@@ -18,47 +31,146 @@ class Database(Thread):
 
         # Setup inputs
         self._in_received_queue = in_received_queue
+        # Precompiled statements keyed by flow name
+        self._statements = statements
+        # Jobs go to on-disk spool while MySQL is down or input queue is too deep
+        self._spool = spool
+        spool_config = getattr(config, 'spool', None) or {}
+        # Offload has to start before input queue is full and producers block, default is 3/4 of its limit
+        max_jobs = int((getattr(config, 'queue', None) or {}).get('max_jobs', 1000))
+        self._spool_queue_depth = int(spool_config.get('queue_depth', max_jobs * 3 // 4 if max_jobs else 1000))
+        self._spool_replay_jobs = int(spool_config.get('replay_jobs', 100))
+        # Batches set aside after too many failed writes, kept next to the spool for inspection
+        self._rejected_location = spool_config.get('rejected_location') or \
+            (spool_config.get('location') and os.path.join(spool_config['location'], 'rejected'))
+        self._rejected = None
+        # Writer pool threads set aside their own spooled jobs
+        self._rejected_lock = Lock()
+        # Jobs that never reach their table are reported back so flows resync change detection
+        self._on_drop = on_drop
 
         self._db_client = None
 
         # Setup flags
         self.running = False
         self.wantRunning = True  # Can be changed from main
+        # Replaced by supervisor before start
+        self.health = Health()
         self.errorCount = 0
 
-        self._connect_db_client()
-
-        self._flows = []
-        for flow in config.flows:
-            try:
-                obj = Flow(self.LOGGER, flow)
-                self._flows.append(obj)
-            except Exception, e:
-                self.LOGGER.error("Could not setup flow [{}]\n{}".format(flow, e))
-
-    def __get_current_time_ms(self):
-        return int(time.time())
+        # Batching, pending jobs are flushed when row count or max latency is reached
+        self._batch_max_rows = int(config.mysql.get('batch_max_rows', 10000))
+        self._batch_max_latency = float(config.mysql.get('batch_max_latency', 1.0))
+        # Single multi-row INSERT is bounded so it stays below max_allowed_packet
+        self._insert_max_rows = int(config.mysql.get('insert_max_rows', 1000))
+        self._insert_max_bytes = int(config.mysql.get('insert_max_bytes', 1024 * 1024))
+        # Payloads of at least bulk_min_rows rows go through LOAD DATA LOCAL INFILE (0 disables),
+        # flows can force either path with 'bulk_ingest'
+        self._bulk_min_rows = int(config.mysql.get('bulk_min_rows', 0))
+        self._bulk_dir = config.mysql.get('bulk_dir')
+        self._bulk_enabled = bool(self._bulk_min_rows) or \
+            any(statement.bulk for statement in statements.values())
+        self._pending_jobs = []
+        self._pending_rows = 0
+        self._pending_since = None
+
+        # Jobs with batch id that was already written (retry, spool replay) are skipped
+        # Ledger table makes it survive restarts, it is written in the same transaction as the rows
+        self._recent_batches = RecentBatches(config.mysql.get('dedupe_cache', 100000))
+        self._batch_ledger = config.mysql.get('batch_ledger')
+
+        # Reconnect attempts back off exponentially with jitter and never give up,
+        # jobs stay in input queue (or spool) meanwhile
+        self._reconnect_initial = float(config.mysql.get('reconnect_initial', 1))
+        self._reconnect_max = float(config.mysql.get('reconnect_max', 60))
+        self._backoff = Backoff(self._reconnect_initial, self._reconnect_max)
+        self._next_connect_attempt = 0
+        # Set by drain(), until then shutdown leaves queued jobs behind
+        self._drain_until = None
+        # Batch that failed on lost connection without spool, written again first after reconnect
+        # Connection can drop after COMMIT reached the server, only batch_ledger keeps such batch
+        # from being written twice
+        # Restarted thread starts with jobs its failed predecessor did not write
+        self._retry_jobs = list(carried_jobs or [])
+        # Batch that loses the connection this many times in a row (oversized packet, statement
+        # that kills the server) is set aside so it doesn't block everything behind it
+        self._max_write_retries = int(config.mysql.get('max_write_retries', 5))
+        self._retry_attempts = 0
+        self._replay_attempts = 0
+        # (failed jobs, spool position) of replayed batch that was written only in part
+        self._replay_failed = None
+
+        # With more than one writer, batches are written in parallel on a connection per writer
+        # Writers connect and health check on their own, with spool each one keeps partitions it can't
+        # write in <location>/writer-<index> while the others go on
+        # Writer stuck in one MySQL call for write_timeout seconds fails the thread, restart gets fresh connections
+        self._writer_pool = None
+        writers = int(config.mysql.get('writers', 1))
+        if writers > 1:
+            create_spool = None
+            if spool_config.get('location'):
+                create_spool = lambda index: Spool(self.LOGGER,
+                                                   os.path.join(spool_config['location'], 'writer-{}'.format(index)),
+                                                   spool_config.get('segment_size', 16 * 1024 * 1024),
+                                                   spool_config.get('max_size', 1024 * 1024 * 1024),
+                                                   spool_config.get('fsync', False))
+            self._writer_pool = WriterPool(self.LOGGER, writers, statements, self._open_connection, self._write_jobs,
+                                           config.mysql.get('health_check_interval', 30),
+                                           self._reconnect_initial, self._reconnect_max, create_spool,
+                                           self._set_aside, self._max_write_retries, self._spool_replay_jobs,
+                                           config.mysql.get('write_timeout', 60))
+        else:
+            self._connect_db_client()
+
+    def _open_connection(self):
+        # Used by writer pool connections too
+        try:
+            db_client = MySQLdb.connect(config.mysql['host'],
+                                        config.mysql['username'],
+                                        config.mysql['password'],
+                                        config.mysql['db'],
+                                        local_infile=int(self._bulk_enabled))
+        except Exception:
+            MYSQL_CONNECTS.labels('error').inc()
+            raise
+        MYSQL_CONNECTS.labels('ok').inc()
+        if self._batch_ledger:
+            cursor = db_client.cursor()
+            cursor.execute("CREATE TABLE IF NOT EXISTS {} ("
+                           "batch_id VARCHAR(64) NOT NULL PRIMARY KEY, "
+                           "created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)".format(self._batch_ledger))
+            cursor.close()
+        return db_client
 
     def _connect_db_client(self):
         self.LOGGER.debug("Connecting to MySQL DB")
-        # If not connected block thread for 10 seconds and try again
         try:
-            self._db_client = MySQLdb.connect(config.mysql['host'],
-                                              config.mysql['username'],
-                                              config.mysql['password'],
-                                              config.mysql['db'])
+            self._db_client = self._open_connection()
+            self.errorCount = 0
+            self._backoff.reset()
             self.LOGGER.info("Connected to MySQL DB")
         except Exception, e:
+            self._db_client = None
             self.errorCount += 1
-            # If not connected block thread for few seconds and try again
-            self.LOGGER.error("Error connecting to MySQL DB\n***{}".format(e))
-            if self.errorCount < 3:
-                self.LOGGER.error("Sleeping for 5 seconds and trying again...")
-                sleep(5)
-                return self._connect_db_client()
-            else:
-                self.wantRunning = False
-                return
+            delay = self._backoff.next_delay()
+            self._next_connect_attempt = monotonic() + delay
+            self.LOGGER.error("Error connecting to MySQL DB, attempt {}, trying again in {:.1f} seconds\n***{}".format(
+                self.errorCount, delay, e))
+
+    def drain(self, timeout):
+        # Stop after writing queued and pending jobs, whatever is not written within timeout goes to spool
+        # Producers must be stopped first
+        self._drain_until = monotonic() + timeout
+        self.wantRunning = False
+
+    def unwritten_jobs(self):
+        # Jobs taken from input queue but not written yet, only meaningful once thread stopped
+        return self._retry_jobs + self._pending_jobs
+
+    def _is_connected(self):
+        if self._writer_pool:
+            return self._writer_pool.connected()
+        return self._db_client is not None and self._db_client.open
 
     def _disconnect_db_client(self):
         try:
@@ -68,36 +180,36 @@ class Database(Thread):
             self.LOGGER.error("Error disconnecting MySQL DB\n***{}".format(e))
 
     def _select_query(self, query):
-        self.LOGGER.debug("Executing select query\n{}".format(query))
+        self.LOGGER.debug("Executing select query\n{}", query)
         try:
             cursor = self._db_client.cursor()
             cursor.execute(query)
             results = cursor.fetchall()
             cursor.close()
             # self._db_client.commit()
-            self.LOGGER.debug("Got result\n{}".format(results))
+            self.LOGGER.debug("Got result\n{}", results)
 
             return results
         except Exception, e:
-            self.LOGGER.error("Error executing select query\n{}\n***{}".format(query, e))
+            self.LOGGER.error("Error executing select query\n{}\n***{}", query, e)
             return None
 
     def _update_query(self, query, args):
-        self.LOGGER.debug("Executing update query\n{}with agruments:\n{}".format(query, args))
+        self.LOGGER.debug("Executing update query\n{}with agruments:\n{}", query, args)
         try:
             cursor = self._db_client.cursor()
             sql_query = query.format(*args)
-            self.LOGGER.debug("Merged query:\n{}".format(sql_query))
+            self.LOGGER.debug("Merged query:\n{}", sql_query)
             affected_rows = cursor.execute(sql_query)
             self._db_client.commit()
             cursor.close()
             return affected_rows
         except Exception, e:
-            self.LOGGER.error("Error executing update query {}\nwith agruments:\n{}\n***{}".format(query, args, e))
+            self.LOGGER.error("Error executing update query {}\nwith agruments:\n{}\n***{}", query, args, e)
             return None
 
     def _insert_query(self, query, args):
-        self.LOGGER.debug("Executing insert query\n{}\nwith agruments:\n{}".format(query, args))
+        self.LOGGER.debug("Executing insert query\n{}\nwith agruments:\n{}", query, args)
         try:
             cursor = self._db_client.cursor()
             affected_rows = cursor.executemany(query, args)
@@ -106,7 +218,7 @@ class Database(Thread):
             self.LOGGER.debug('Data inserted successfully')
             return affected_rows
         except Exception, e:
-            self.LOGGER.error("Error executing update query {}\nwith agruments:\n{}\n***{}".format(query, args, e))
+            self.LOGGER.error("Error executing insert query {}\nwith agruments:\n{}\n***{}", query, args, e)
             return None
 
     def _run_stored_procedure(self, sp_name, in_vars=None, out_vars=None, commit=True):
@@ -115,11 +227,11 @@ class Database(Thread):
             'err_desc': 'str'
         }
 
-        self.LOGGER.debug("Starting stored procedure [{}]".format(sp_name))
-        self.LOGGER.debug("IN vars [{}]".format(in_vars))
-        self.LOGGER.debug("OUT vars [{}]".format(out_vars))
+        self.LOGGER.debug("Starting stored procedure [{}]", sp_name)
+        self.LOGGER.debug("IN vars [{}]", in_vars)
+        self.LOGGER.debug("OUT vars [{}]", out_vars)
 
-        time_start = self.__get_current_time_ms()
+        time_start = monotonic()
 
         response = True
         try:
@@ -143,7 +255,7 @@ class Database(Thread):
                     except Exception:
                         self.LOGGER.error("Output variable [{}] type not defined".format(var))
                         raise
-            self.LOGGER.debug("Stored procedure vars [{}]".format(sp_args))
+            self.LOGGER.debug("Stored procedure vars [{}]", sp_args)
 
             # Run stored procedure, RAISE an exception if failed
             result_sp = cursor.callproc(sp_name, sp_args)
@@ -152,7 +264,7 @@ class Database(Thread):
                 self.LOGGER.error("Unable to run stored procedure")
                 raise Exception
 
-            self.LOGGER.debug("Stored procedure executed successfully {}".format(result_sp))
+            self.LOGGER.debug("Stored procedure executed successfully {}", result_sp)
 
             # If there are out vars let's get their values after running stored procedure
             if out_vars:
@@ -175,7 +287,7 @@ class Database(Thread):
                         select_list.append(select_item)
 
                     select_query = "SELECT " + ",".join(select_list)
-                    self.LOGGER.debug("Running select query after stored procedure [{}]".format(select_query))
+                    self.LOGGER.debug("Running select query after stored procedure [{}]", select_query)
 
                     # Execute select query
                     result_select = cursor.execute(select_query)
@@ -186,7 +298,7 @@ class Database(Thread):
                     # Build response dictionary
                     select_results = cursor.fetchall()
 
-                self.LOGGER.debug("Raw results: [{}]".format(select_results))
+                self.LOGGER.debug("Raw results: [{}]", select_results)
                 response = {}
                 for idx, var_name in enumerate(out_vars):
                     if __outvar_types[var_name] == 'int':
@@ -200,7 +312,7 @@ class Database(Thread):
                         except:
                             response[var_name] = ''
 
-            self.LOGGER.debug("Parsed results: [{}]".format(response))
+            self.LOGGER.debug("Parsed results: [{}]", response)
 
             cursor.close()
 
@@ -214,18 +326,361 @@ class Database(Thread):
             self.LOGGER.error("Error executing stored procedure >> {}".format(e))
             response = False
 
-        time_end = self.__get_current_time_ms()
-        time_diff = float(time_end - time_start) / 1000
-        self.LOGGER.debug("[TIMING][STORED PROCEDURE] {} sec".format(time_diff))
+        self.LOGGER.debug("[TIMING][STORED PROCEDURE] {:.3f} sec", monotonic() - time_start)
 
         return response
 
+    def _write_rows(self, cursor, statement, payloads):
+        affected_rows = 0
+        for args, row_count in insert_chunks(payloads, self._insert_max_rows, self._insert_max_bytes):
+            affected_rows += cursor.execute(statement.query(row_count), args)
+        return affected_rows
+
+    def _use_bulk(self, statement, row_count):
+        if statement.bulk is not None:
+            return statement.bulk
+        return bool(self._bulk_min_rows) and row_count >= self._bulk_min_rows
+
+    def _bulk_write_rows(self, cursor, statement, payloads):
+        # Whole payload in one LOAD DATA, ON_FAIL_UPDATE flows load to temporary table and merge from it
+        path = write_tsv(itertools.chain.from_iterable(payloads), self._bulk_dir)
+        try:
+            affected_rows = 0
+            for query in statement.bulk_queries:
+                if '%s' in query:
+                    affected_rows = cursor.execute(query, (path,))
+                else:
+                    result = cursor.execute(query)
+                    if query.startswith('INSERT'):
+                        affected_rows = result
+            return affected_rows
+        finally:
+            os.remove(path)
+
+    def _delete_keys(self, cursor, statement, keys):
+        affected_rows = 0
+        for start in range(0, len(keys), self._insert_max_rows):
+            chunk = keys[start:start + self._insert_max_rows]
+            args = [value for key in chunk for value in key]
+            affected_rows += cursor.execute(statement.delete_query(len(chunk)), args)
+        return affected_rows
+
+    def _add_pending(self, job):
+        if not self._pending_jobs:
+            self._pending_since = monotonic()
+        self._pending_jobs.append(job)
+        self._pending_rows += len(job['payload'])
+
+    def _collect_jobs(self):
+        # Block until first job arrives or pending batch is due, then drain whatever else is queued
+        if self._pending_jobs:
+            timeout = max(self._pending_since + self._batch_max_latency - monotonic(), 0)
+        else:
+            timeout = self._batch_max_latency
+
+        try:
+            self._add_pending(self._in_received_queue.get(timeout=timeout))
+            while self._pending_rows < self._batch_max_rows:
+                self._add_pending(self._in_received_queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+    def _batch_due(self):
+        if not self._pending_jobs:
+            return False
+        return self._pending_rows >= self._batch_max_rows or \
+            monotonic() - self._pending_since >= self._batch_max_latency
+
+    def _take_pending(self):
+        jobs = self._pending_jobs
+        self._pending_jobs = []
+        self._pending_rows = 0
+        self._pending_since = None
+        return jobs
+
+    def _new_jobs(self, cursor, jobs):
+        # Drop jobs whose batch was already written, jobs without batch id are always written
+        new_jobs = []
+        batch_ids = set()
+        for job in jobs:
+            batch_id = job.get('batch_id')
+            if batch_id is not None:
+                if batch_id in batch_ids or self._recent_batches.seen(batch_id):
+                    continue
+                batch_ids.add(batch_id)
+            new_jobs.append(job)
+
+        if self._batch_ledger and batch_ids:
+            cursor.execute("SELECT batch_id FROM {} WHERE batch_id IN ({})".format(
+                self._batch_ledger, ", ".join("%s" for x in batch_ids)), list(batch_ids))
+            written = set(row[0] for row in cursor.fetchall())
+            if written:
+                new_jobs = [job for job in new_jobs if job.get('batch_id') not in written]
+                self._recent_batches.add(written)
+
+        if len(new_jobs) < len(jobs):
+            self.LOGGER.info("Skipping {} already written jobs".format(len(jobs) - len(new_jobs)))
+        return new_jobs
+
+    def _record_batches(self, cursor, batch_ids):
+        for start in range(0, len(batch_ids), self._insert_max_rows):
+            chunk = batch_ids[start:start + self._insert_max_rows]
+            cursor.execute("INSERT INTO {} (batch_id) VALUES {}".format(
+                self._batch_ledger, ", ".join("(%s)" for x in chunk)), chunk)
+
+    def _write_jobs(self, db_client, jobs):
+        """
+        Write jobs in one transaction
+        Connection errors are raised so caller can keep the jobs. On other errors the batch is rolled back
+        and written again job by job, so one bad flow doesn't take the jobs of other flows with it
+        """
+        error = self._try_write(db_client, jobs)
+        if error is None:
+            return
+        if len(jobs) == 1:
+            self.LOGGER.error("Dropping job of flow {}, {} rows\n***{}".format(jobs[0]['name'],
+                                                                              len(jobs[0]['payload']), error))
+            self._report_dropped(jobs)
+            return
+
+        self.LOGGER.error("Error writing batch of {} jobs, writing them one by one\n***{}".format(len(jobs), error))
+        dropped = 0
+        for job in jobs:
+            error = self._try_write(db_client, [job])
+            if error is not None:
+                dropped += 1
+                self.LOGGER.error("Dropping job of flow {}, {} rows\n***{}".format(job['name'], len(job['payload']),
+                                                                                  error))
+                self._report_dropped([job])
+        self.LOGGER.info("Wrote {} of {} jobs one by one".format(len(jobs) - dropped, len(jobs)))
+
+    def _try_write(self, db_client, jobs):
+        # Returns error the transaction was rolled back on, connection errors are raised
+        cursor = db_client.cursor()
+        try:
+            jobs = self._new_jobs(cursor, jobs)
+            batch_ids = [job['batch_id'] for job in jobs if job.get('batch_id') is not None]
+
+            # Group job payloads by flow so each table gets its rows in as few statements as possible
+            # Deletes split the group so a key removed and re-added later in the batch ends up inserted
+            grouped = OrderedDict()
+            for job in jobs:
+                operations = grouped.setdefault(job['name'], [])
+                if job.get('deleted'):
+                    operations.append(('delete', job['deleted']))
+                if len(job['payload']):
+                    if operations and operations[-1][0] == 'insert':
+                        operations[-1][1].append(job['payload'])
+                    else:
+                        operations.append(('insert', [job['payload']]))
+
+            for job_name, operations in grouped.items():
+                # Job names are validated by the queue, lookup can't miss
+                statement = self._statements[job_name]
+                for operation, values in operations:
+                    if operation == 'delete':
+                        time_start = monotonic()
+                        affected_rows = self._delete_keys(cursor, statement, values)
+                        MYSQL_EXECUTE_SECONDS.labels(job_name, operation).observe(monotonic() - time_start)
+                        self.LOGGER.info("Delete for {} finished, {} keys, {} affected".format(job_name, len(values),
+                                                                                            affected_rows))
+                    else:
+                        row_count = sum(len(payload) for payload in values)
+                        bulk = self._use_bulk(statement, row_count)
+                        time_start = monotonic()
+                        if bulk:
+                            affected_rows = self._bulk_write_rows(cursor, statement, values)
+                        else:
+                            affected_rows = self._write_rows(cursor, statement, values)
+                        elapsed = max(monotonic() - time_start, 1e-6)
+                        MYSQL_EXECUTE_SECONDS.labels(job_name, 'bulk' if bulk else operation).observe(elapsed)
+                        MYSQL_ROWS.labels(job_name).inc(row_count)
+                        self.LOGGER.info("{} for {} finished, {} rows, {} affected, {:.0f} rows/sec".format(
+                            'Bulk load' if bulk else 'Insert', job_name, row_count, affected_rows,
+                            row_count / elapsed))
+
+            if self._batch_ledger and batch_ids:
+                self._record_batches(cursor, batch_ids)
+
+            # One commit per batch
+            time_start = monotonic()
+            db_client.commit()
+            MYSQL_COMMIT_SECONDS.observe(monotonic() - time_start)
+            self._recent_batches.add(batch_ids)
+            return None
+        except Exception, e:
+            if is_connection_error(e):
+                # Connection problem, let the caller handle it
+                raise
+            db_client.rollback()
+            return e
+        finally:
+            cursor.close()
+
+    def _write_batch(self, jobs):
+        # Returns jobs that were not written because MySQL connection was lost
+        BATCH_JOBS.observe(len(jobs))
+        BATCH_ROWS.observe(sum(len(job['payload']) for job in jobs))
+        if self._writer_pool:
+            return self._writer_pool.write(jobs)
+        try:
+            self._write_jobs(self._db_client, jobs)
+            return []
+        except MySQLdb.OperationalError, e:
+            self.LOGGER.error("Lost MySQL connection writing batch\n***{}".format(e))
+            self._disconnect_db_client()
+            self._db_client = None
+            return jobs
+
+    def _keep_failed(self, failed):
+        if self._spool:
+            self._spool_jobs(failed)
+        else:
+            self.LOGGER.warning("Keeping {} jobs to retry after reconnect".format(len(failed)))
+            self._retry_jobs.extend(failed)
+
+    def _flush_batch(self):
+        failed = self._write_batch(self._take_pending())
+        if failed:
+            self._keep_failed(failed)
+
+    def _retry_failed(self):
+        jobs = self._retry_jobs
+        self._retry_jobs = self._write_batch(jobs)
+        if not self._retry_jobs:
+            self._retry_attempts = 0
+            self.LOGGER.info("Retried {} jobs after reconnect".format(len(jobs)))
+            return
+
+        self._retry_attempts += 1
+        if self._retry_attempts >= self._max_write_retries:
+            self._set_aside(self._retry_jobs, self._retry_attempts)
+            self._retry_jobs = []
+            self._retry_attempts = 0
+
+    def _report_dropped(self, jobs):
+        if self._on_drop:
+            for job in jobs:
+                self._on_drop(job)
+
+    def _set_aside(self, jobs, attempts):
+        # Set aside jobs are not in their table either
+        self._report_dropped(jobs)
+        with self._rejected_lock:
+            if self._rejected is None and self._rejected_location:
+                spool_config = getattr(config, 'spool', None) or {}
+                self._rejected = Spool(self.LOGGER, self._rejected_location,
+                                       spool_config.get('segment_size', 16 * 1024 * 1024),
+                                       spool_config.get('max_size', 1024 * 1024 * 1024),
+                                       spool_config.get('fsync', False))
+        if self._rejected is None:
+            self.LOGGER.error("Dropping {} jobs after {} failed writes, spool is not configured".format(
+                len(jobs), attempts))
+            return
+        self.LOGGER.error("Setting {} jobs aside to {} after {} failed writes".format(
+            len(jobs), self._rejected_location, attempts))
+        for job in jobs:
+            self._rejected.append(job)
+
+    def _spool_jobs(self, jobs):
+        for job in jobs:
+            self._spool.append(job)
+
+    def _spool_queue(self, timeout=0):
+        # Move pending and queued jobs to spool, optionally block until first job arrives
+        self._spool_jobs(self._take_pending())
+        try:
+            if timeout:
+                self._spool.append(self._in_received_queue.get(timeout=timeout))
+            while True:
+                self._spool.append(self._in_received_queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+    def _replay_spool(self):
+        # New jobs are spooled too while replay is in progress so order is preserved
+        self._spool_queue()
+
+        if self._replay_failed:
+            # Only what failed last time, writer pool partitions that were written are not written again
+            jobs, position = self._replay_failed
+        else:
+            jobs, position = self._spool.read(self._spool_replay_jobs)
+        if jobs:
+            failed = self._write_batch(jobs)
+            if failed:
+                self._replay_attempts += 1
+                if self._replay_attempts < self._max_write_retries:
+                    # Read position is kept until failed jobs are written too, if writer stops meanwhile
+                    # whole batch is replayed on next start and only batch_ledger skips the written part
+                    self._replay_failed = (failed, position)
+                    return
+                self._set_aside(failed, self._replay_attempts)
+            else:
+                self.LOGGER.info("Replayed {} jobs from spool".format(len(jobs)))
+        self._replay_failed = None
+        self._replay_attempts = 0
+        self._spool.commit(position)
+
+    def _drain(self):
+        jobs = self._retry_jobs + self._take_pending()
+        self._retry_jobs = []
+        try:
+            while True:
+                jobs.append(self._in_received_queue.get_nowait())
+        except Queue.Empty:
+            pass
+
+        flushed_rows = 0
+        # Spooled jobs are older, writing new ones before them would break order
+        behind_spool = self._spool is not None and not self._spool.empty()
+        while jobs and not behind_spool and monotonic() < self._drain_until:
+            if not self._writer_pool and not self._is_connected():
+                self._connect_db_client()
+            if not self._is_connected():
+                break
+
+            batch_rows = 0
+            count = 0
+            while count < len(jobs) and (not count or batch_rows < self._batch_max_rows):
+                batch_rows += len(jobs[count]['payload'])
+                count += 1
+            batch, jobs = jobs[:count], jobs[count:]
+            failed = self._write_batch(batch)
+            if failed:
+                # Connection was lost, retrying until deadline would only delay shutdown, rest goes to spool
+                jobs = failed + jobs
+                flushed_rows += batch_rows - sum(len(job['payload']) for job in failed)
+                break
+            flushed_rows += batch_rows
+
+        deferred_rows = sum(len(job['payload']) for job in jobs)
+        if jobs and self._spool:
+            self._spool_jobs(jobs)
+            self._spool.close()
+            self.LOGGER.info("Drained {} rows, {} rows ({} jobs) deferred to spool for next start".format(
+                flushed_rows, deferred_rows, len(jobs)))
+        elif jobs:
+            self.LOGGER.error("Drained {} rows, {} rows ({} jobs) lost, spool is not configured".format(
+                flushed_rows, deferred_rows, len(jobs)))
+            self._report_dropped(jobs)
+        else:
+            self.LOGGER.info("Drained {} rows, nothing deferred".format(flushed_rows))
+
     def run(self):
         self.running = True
         self.LOGGER.info("Starting loop")
+        if self._writer_pool:
+            self._writer_pool.start()
         while True:
-            time_start = self.__get_current_time_ms()
+            self.health.beat()
+            time_start = monotonic()
             try:
+                # Main wants out, write what is left in memory first
+                if not self.wantRunning and self._drain_until is not None:
+                    self._drain()
+                    self._drain_until = None
+
                 # Call disconnect if main wants to quit and client is still connected
                 if not self.wantRunning and self._db_client and self._db_client.open:
                     self.LOGGER.info("Disconnecting MySQL client")
@@ -237,58 +692,66 @@ class Database(Thread):
                     self.running = False
                     break
 
+                overrun = self._writer_pool.overrun() if self._writer_pool else None
+                if overrun:
+                    reason = "{} stuck in MySQL call for {:.0f} sec".format(*overrun[0])
+                    self.LOGGER.error("{}, breaking loop".format(reason))
+                    self.health.failed(reason)
+                    self.running = False
+                    break
+
                 # Connect client
-                if not self._db_client or not self._db_client.open:
+                if not self._writer_pool and not self._is_connected() and \
+                        monotonic() >= self._next_connect_attempt:
                     self.LOGGER.info("Connecting DB client")
-                    return self._connect_db_client()
-
-                # Check if there are updated topics by MQTT
-                # If found insert event in DB so we can work it in next step
-                if not self._in_received_queue.empty():
-                    job = self._in_received_queue.get()
-                    job_name = job['name']
-                    job_payload = job['payload']
-
-                    for flow in self._flows:
-                        if flow.get_flow_name() == job_name:
-                            mysql_type = flow.get_flow_mysql_type()
-                            mysql_table = flow.get_flow_mysql_table()
-                            mysql_params = flow.get_params()
-                            query = ""
-                            if mysql_type.startswith('INSERT'):
-                                query += "INSERT INTO "
-                            else:
-                                raise Exception('Unknown mysql type {}'.format(mysql_type))
-
-                            query += "{} ({}) ".format(mysql_table, ", ".join(mysql_params))
-                            query += "VALUES ({}) ".format(", ".join("%s" for x in mysql_params))
-
-                            if "ON_FAIL_UPDATE" in mysql_type:
-                                query += "ON DUPLICATE KEY UPDATE {} ".format(
-                                    ", ".join("{0} = VALUES({0})".format(param) for param in mysql_params)
-                                )
-
-                            if mysql_type.startswith('INSERT'):
-                                self._insert_query(query, job_payload)
-                                self.LOGGER.info("Insert for {} finished".format(job['name']))
-                            break
+                    self._connect_db_client()
+
+                if not self._is_connected():
+                    # MySQL is down, keep input queue empty by moving jobs to spool
+                    # Without spool jobs are buffered in input queue up to its limits
+                    if self._spool:
+                        self._spool_queue(timeout=1)
                     else:
-                        self.LOGGER.error("Could not find configured flow [{}]".format(job['name']))
+                        sleep(min(max(self._next_connect_attempt - monotonic(), 0.1), 1))
+                    continue
+
+                # Batch interrupted by lost connection goes first
+                if self._retry_jobs:
+                    self._retry_failed()
+                    continue
+
+                # Replay spooled jobs in order before taking new ones from queue
+                if self._spool and not self._spool.empty():
+                    self._replay_spool()
+                    continue
+
+                # Block on queue until jobs arrive, flush when batch is big enough or old enough
+                self._collect_jobs()
+
+                # Writer can't keep up, offload queue to spool
+                if self._spool and self._in_received_queue.qsize() > self._spool_queue_depth:
+                    self.LOGGER.warning("Input queue over {} jobs, spooling".format(self._spool_queue_depth))
+                    self._spool_queue()
+                    continue
+
+                if not self._batch_due():
+                    continue
 
-                    self._db_client.commit()
+                self._flush_batch()
             except Exception, e:
-                self.LOGGER.error("Unexpected exception in loop\n***{}".format(e))
+                self.LOGGER.error("Unexpected exception in loop\n***{}", e)
+                self.health.failed(e)
                 self.running = False
-                if self._db_client.open:
+                if self._db_client and self._db_client.open:
                     self.LOGGER.info("Disconnecting MySQL client")
                     self._disconnect_db_client()
                 break
 
-            time_end = self.__get_current_time_ms()
-            time_diff = float(time_end - time_start) / 1000
-            self.LOGGER.debug("[TIMING][LOOP] {} sec".format(time_diff))
+            self.LOGGER.debug("[TIMING][LOOP] {:.3f} sec", monotonic() - time_start)
 
-            sleep(.5)
         # While loop broken
+        if self._writer_pool:
+            self._writer_pool.stop()
         self.LOGGER.warning("Database Thread exiting")
+        self.health.stopped()
         return
@@ -0,0 +1,310 @@
+from threading import Thread
+from time import sleep
+import MySQLdb
+import time
+from etc import config
+from lib.logger import get_logger
+from lib.supervisor import Health
+from lib.clock import monotonic
+from lib.mysqlerrors import is_connection_error
+
+
+class IoBudget:
+    """
+    Keeps maintenance queries within a fraction of wall time
+    After every statement caller sleeps long enough that busy time / total time stays at budget
+    """
+
+    def __init__(self, budget):
+        self._budget = min(max(float(budget), 0.01), 1.0)
+        self._started = None
+
+    def start(self):
+        self._started = monotonic()
+
+    def pause(self):
+        busy = monotonic() - self._started
+        return busy * (1 - self._budget) / self._budget
+
+
+class Maintenance(Thread):
+    """
+    Downsamples stored flow tables and enforces retention
+    Every level rolls up the previous one (raw -> minute -> hour -> day) one complete bucket window at a time.
+    Processed time is kept in watermark table and advanced in the same transaction as the rollup insert,
+    so no row is aggregated twice. Rows older than retention are removed with chunked deletes or partition drops.
+
+    config.maintenance = {
+        'interval': 60, 'io_budget': 0.2, 'chunk_rows': 5000, 'max_buckets': 60, 'delay': 120,
+        'tables': [{
+            'table': 'lan_traffic_usage', 'time_column': 'created', 'retention': 7 * 86400,
+            'group_by': ['local_ip', 'traffic_type'], 'sum': ['bytes', 'packets'],
+            'resolutions': [{'table': 'lan_traffic_minute', 'bucket': 60, 'retention': 30 * 86400},
+                            {'table': 'lan_traffic_hour', 'bucket': 3600, 'retention': 365 * 86400},
+                            {'table': 'lan_traffic_day', 'bucket': 86400}]
+        }]
+    }
+    Resolution tables have 'bucket' column (or 'bucket_column'), group_by and sum columns and unique key on
+    bucket + group_by. Tables with 'partitions': 'TO_DAYS' or 'UNIX_TIMESTAMP' (RANGE partitioning expression)
+    drop whole expired partitions instead of deleting rows. Tables without resolutions (ex Database batch
+    ledger, {'table': 'batch_ledger', 'time_column': 'created', 'retention': 86400}) only get retention.
+    """
+
+    def __init__(self, ingest_queue=None):
+        # Setup thread stuff
+        Thread.__init__(self)
+        self.threadID = 4
+        self.daemon = True
+        self.LOGGER = get_logger(type(self).__name__)
+
+        maintenance = config.maintenance
+        self._tables = maintenance.get('tables', [])
+        self._interval = float(maintenance.get('interval', 60))
+        self._chunk_rows = int(maintenance.get('chunk_rows', 5000))
+        # Buckets rolled up per statement, bounds statement run time
+        self._max_buckets = int(maintenance.get('max_buckets', 60))
+        # Raw rows may still arrive this many seconds after their bucket ends
+        self._delay = int(maintenance.get('delay', 120))
+        self._watermark_table = maintenance.get('watermark_table', 'maintenance_watermarks')
+        self._budget = IoBudget(maintenance.get('io_budget', 0.2))
+        # Ingest has priority, maintenance waits while Database input queue is deeper than this
+        self._ingest_queue = ingest_queue
+        self._max_ingest_backlog = int(maintenance.get('max_ingest_backlog', 100))
+
+        self._db_client = None
+
+        # Setup flags
+        self.running = False
+        self.wantRunning = True  # Can be changed from main
+        # Replaced by supervisor before start
+        self.health = Health()
+        self._next_run = 0
+
+    def _connect_db_client(self):
+        self.LOGGER.debug("Connecting to MySQL DB")
+        try:
+            self._db_client = MySQLdb.connect(config.mysql['host'],
+                                              config.mysql['username'],
+                                              config.mysql['password'],
+                                              config.mysql['db'])
+            self._execute("CREATE TABLE IF NOT EXISTS {} ("
+                          "name VARCHAR(191) NOT NULL PRIMARY KEY, "
+                          "watermark BIGINT NOT NULL)".format(self._watermark_table))
+            self._db_client.commit()
+            self.LOGGER.info("Connected to MySQL DB")
+        except Exception, e:
+            self.LOGGER.error("Error connecting to MySQL DB\n***{}".format(e))
+            self._disconnect_db_client()
+
+    def _disconnect_db_client(self):
+        if self._db_client:
+            try:
+                self._db_client.close()
+            except Exception, e:
+                self.LOGGER.error("Error disconnecting MySQL DB\n***{}".format(e))
+        self._db_client = None
+
+    def _execute(self, query, args=None):
+        cursor = self._db_client.cursor()
+        try:
+            affected_rows = cursor.execute(query, args)
+            return affected_rows, cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def _throttle(self):
+        # Sleep off the time spent in last statement, then wait for ingest backlog to clear
+        delay = self._budget.pause()
+        while self.wantRunning:
+            self.health.beat()
+            if delay > 0:
+                sleep(min(delay, 1))
+                delay -= 1
+                continue
+            if self._ingest_queue is None or self._ingest_queue.qsize() <= self._max_ingest_backlog:
+                break
+            sleep(1)
+        return self.wantRunning
+
+    # Watermarks, unix timestamp up to which source rows were rolled up
+
+    def _get_watermark(self, name):
+        affected_rows, rows = self._execute("SELECT watermark FROM {} WHERE name = %s".format(self._watermark_table),
+                                            (name,))
+        return int(rows[0][0]) if rows else None
+
+    def _set_watermark(self, name, watermark):
+        self._execute("INSERT INTO {} (name, watermark) VALUES (%s, %s) "
+                      "ON DUPLICATE KEY UPDATE watermark = VALUES(watermark)".format(self._watermark_table),
+                      (name, watermark))
+
+    def _first_bucket(self, source, time_column, bucket):
+        affected_rows, rows = self._execute("SELECT UNIX_TIMESTAMP(MIN({})) FROM {}".format(time_column, source))
+        if not rows or rows[0][0] is None:
+            return None
+        return int(rows[0][0]) // bucket * bucket
+
+    # Downsampling
+
+    def _rollup_query(self, source, time_column, resolution, group_by, sums):
+        bucket = int(resolution['bucket'])
+        columns = [resolution.get('bucket_column', 'bucket')] + group_by + sums
+        return ("INSERT INTO {target} ({columns}) "
+                "SELECT FROM_UNIXTIME(UNIX_TIMESTAMP({time}) DIV {bucket} * {bucket}), {select} "
+                "FROM {source} WHERE {time} >= FROM_UNIXTIME(%s) AND {time} < FROM_UNIXTIME(%s) "
+                "GROUP BY 1{group_by} "
+                "ON DUPLICATE KEY UPDATE {update}").format(
+            target=resolution['table'],
+            columns=", ".join(columns),
+            time=time_column,
+            bucket=bucket,
+            select=", ".join(group_by + ["SUM({})".format(column) for column in sums]),
+            source=source,
+            group_by="".join(", {}".format(column) for column in group_by),
+            update=", ".join("{0} = {0} + VALUES({0})".format(column) for column in sums))
+
+    def _downsample(self, source, time_column, resolution, group_by, sums):
+        """
+        Roll up complete buckets of source into resolution table, returns False if interrupted
+        """
+        name = '{}:{}'.format(source, resolution['table'])
+        bucket = int(resolution['bucket'])
+        query = self._rollup_query(source, time_column, resolution, group_by, sums)
+        # Only buckets that can't receive more rows are processed
+        end = (int(time.time()) - self._delay) // bucket * bucket
+
+        watermark = self._get_watermark(name)
+        if watermark is None:
+            watermark = self._first_bucket(source, time_column, bucket)
+            if watermark is None:
+                return True
+
+        while watermark < end:
+            window_end = min(watermark + bucket * self._max_buckets, end)
+            self._budget.start()
+            affected_rows, rows = self._execute(query, (watermark, window_end))
+            self._set_watermark(name, window_end)
+            self._db_client.commit()
+            self.LOGGER.debug("Rolled up {} [{} - {}) into {}, {} affected", source, watermark, window_end,
+                              resolution['table'], affected_rows)
+            watermark = window_end
+            if not self._throttle():
+                return False
+        return True
+
+    # Retention
+
+    def _drop_partitions(self, table, partitions, cutoff):
+        # Partition holds rows with expression value LESS THAN description, drop partitions entirely below cutoff
+        if partitions == 'TO_DAYS':
+            affected_rows, rows = self._execute("SELECT TO_DAYS(FROM_UNIXTIME(%s))", (cutoff,))
+            cutoff = int(rows[0][0])
+        elif partitions != 'UNIX_TIMESTAMP':
+            raise Exception('Unknown partition expression {} for table {}'.format(partitions, table))
+
+        affected_rows, rows = self._execute("SELECT PARTITION_NAME, PARTITION_DESCRIPTION "
+                                            "FROM information_schema.PARTITIONS "
+                                            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+                                            "AND PARTITION_DESCRIPTION <> 'MAXVALUE'", (table,))
+        expired = [name for name, description in rows if description is not None and int(description) <= cutoff]
+        if expired:
+            self._budget.start()
+            self._execute("ALTER TABLE {} DROP PARTITION {}".format(table, ", ".join(expired)))
+            self.LOGGER.info("Dropped {} expired partitions of {}".format(len(expired), table))
+            return self._throttle()
+        return True
+
+    def _delete_expired(self, table, time_column, cutoff):
+        query = "DELETE FROM {} WHERE {} < FROM_UNIXTIME(%s) LIMIT {}".format(table, time_column, self._chunk_rows)
+        deleted = 0
+        while True:
+            self._budget.start()
+            affected_rows, rows = self._execute(query, (cutoff,))
+            self._db_client.commit()
+            deleted += affected_rows
+            if affected_rows < self._chunk_rows:
+                break
+            if not self._throttle():
+                return False
+        if deleted:
+            self.LOGGER.info("Deleted {} expired rows from {}".format(deleted, table))
+        return self._throttle()
+
+    def _enforce_retention(self, table):
+        if not table.get('retention'):
+            return True
+        cutoff = int(time.time()) - int(table['retention'])
+        if table.get('partitions'):
+            return self._drop_partitions(table['table'], table['partitions'], cutoff)
+        return self._delete_expired(table['table'], table['time_column'], cutoff)
+
+    def _maintain(self, table):
+        group_by = list(table.get('group_by', []))
+        sums = list(table.get('sum', []))
+        source = table['table']
+        time_column = table['time_column']
+        levels = [table]
+        for resolution in table.get('resolutions', []):
+            if not self._downsample(source, time_column, resolution, group_by, sums):
+                return False
+            # Next resolution is rolled up from this one
+            source = resolution['table']
+            time_column = resolution.get('bucket_column', 'bucket')
+            levels.append(dict(resolution, time_column=time_column))
+
+        for level in levels:
+            if not self._enforce_retention(level):
+                return False
+        return True
+
+    """
+    Main loop
+    """
+    def run(self):
+        self.running = True
+        self.LOGGER.info("Starting loop")
+        while True:
+            self.health.beat()
+            try:
+                # Main wants out, break out while loop
+                if not self.wantRunning:
+                    self._disconnect_db_client()
+                    self.LOGGER.info("Breaking loop")
+                    self.running = False
+                    break
+
+                if monotonic() < self._next_run:
+                    sleep(1)
+                    continue
+                self._next_run = monotonic() + self._interval
+
+                if not self._db_client or not self._db_client.open:
+                    self._connect_db_client()
+                    if not self._db_client:
+                        continue
+
+                time_start = monotonic()
+                for table in self._tables:
+                    try:
+                        if not self._maintain(table):
+                            break
+                    except Exception, e:
+                        if is_connection_error(e):
+                            self.LOGGER.error("Lost MySQL connection maintaining {}\n***{}".format(table['table'], e))
+                            self._disconnect_db_client()
+                            break
+                        # Bad table config or query, other tables are still maintained
+                        self.LOGGER.error("Error maintaining {}\n***{}".format(table['table'], e))
+                        self._db_client.rollback()
+                self.LOGGER.debug("[TIMING][MAINTENANCE] {:.3f} sec", monotonic() - time_start)
+            except Exception, e:
+                self.LOGGER.error("Unexpected exception in loop\n***{}", e)
+                self.health.failed(e)
+                self.running = False
+                self._disconnect_db_client()
+                break
+
+        # While loop broken
+        self.LOGGER.warning("Maintenance Thread exiting")
+        self.health.stopped()
+        return
@@ -1,14 +1,20 @@
 import routeros_api
 from threading import Thread
-from time import sleep
 from etc import config
 from lib.logger import get_logger
+from lib.supervisor import Health
 from lib.flow import Flow
+from lib.scheduler import Scheduler
+from lib.workerpool import WorkerPool
+from lib.connections import ConnectionManager
+from lib.routeros.engine import ApiEngine
+from lib.jobqueue import UnknownFlowError
+import Queue
 
 
 class MikrotikScrapper(Thread):
 
-    def __init__(self, output_queue):
+    def __init__(self, output_queue, drop_notices=None):
         # Setup thread stuff
         Thread.__init__(self)
         self.threadID = 2
@@ -17,43 +23,111 @@ class MikrotikScrapper(Thread):
 
         # Setup output
         self._out_report_queue = output_queue
+        self._put_timeout = (getattr(config, 'queue', None) or {}).get('put_timeout')
+        # Jobs dropped by writer side, see lib/changes.py DropNotices
+        self._drop_notices = drop_notices
+        # Thread gives up when no router could be connected this many times in a row, 0 never gives up
+        self._max_connect_failures = int(config.mikrotik.get('max_connect_failures', 5))
 
         # Setup flags
-        self._error_count = 0
         self.running = False
         self.wantRunning = True  # Can be changed from main
+        # Replaced by supervisor before start
+        self.health = Health()
 
-        self._apiConnection = None
+        self._scheduler = Scheduler(self.LOGGER,
+                                    config.mikrotik.get('overrun_policy', 'skip'),
+                                    config.mikrotik.get('max_catch_up', 3))
 
+        # Routers to scrape, single config.mikrotik router if router list is not configured
+        routers = getattr(config, 'routers', None) or [
+            dict(config.mikrotik, id=config.mikrotik.get('id', config.mikrotik['host']))
+        ]
+
+        # Every router gets its own instance of each flow it runs
         self._flows = []
-        for flow in config.flows:
-            try:
-                obj = Flow(self.LOGGER, flow)
-                self._flows.append(obj)
-            except Exception, e:
-                self.LOGGER.error("Could not setup flow [{}]\n{}".format(flow, e))
-
-    def _get_api_client(self):
-        try:
-            if not self._apiConnection or not self._apiConnection.connected:
-                # Init API connection
-                self._apiConnection = routeros_api.RouterOsApiPool(config.mikrotik['host'],
-                                                                   config.mikrotik['username'],
-                                                                   config.mikrotik['password'])
-                self.LOGGER.info("Connected to API")
-
-            return self._apiConnection.get_api()
-        except Exception, e:
-            self.LOGGER.error("Error connecting to API [{}]".format(e))
-            self._error_count += 1
-
-    def _disconnect_client(self):
-        if self._apiConnection.connected:
+        for router in routers:
+            for flow in config.flows:
+                if 'flows' in router and flow['name'] not in router['flows']:
+                    continue
+                try:
+                    obj = Flow(self.LOGGER, flow, router['id'])
+                    self._scheduler.add(obj, obj.get_run_interval(), obj.get_overrun_policy(),
+                                        max_concurrency=obj.get_max_concurrency())
+                    self._flows.append(obj)
+                except Exception, e:
+                    self.LOGGER.error("Could not setup flow [{}] for router [{}]\n{}".format(flow, router['id'], e))
+
+        # Optional non-blocking API engine, one event loop thread multiplexes tagged requests
+        # for all routers over a single socket per router
+        self._engine = None
+        connection_factory = self._create_api_connection
+        if config.mikrotik.get('engine') == 'async':
+            self._engine = ApiEngine(self.LOGGER,
+                                     config.mikrotik.get('connect_timeout', 10),
+                                     config.mikrotik.get('request_timeout', 60))
+            connection_factory = self._engine.connect
+
+        # Persistent, health checked connections per router, reconnects with backoff
+        self._connections = ConnectionManager(self.LOGGER,
+                                              routers,
+                                              connection_factory,
+                                              config.mikrotik.get('max_connections', 2),
+                                              config.mikrotik.get('health_check_interval', 30),
+                                              config.mikrotik.get('acquire_timeout', 10),
+                                              config.mikrotik.get('backoff_initial', 1),
+                                              config.mikrotik.get('backoff_max', 60),
+                                              multiplexed=self._engine is not None)
+
+        # Workers check out connection of flow's router for every run so slow flow can't hold up the others
+        # Run taking longer than flow_timeout seconds means worker is stuck, thread fails so supervisor restarts it
+        self._pool = WorkerPool(self.LOGGER,
+                                type(self).__name__,
+                                config.mikrotik.get('workers', len(self._flows) or 1),
+                                self._connections,
+                                self._on_flow_result,
+                                self._on_flow_done,
+                                config.mikrotik.get('flow_timeout', 300))
+
+    def _create_api_connection(self, router):
+        client = routeros_api.RouterOsApiPool(router['host'],
+                                              router['username'],
+                                              router['password'],
+                                              port=router.get('port', 8728))
+        # Read on a router that stopped answering fails instead of holding worker forever
+        client.set_timeout(router.get('socket_timeout', config.mikrotik.get('socket_timeout', 15)))
+        return client
+
+    # Worker pool callbacks, called from worker threads
+    def _on_flow_result(self, entry, result):
+        # If flow returned anything send result to Database thread
+        if result:
             try:
-                self._apiConnection.disconnect()
-                self.LOGGER.info("Disconnected API")
-            except Exception, e:
-                self.LOGGER.error("Error disconnecting API [{}]".format(e))
+                # Blocks worker when queue is full and backpressure policy is block
+                self._out_report_queue.put(result, timeout=self._put_timeout)
+            except UnknownFlowError, e:
+                self.LOGGER.error("Dropping result of flow [{}]\n***{}".format(entry.job, e))
+                entry.job.reset_changes()
+            except Queue.Full:
+                self.LOGGER.error("Queue full for {} sec, dropping result of flow [{}]".format(self._put_timeout,
+                                                                                            entry.job))
+                # Dropped rows were already marked as written, send everything again on next run
+                entry.job.reset_changes()
+
+    def _flush_rollups(self, running):
+        for flow in self._flows:
+            if flow in running:
+                # Worker still feeds the bucket, flushing it here would race with the run
+                self.LOGGER.warning("Flow [{}] still running, open rollup bucket not flushed".format(flow))
+                continue
+            for job in flow.flush_rollup():
+                try:
+                    self._out_report_queue.put(job, timeout=self._put_timeout)
+                except Exception, e:
+                    self.LOGGER.error("Dropping open rollup bucket of flow [{}]\n***{}".format(flow, e))
+
+    def _on_flow_done(self, entry):
+        self._scheduler.release(entry)
 
     """
     Main loop
@@ -62,47 +136,68 @@ class MikrotikScrapper(Thread):
         self.running = True
         self.LOGGER.info("Starting loop")
 
+        if self._engine:
+            self._engine.start()
+        self._pool.start()
+
         while True:
+            self.health.beat()
             try:
-                # If connecting failed sleep few seconds before retrying
-                if self._error_count > 0:
-                    sleep(5)
-
-                # If connecting failed too many times shutdown thread
-                if self._error_count > 5:
-                    self.LOGGER.info("Could not connect to API, breaking loop")
-                    self.wantRunning = False
-
                 # Main wants out, break out while loop
                 if not self.wantRunning:
-                    # Call disconnect if client is still connected
-                    if self._apiConnection.connected:
-                        self.LOGGER.info("Disconnecting API client")
-                        self._disconnect_client()
+                    # Workers disconnect their clients on exit
+                    self.LOGGER.info("Stopping workers")
+                    running = self._pool.stop()
+                    if self._engine:
+                        self._engine.stop()
+                    self._flush_rollups(running)
 
                     self.LOGGER.info("Breaking loop")
                     self.running = False
                     break
 
-                # Get API client object
-                client = self._get_api_client()
+                # If connecting failed too many times shutdown thread, supervisor decides whether to restart it
+                if self._max_connect_failures and self._connections.all_failing(self._max_connect_failures):
+                    self.LOGGER.error("Could not connect to API, breaking loop")
+                    self.health.failed("Could not connect to API {} times in a row".format(self._max_connect_failures))
+                    self._pool.stop()
+                    if self._engine:
+                        self._engine.stop()
+                    self.running = False
+                    break
 
-                # ## Check passed
+                overrun = self._pool.overrun()
+                if overrun:
+                    worker, flow, elapsed = overrun[0]
+                    reason = "{} stuck on flow [{}] for {:.0f} sec".format(worker, flow, elapsed)
+                    self.LOGGER.error("{}, breaking loop".format(reason))
+                    self.health.failed(reason)
+                    self._pool.stop()
+                    if self._engine:
+                        self._engine.stop()
+                    self.running = False
+                    break
 
-                # Run loop methods for all flows
-                # If flow returned anything send result to Database thread
-                for flow in self._flows:
-                    res = flow.loop_pass(client)
-                    if res:
-                        self._out_report_queue.put(res)
+                # Rows suppressed since a dropped job would never be written, those flows send everything again
+                if self._drop_notices:
+                    for flow in self._drop_notices.resync(self._flows):
+                        self.LOGGER.info("Job of flow [{}] was dropped, resyncing on next run".format(flow))
 
-                # Work done, sleep a bit
-                sleep(.2)
+                # Sleep until next flow is due, wake up at least once a second to check for shutdown
+                # Due flows are handed to worker pool, flow never overlaps with itself
+                for entry in self._scheduler.wait(1.0):
+                    if self._scheduler.acquire(entry):
+                        self._pool.submit(entry)
 
             except Exception, e:
-                self.LOGGER.error("Unexpected exception in loop\n***{}".format(e))
+                self.LOGGER.error("Unexpected exception in loop\n***{}", e)
+                self.health.failed(e)
+                self._pool.stop()
+                if self._engine:
+                    self._engine.stop()
                 self.running = False
                 break
         # While loop broken
         self.LOGGER.warning("Thread exiting")
+        self.health.stopped()
         return